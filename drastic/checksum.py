@@ -0,0 +1,155 @@
+"""Checksums of the ingested files
+
+A pool of threads dedicated to hashing, so that the checksums are computed
+while the uploads go on (hashlib releases the GIL on large buffers, the
+threads hash on several cores). The chunks of a file which is uploaded
+are handed to the pool as they are read, a stream only takes a thread
+while it has chunks waiting to be hashed, so any number of uploads share
+the pool. The files which aren't imported are read and hashed by the
+pool.
+
+Each part of a blob also has its own SHA-256, computed independently, and
+the blob records the root of the Merkle tree of its parts, so that any
+range of parts can be checked on its own.
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+from collections import deque
+import hashlib
+from multiprocessing.pool import ThreadPool
+import threading
+
+# Algorithm of Blob.hash
+BLOB_ALGORITHM = 'sha256'
+CHUNK_SIZE = 1024 * 1024
+# Chunks of a stream waiting to be hashed before update blocks
+STREAM_DEPTH = 4
+
+
+def check_algorithm(algorithm):
+    """Raise ValueError if hashlib doesn't know the algorithm"""
+    hashlib.new(algorithm)
+    return algorithm
+
+
+def part_hash(data):
+    """Return the hex digest of a part"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def tree_hash(part_hashes):
+    """Return the root of the Merkle tree of the hex digests of the parts.
+    A leaf is the SHA-256 of 0x00 and the hash of its part, a node the
+    SHA-256 of 0x01 and its two children, so that a leaf can't be taken
+    for a node. An odd node is carried up to the next level"""
+    level = [hashlib.sha256('\x00' + h.decode('hex')).digest() for h in part_hashes]
+    if not level:
+        return hashlib.sha256('').hexdigest()
+    while len(level) > 1:
+        parent = [hashlib.sha256('\x01' + level[i] + level[i + 1]).digest()
+                  for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            parent.append(level[-1])
+        level = parent
+    return level[0].encode('hex')
+
+
+def data_digests(data, algorithms):
+    """Return the {algorithm: hex digest} of a string"""
+    return dict((a, hashlib.new(a, data).hexdigest()) for a in algorithms)
+
+
+def file_digests(path, algorithms):
+    """Return the {algorithm: hex digest} of a file"""
+    hashers = dict((a, hashlib.new(a)) for a in algorithms)
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                break
+            for hasher in hashers.itervalues():
+                hasher.update(data)
+    return dict((a, h.hexdigest()) for a, h in hashers.iteritems())
+
+
+class HashPool(object):
+    """Threads computing the checksums of the files with an algorithm, and
+    the hash of the blobs"""
+
+    def __init__(self, algorithm='sha256', threads=4):
+        self.algorithm = check_algorithm(algorithm)
+        self.algorithms = set([algorithm, BLOB_ALGORITHM])
+        self.pool = ThreadPool(threads)
+        # The parts have their own threads, so that the uploads waiting for
+        # their hashes aren't held up by the files being hashed
+        self.parts = ThreadPool(threads)
+
+    def stream(self):
+        """Return a StreamDigest to feed the chunks of a blob to"""
+        return StreamDigest(self.pool, self.algorithms)
+
+    def part(self, data):
+        """Start hashing a part, return the AsyncResult of its hex digest"""
+        return self.parts.apply_async(part_hash, (data,))
+
+    def file(self, path):
+        """Start hashing a file, return the AsyncResult of its digests"""
+        return self.pool.apply_async(file_digests, (path, self.algorithms))
+
+    def close(self):
+        for pool in (self.pool, self.parts):
+            pool.close()
+            pool.join()
+
+
+class StreamDigest(object):
+    """Digests of a stream of chunks, hashed in order by the threads of a
+    pool. A task hashing the chunks of the stream is started when a chunk
+    is queued and none is running, it ends once the queue is empty. update
+    returns as soon as the chunk is queued"""
+
+    def __init__(self, pool, algorithms):
+        self.pool = pool
+        self.hashers = dict((a, hashlib.new(a)) for a in algorithms)
+        self.chunks = deque()
+        self.cond = threading.Condition()
+        # A task is hashing the chunks
+        self.running = False
+        self.digests = None
+
+    def update(self, data):
+        with self.cond:
+            while len(self.chunks) >= STREAM_DEPTH:
+                self.cond.wait()
+            self.chunks.append(data)
+            if not self.running:
+                self.running = True
+                self.pool.apply_async(self.run)
+
+    def run(self):
+        while True:
+            with self.cond:
+                if not self.chunks:
+                    self.running = False
+                    self.cond.notify_all()
+                    return
+                data = self.chunks[0]
+            for hasher in self.hashers.itervalues():
+                hasher.update(data)
+            with self.cond:
+                self.chunks.popleft()
+                self.cond.notify_all()
+
+    def hexdigests(self):
+        """Wait for the end of the stream, return {algorithm: hex digest}"""
+        with self.cond:
+            while self.running:
+                self.cond.wait()
+            if self.digests is None:
+                self.digests = dict((a, h.hexdigest()) for a, h in self.hashers.iteritems())
+        return self.digests
+
+    def hexdigest(self, algorithm=BLOB_ALGORITHM):
+        return self.hexdigests()[algorithm]
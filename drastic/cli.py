@@ -8,9 +8,15 @@ import argparse
 import sys
 
 from drastic import get_config
+from drastic.indexer import start_indexer
 from drastic.models.errors import GroupConflictError
 from drastic.models import initialise, sync, destroy
-from drastic.ingest import do_ingest
+from drastic.ingest import do_ingest, do_replay
+from drastic.distributed import do_coordinate, do_status, do_work
+from drastic.reindex import do_reindex
+
+# Commands which create, update or delete collections and resources
+INDEXED_COMMANDS = ('ingest', 'ingest-replay', 'ingest-coordinate', 'ingest-worker')
 
 
 def parse_arguments():
@@ -30,6 +36,44 @@ def parse_arguments():
                         help='Set if we do not want to import the files into Cassandra')
     parser.add_argument('--localip', dest='local_ip', action='store',
                         help='Specify the IP address for this machine (subnets/private etc)')
+    parser.add_argument('--workers', dest='workers', action='store', type=int,
+                        help='Specify the number of worker threads')
+    parser.add_argument('--events', dest='events', action='store', default='summary',
+                        choices=['summary', 'suppress', 'each'],
+                        help='Specify how the events of the ingested objects are published')
+    parser.add_argument('--manifest', dest='manifest', action='store',
+                        help='Specify the manifest file used to only ingest the files changed since the last run')
+    parser.add_argument('--report', dest='report', action='store',
+                        help='Specify the file where the JSON report of the ingest is written')
+    parser.add_argument('--filelist', dest='filelist', action='store',
+                        help='Specify a file with the list of the files to ingest, "-" to read it from stdin')
+    parser.add_argument('--deadletter', dest='dead_letter', action='store',
+                        help='Specify the file where the entries which could not be ingested are written')
+    parser.add_argument('--max-bytes-rate', dest='max_bytes_rate', action='store', type=float,
+                        help='Specify the maximum number of bytes ingested per second')
+    parser.add_argument('--max-rows-rate', dest='max_rows_rate', action='store', type=float,
+                        help='Specify the maximum number of rows written per second when ingesting')
+    parser.add_argument('--latency-target', dest='latency_target', action='store', type=float,
+                        default=0.1,
+                        help='Specify the write latency (in seconds) above which the ingest slows down')
+    parser.add_argument('--control', dest='control', action='store',
+                        help='Specify the JSON file with the ingest limits, read again when modified')
+    parser.add_argument('--processes', dest='processes', action='store', type=int,
+                        help='Specify the number of worker processes for ingestion of data')
+    parser.add_argument('--checksum', dest='checksum', action='store', default='sha256',
+                        help='Specify the algorithm of the checksums of the ingested resources, "none" to skip them')
+    parser.add_argument('--hash-workers', dest='hash_workers', action='store', type=int,
+                        help='Specify the number of threads computing the checksums when ingesting')
+    parser.add_argument('--inline-threshold', dest='inline_threshold', action='store', type=int,
+                        help='Specify the size in bytes up to which files are stored in their resource, 0 to disable')
+    parser.add_argument('--watch', dest='watch', action='store_true',
+                        help='Keep ingesting the changes of the folder after the first ingest')
+    parser.add_argument('--debounce', dest='debounce', action='store', type=float,
+                        help='Specify the seconds a changed file must be left alone before it is ingested')
+    parser.add_argument('--split-depth', dest='split_depth', action='store', type=int,
+                        help='Specify the depth of the directories whose subtrees are distributed ingest units')
+    parser.add_argument('--unit-size', dest='unit_size', action='store', type=int,
+                        help='Specify the number of directories or files of a distributed ingest unit')
     return parser.parse_args()
 
 
@@ -142,6 +186,13 @@ def group_list(cfg):
                 ("N", "Y")[user.id == group.owner])
 
 
+def search_migrate(cfg):
+    """Convert the legacy search index to the term partitioned index"""
+    from drastic.models.search import SearchIndex
+    count = SearchIndex.migrate()
+    print "Migrated the search index of {} objects".format(count)
+
+
 def main():
     """Main"""
     args = parse_arguments()
@@ -151,6 +202,11 @@ def main():
     initialise(keyspace, hosts=hosts)
 
     command = args.command[0]
+    if command in INDEXED_COMMANDS:
+        # The collections they change are reindexed in the background
+        indexer = start_indexer()
+    else:
+        indexer = None
     if command == 'create':
         create(cfg)
     elif command == 'user-create':
@@ -165,7 +221,21 @@ def main():
         group_add_user(cfg, args.command[1:])
     elif command == 'group-delete':
         group_delete(cfg, args.command[1:])
+    elif command == 'search-migrate':
+        search_migrate(cfg)
     elif command == 'zap':
         zap(cfg)
     elif command == 'ingest':
         do_ingest(cfg, args)
+    elif command == 'ingest-replay':
+        do_replay(cfg, args)
+    elif command == 'ingest-coordinate':
+        do_coordinate(cfg, args)
+    elif command == 'ingest-worker':
+        do_work(cfg, args)
+    elif command == 'ingest-status':
+        do_status(cfg, args)
+    elif command == 'reindex':
+        do_reindex(cfg, args)
+    if indexer is not None:
+        indexer.flush()
@@ -0,0 +1,374 @@
+"""Distributed ingest
+
+An ingest job is split by a coordinator into work units stored in
+Cassandra: the subtrees of the directories at a given depth, the files of
+the directories above them, or segments of a list of files. The
+collections above the units are created by the coordinator.
+
+Workers on any number of hosts (which all see the folder at the same
+path) claim the units with a lease taken with a lightweight transaction,
+renew it while they ingest the unit and mark the unit done at the end. The
+unit of a worker which died is taken over by another one when its lease
+expires. The lease version is a fencing token: a worker which lost its
+lease stops queueing files and can't mark the unit done.
+
+Lease expiry relies on the clocks of the worker hosts being in sync.
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+from datetime import datetime
+import os
+import socket
+import sys
+import threading
+import time
+
+from drastic import events
+from drastic.ingest import (
+    CollectionPlan,
+    Ingester,
+    check_arguments,
+    decode_str,
+    inline_setting,
+    INLINE_THRESHOLD
+)
+from drastic.log import init_log
+from drastic.metrics import IngestMetrics
+from drastic.models.collection import Collection
+from drastic.models.errors import NodeConflictError
+from drastic.models.group import Group
+from drastic.models.ingest_job import (
+    IngestJob,
+    WorkUnit,
+    PENDING,
+    RUNNING,
+    DONE,
+    FAILED
+)
+from drastic.models.node import Node
+from drastic.models.user import User
+from drastic.scanner import read_filelist
+from drastic.throttle import Throttle
+
+logger = init_log('distributed')
+
+# Seconds a lease lasts without being renewed
+LEASE_TTL = 60
+# Depth of the directories whose subtrees are units
+SPLIT_DEPTH = 2
+# Directories (or files for a list of files) per unit
+UNIT_SIZE = 1000
+# Seconds between two looks for a unit when the others are all leased
+IDLE_WAIT = 10
+# Attempts of a unit whose ingest raised an error before it's failed
+UNIT_ATTEMPTS = 3
+
+
+def split_plan(plan, split_depth=SPLIT_DEPTH, unit_size=UNIT_SIZE):
+    """Return the (kind, paths) units of a plan built down to split_depth.
+    The directories at split_depth are "tree" units, the root and the
+    directories above them are grouped in "dirs" units"""
+    units = []
+    dirs = [u'/']
+    for depth, level in enumerate(plan.levels):
+        for _, _, _, path in level:
+            if depth + 1 == split_depth:
+                units.append(('tree', [path]))
+            else:
+                dirs.append(path)
+    for i in range(0, len(dirs), unit_size):
+        units.append(('dirs', dirs[i:i + unit_size]))
+    return units
+
+
+def split_files(paths, unit_size=UNIT_SIZE):
+    """Return the (kind, paths) units of a list of files"""
+    return [('files', [decode_str(p) for p in paths[i:i + unit_size]])
+            for i in range(0, len(paths), unit_size)]
+
+
+def local_address(hosts, port=9042):
+    """Return the address of this host on the route to the Cassandra
+    hosts, None if none can be reached. Unlike the address of the host
+    name, which is a loopback address on many systems, it tells the hosts
+    apart"""
+    for host in hosts:
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            # Nothing is sent, this only picks the route
+            s.connect((host, port))
+            return s.getsockname()[0]
+        except socket.error:
+            continue
+        finally:
+            s.close()
+    return None
+
+
+# noinspection PyUnusedLocal
+def do_coordinate(cfg, args):
+    """Split an ingest in work units, print the id of the job"""
+    user, group, path = check_arguments(args)
+    coordinator = Coordinator(user, group, path, args.local_ip, args.no_import,
+                              threads=args.workers or 8,
+                              filelist=args.filelist,
+                              split_depth=args.split_depth or SPLIT_DEPTH,
+                              unit_size=args.unit_size or UNIT_SIZE,
+                              events_mode=None if args.events == 'each' else args.events)
+    job = coordinator.start()
+    msg = u"Ingest job {}: {} units".format(job.id, job.units)
+    logger.info(msg)
+    print msg
+
+
+# noinspection PyUnusedLocal
+def do_work(cfg, args):
+    """Ingest the units of a job until they are all done"""
+    job = find_job(args)
+    throttle = Throttle(args.max_bytes_rate, args.max_rows_rate,
+                        args.latency_target, args.control)
+    throttle.reload()
+    worker = Worker(job, threads=args.workers or 8,
+                    local_ip=args.local_ip or local_address(cfg.get('CASSANDRA_HOSTS', ('127.0.0.1', ))),
+                    events_mode=None if args.events == 'each' else args.events,
+                    report=args.report, dead_letter=args.dead_letter,
+                    throttle=throttle,
+                    checksum=None if args.checksum == 'none' else args.checksum,
+                    hash_threads=args.hash_workers or 4,
+                    inline_threshold=inline_setting(cfg, args))
+    worker.start()
+
+
+# noinspection PyUnusedLocal
+def do_status(cfg, args):
+    """Print the number of units of a job in each state"""
+    job = find_job(args)
+    files = size = failed = 0
+    counts = {}
+    for unit in job.get_units():
+        counts[unit.state] = counts.get(unit.state, 0) + 1
+        files += unit.files or 0
+        size += unit.bytes or 0
+        failed += unit.failed or 0
+    print u"Ingest job {} of {}".format(job.id, job.folder)
+    for state in (PENDING, RUNNING, DONE, FAILED):
+        print u"{0:10s}{1}".format(state, counts.get(state, 0))
+    print u"Ingested {} files, {} bytes, {} failed".format(files, size, failed)
+
+
+def find_job(args):
+    if len(args.command) < 2:
+        msg = "The id of the ingest job is required"
+        logger.error(msg)
+        print msg
+        sys.exit(1)
+    job = IngestJob.find(args.command[1])
+    if not job:
+        msg = u"Ingest job '{}' not found".format(args.command[1])
+        logger.error(msg)
+        print msg
+        sys.exit(1)
+    return job
+
+
+class Coordinator(object):
+    """Plan an ingest job, create the collections above its units and
+    store the units"""
+
+    def __init__(self, user, group, folder, local_ip='127.0.0.1', skip_import=False,
+                 threads=8, filelist=None, split_depth=SPLIT_DEPTH, unit_size=UNIT_SIZE,
+                 events_mode='summary'):
+        self.user = user
+        self.group = group
+        self.folder = folder
+        self.local_ip = local_ip or '127.0.0.1'
+        self.skip_import = skip_import
+        self.threads = threads
+        self.filelist = filelist
+        self.split_depth = split_depth
+        self.unit_size = unit_size
+        self.events_mode = events_mode
+
+    def start(self):
+        """Return the job once its units are stored"""
+        ingester = Ingester(self.user, self.group, self.folder, self.local_ip,
+                            self.skip_import, threads=self.threads)
+        ingester.get_root()
+        plan = CollectionPlan(self.folder)
+        if self.filelist:
+            paths = read_filelist(self.filelist)
+            plan.from_files(paths)
+            units = split_files(paths, self.unit_size)
+        else:
+            plan.build(self.threads, max_depth=self.split_depth)
+            units = split_plan(plan, self.split_depth, self.unit_size)
+        with events.bulk(self.events_mode):
+            ingester.create_collections(plan)
+
+        job = IngestJob.create(folder=decode_str(self.folder),
+                               user=self.user.id,
+                               group=self.group.id,
+                               local_ip=self.local_ip,
+                               skip_import=bool(self.skip_import),
+                               units=len(units),
+                               create_ts=datetime.utcnow())
+        for i, (kind, paths) in enumerate(units):
+            WorkUnit.create(job=job.id, id=u"{:06d}".format(i), kind=kind, paths=paths)
+        return job
+
+
+class Worker(object):
+    """Claim the units of a job and ingest them until none is left"""
+
+    def __init__(self, job, threads=8, ttl=LEASE_TTL, events_mode='summary',
+                 report=None, dead_letter=None, throttle=None, checksum='sha256',
+                 hash_threads=4, inline_threshold=INLINE_THRESHOLD, local_ip=None):
+        self.job = job
+        # Address the node is registered with
+        self.local_ip = local_ip
+        self.threads = threads
+        self.ttl = ttl
+        self.events_mode = events_mode
+        self.report_path = report
+        self.dead_letter = dead_letter
+        self.throttle = throttle
+        self.checksum = checksum
+        self.hash_threads = hash_threads
+        self.inline_threshold = inline_threshold
+        self.node = None
+        # Several workers can run on the same node
+        self.owner = None
+        self.metrics = IngestMetrics()
+
+    def start(self):
+        self.node = self.register()
+        self.owner = u"{}:{}".format(self.node.id, os.getpid())
+        while True:
+            unit = self.claim()
+            if unit is not None:
+                self.process(unit)
+                continue
+            if self.finished():
+                break
+            time.sleep(IDLE_WAIT)
+        self.metrics.print_progress()
+        if self.report_path:
+            self.metrics.write_report(self.report_path)
+
+    def register(self):
+        """Return the node of the host, registered if needed"""
+        name = socket.gethostname()
+        node = Node.find(name)
+        if not node:
+            address = self.local_ip or name
+            try:
+                node = Node.create(name=name, address=address)
+            except NodeConflictError:
+                # Registered by another worker of the host in the meantime
+                node = Node.find(name)
+                if not node:
+                    msg = (u"Another node is registered with the address {}, set the "
+                           u"address of this host with --localip".format(address))
+                    logger.error(msg)
+                    print msg
+                    sys.exit(1)
+        node.update(last_update=datetime.now(), status="UP")
+        return node
+
+    def claim(self):
+        """Lease a unit, return None if there's none to claim"""
+        now = datetime.utcnow()
+        for unit in self.job.get_units():
+            if unit.claimable(now) and unit.claim(self.owner, self.ttl):
+                logger.info(u"Claimed unit {} of job {}".format(unit.id, self.job.id))
+                return unit
+        return None
+
+    def finished(self):
+        """Check if all the units are done or failed"""
+        return all(unit.state in (DONE, FAILED) for unit in self.job.get_units())
+
+    def heartbeat(self, unit, stopped, lost):
+        """Renew the lease of a unit until stopped is set, set lost if the
+        lease has been taken over"""
+        while not stopped.wait(self.ttl / 3.0):
+            if not unit.renew(self.owner, self.ttl):
+                logger.warning(u"Lost the lease of unit {} of job {}".format(unit.id, self.job.id))
+                lost.set()
+                return
+            self.node.update(last_update=datetime.now())
+
+    def process(self, unit):
+        """Ingest a unit while renewing its lease"""
+        stopped = threading.Event()
+        lost = threading.Event()
+        beat = threading.Thread(target=self.heartbeat, args=(unit, stopped, lost))
+        beat.setDaemon(True)
+        beat.start()
+        ingester = UnitIngester(unit, lost,
+                                User.find_by_id(self.job.user),
+                                Group.find_by_id(self.job.group),
+                                self.job.folder.encode('utf8'),
+                                self.job.local_ip, self.job.skip_import,
+                                threads=self.threads, events_mode=self.events_mode,
+                                dead_letter=self.dead_letter, throttle=self.throttle,
+                                checksum=self.checksum, hash_threads=self.hash_threads,
+                                inline_threshold=self.inline_threshold)
+        state = DONE
+        try:
+            ingester.start()
+        except Exception as e:
+            logger.error(u"Problem ingesting unit {} of job {}: {}".format(unit.id, self.job.id, e))
+            # Let another attempt have a go at it
+            state = PENDING if unit.attempts < UNIT_ATTEMPTS else FAILED
+        finally:
+            stopped.set()
+            beat.join()
+        report = ingester.metrics.report()
+        self.metrics.merge(report)
+        if lost.is_set() or not unit.finish(self.owner, state, report['files'],
+                                             report['bytes'], report['failed']):
+            logger.warning(u"Unit {} of job {} was taken over".format(unit.id, self.job.id))
+
+
+class UnitIngester(Ingester):
+    """Ingester of a work unit, the collections above the unit exist"""
+
+    def __init__(self, unit, lost, *args, **kwargs):
+        super(UnitIngester, self).__init__(*args, **kwargs)
+        self.unit = unit
+        # Set when the lease of the unit has been lost
+        self.lost = lost
+
+    def do_work(self):
+        self.get_root()
+        plan = CollectionPlan(self.folder)
+        paths = self.unit.paths or []
+        if self.unit.kind == 'files':
+            plan.from_files([p.encode('utf8') for p in paths])
+            roots = [(self.folder, u'/')]
+        elif self.unit.kind == 'tree':
+            dirpath = self.folder + paths[0].encode('utf8')
+            with self.metrics.stage('plan'):
+                plan.build(self.threads, root=dirpath)
+            roots = [(dirpath, paths[0])]
+        else:
+            roots = [(self.folder if p == u'/' else self.folder + p.encode('utf8'), p)
+                     for p in paths]
+        for _, path in roots:
+            if path not in self.collection_cache:
+                collection = Collection.find_by_path(path)
+                if collection is None:
+                    logger.error(u"Skipping {}, its collection is missing".format(path))
+                    continue
+                self.collection_cache[path] = collection
+        self.ingest_plan(plan, [(dirpath, path) for dirpath, path in roots
+                                if path in self.collection_cache])
+
+    def create_entry(self, rdict, context, do_load):
+        # The unit belongs to another worker now
+        if self.lost.is_set():
+            return
+        super(UnitIngester, self).create_entry(rdict, context, do_load)
@@ -6,28 +6,31 @@ __license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
 
 from drastic.drivers.filesystem import FileSystemDriver
 from drastic.drivers.cassandra import CassandraDriver
+from drastic.drivers.inline import InlineDriver
 from drastic.drivers.test import TestDriver
 from drastic.models.errors import NoSuchDriverError
 
 DRIVERS = {
     "cassandra": CassandraDriver,
     "file": FileSystemDriver,
+    "inline": InlineDriver,
     "test": TestDriver,
 }
 
 
-def get_driver(url):
+def get_driver(url, resource=None):
     """Parse a url to get the correct driver
 
     Given a url this function attempts to create a driver which is initialised
     with the appropriate path from the URL. For example, cassandra://IDSTRING
     will return an instance of CassandraDriver whose url property is set to
-    IDSTRING.
+    IDSTRING. The resource of the url can be given if it has already been
+    read, the inline driver then doesn't read it again.
     """
     scheme, path = parse_url(url)
     if scheme not in DRIVERS:
         raise NoSuchDriverError(u"{} is an unknown protocol".format(scheme))
-    return DRIVERS[scheme](path)
+    return DRIVERS[scheme](path, resource)
 
 
 def parse_url(url):
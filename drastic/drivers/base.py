@@ -12,8 +12,10 @@ class StorageDriver(object):
     is handled by the cassandra driver, file:// by the FileSystem driver.
     """
 
-    def __init__(self, url=None):
+    def __init__(self, url=None, resource=None):
         self.url = url
+        # The resource of the url, when the caller already has it
+        self.resource = resource
 
     def chunk_content(self):
         """
@@ -0,0 +1,25 @@
+"""Drastic Inline Driver.
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+from drastic.drivers.base import StorageDriver
+
+
+class InlineDriver(StorageDriver):
+    """Inline Driver, used to yield the content of a small resource stored
+    in the resource row itself, inline://<resource id>
+    """
+
+    def chunk_content(self):
+        """
+        Yields the content of the resource in a single chunk. The row is
+        only read if the driver wasn't given the resource.
+        """
+        resource = self.resource
+        if resource is None:
+            from drastic.models.resource import Resource
+            resource = Resource.find_by_id(self.url)
+        if resource is not None and resource.content:
+            yield resource.content
@@ -0,0 +1,456 @@
+"""Event publisher
+
+Publishes the create/update/delete events of the models on the MQTT
+broker. publish.single opens a connection to the broker for every
+message, so the models put their events in a bounded in-memory queue
+instead and a background thread sends them through one persistent
+connection, a batch at a time.
+
+When the queue is full the overflow policy decides what happens to a new
+event:
+
+- "block": the writer waits for room in the queue (at most
+  EVENT_BLOCK_TIMEOUT seconds, 30 by default, the event is spooled after
+  that if there is a spool file, dropped otherwise)
+- "drop": the event is dropped
+- "spool": the event is appended to the EVENT_SPOOL file, the spooled
+  events are sent once the queue has drained
+
+A spool file which was being sent when the process stopped is sent again
+by the next publisher using it.
+
+The publisher is created on first use from the MQTT_HOST, MQTT_PORT,
+EVENT_QUEUE_SIZE, EVENT_OVERFLOW, EVENT_BLOCK_TIMEOUT and EVENT_SPOOL
+settings.
+
+Bulk operations (an ingest for instance) run in a bulk() context, where the
+events of the objects aren't published one by one. In "summary" mode they
+are collected per operation, object type and container and published as
+batches on "bulk/<operation>/<type>/<container>", with the ids and names
+of the objects (or the path of a manifest file holding them). In
+"suppress" mode they are only counted. In both modes a "bulk/summary"
+event with the counts is published at the end. A bulk operation collects
+the events of the thread which started it, and of the threads which join
+it with join_bulk (or run a function wrapped by in_bulk).
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+import atexit
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+import json
+import os
+import threading
+import time
+import uuid
+
+from drastic.log import init_log
+
+logger = init_log('events')
+
+POLICIES = ('block', 'drop', 'spool')
+# Number of events sent in one go by the background thread
+BATCH_SIZE = 100
+# Maximum delay between two connection attempts
+MAX_RECONNECT_DELAY = 60
+# Seconds a writer waits for room in the queue with the block policy
+BLOCK_TIMEOUT = 30
+BULK_MODES = ('summary', 'suppress')
+# Number of objects in a summary event
+BULK_BATCH_SIZE = 1000
+
+_publisher = None
+_publisher_lock = threading.Lock()
+# The BulkEvents collecting the events of each thread, if any
+_local = threading.local()
+
+
+class EventPublisher(object):
+    """Queue of the events to publish, sent by a background thread"""
+
+    def __init__(self, host='localhost', port=1883, maxsize=10000, policy='block',
+                 block_timeout=BLOCK_TIMEOUT, spool_path=None, batch_size=BATCH_SIZE):
+        if policy not in POLICIES:
+            raise ValueError(u"Unknown overflow policy {}".format(policy))
+        if policy == 'spool' and not spool_path:
+            raise ValueError(u"The spool policy needs a spool file")
+        self.host = host
+        self.port = port
+        self.maxsize = maxsize
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.spool_path = spool_path
+        self.batch_size = batch_size
+        self.client = None
+        self.thread = None
+        self.reset()
+
+    def reset(self):
+        """Forget the queue and the connection, called at creation and in
+        a child process after a fork"""
+        self.pid = os.getpid()
+        self.queue = deque()
+        self.cond = threading.Condition()
+        self.spool_lock = threading.Lock()
+        self.connected = False
+        self.sending = 0
+        self.closed = False
+        self.published = 0
+        self.dropped = 0
+        self.spooled = 0
+        self.errors = 0
+        self.reconnects = 0
+        self.max_depth = 0
+
+    def start(self):
+        """Start the background thread"""
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def check_fork(self):
+        """The connection and the thread don't survive a fork, start again
+        in the child process"""
+        if self.pid != os.getpid():
+            started = self.thread is not None
+            self.client = None
+            self.thread = None
+            self.reset()
+            if started:
+                self.start()
+
+    def publish(self, topic, payload):
+        """Queue an event, return False if it has been dropped"""
+        self.check_fork()
+        with self.cond:
+            if len(self.queue) >= self.maxsize:
+                if self.policy == 'drop':
+                    self.dropped += 1
+                    return False
+                if self.policy == 'spool':
+                    self.spool(topic, payload)
+                    return True
+                deadline = None
+                if self.block_timeout is not None:
+                    deadline = time.time() + self.block_timeout
+                while len(self.queue) >= self.maxsize:
+                    remaining = None
+                    if deadline is not None:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            if self.spool_path:
+                                self.spool(topic, payload)
+                                return True
+                            self.dropped += 1
+                            return False
+                    self.cond.wait(remaining)
+            self.queue.append((topic, payload))
+            self.max_depth = max(self.max_depth, len(self.queue))
+            self.cond.notify_all()
+        return True
+
+    def spool(self, topic, payload):
+        """Append an event to the spool file"""
+        with self.spool_lock:
+            with open(self.spool_path, 'a') as f:
+                f.write(json.dumps({'topic': topic, 'payload': payload}) + '\n')
+        self.spooled += 1
+
+    def metrics(self):
+        """Return a dictionary with the state of the publisher"""
+        with self.cond:
+            return {
+                'depth': len(self.queue),
+                'max_depth': self.max_depth,
+                'connected': self.connected,
+                'published': self.published,
+                'dropped': self.dropped,
+                'spooled': self.spooled,
+                'errors': self.errors,
+                'reconnects': self.reconnects,
+            }
+
+    def connect(self):
+        """Connect to the broker, retrying with an increasing delay"""
+        import paho.mqtt.client as mqtt
+
+        def on_connect(client, userdata, flags, rc):
+            self.connected = rc == 0
+
+        def on_disconnect(client, userdata, rc):
+            self.connected = False
+            self.reconnects += 1
+
+        delay = 1
+        while True:
+            try:
+                client = mqtt.Client()
+                client.on_connect = on_connect
+                client.on_disconnect = on_disconnect
+                client.connect(self.host, self.port, 60)
+                # The network loop reconnects by itself from now on
+                client.loop_start()
+                self.client = client
+                return
+            except (IOError, OSError) as e:
+                logger.warning(u"Unable to connect to the MQTT broker {}:{} ({}), "
+                               u"retrying in {} seconds".format(self.host, self.port, e, delay))
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+    def take(self):
+        """Wait for events and return a batch of them"""
+        with self.cond:
+            while not self.queue:
+                self.cond.wait(1.0)
+                if not self.queue and self.has_spool():
+                    return []
+            batch = []
+            while self.queue and len(batch) < self.batch_size:
+                batch.append(self.queue.popleft())
+            self.sending = len(batch)
+            # Make room for the writers which are blocked
+            self.cond.notify_all()
+            return batch
+
+    def send(self, topic, payload):
+        """Send one event, return False if the client refused it"""
+        try:
+            rc = self.client.publish(topic, payload)[0]
+        except (IOError, OSError, ValueError) as e:
+            logger.warning(u'Unable to publish on "{}": {}'.format(topic, e))
+            rc = -1
+        return rc == 0
+
+    def run(self):
+        self.connect()
+        while True:
+            batch = self.take()
+            if not batch:
+                self.send_spool()
+                continue
+            failed = []
+            for i, (topic, payload) in enumerate(batch):
+                if not self.send(topic, payload):
+                    failed = batch[i:]
+                    break
+            with self.cond:
+                self.published += len(batch) - len(failed)
+                self.sending = 0
+                if failed:
+                    # Retried first once the connection is back
+                    self.errors += 1
+                    self.queue.extendleft(reversed(failed))
+                self.cond.notify_all()
+            if failed:
+                time.sleep(1)
+
+    def has_spool(self):
+        """Check if there are spooled events to send, in the spool file or
+        in the file of a sending which didn't finish"""
+        if not self.spool_path:
+            return False
+        return os.path.exists(self.spool_path + '.sending') or os.path.exists(self.spool_path)
+
+    def send_spool(self):
+        """Send the events of the spool file, while the queue is empty. The
+        events of a sending which didn't finish are sent first"""
+        sending_path = self.spool_path + '.sending'
+        with self.spool_lock:
+            if not os.path.exists(sending_path):
+                if not os.path.exists(self.spool_path):
+                    return
+                os.rename(self.spool_path, sending_path)
+        sent = 0
+        with open(sending_path) as f:
+            for line in f:
+                event = json.loads(line)
+                if not self.send(event['topic'], event['payload']):
+                    # Left for the next attempt, events may be sent twice
+                    logger.warning(u"Stopped sending the spooled events after {}".format(sent))
+                    time.sleep(1)
+                    return
+                sent += 1
+        os.remove(sending_path)
+        with self.cond:
+            self.published += sent
+        logger.info(u"Sent {} spooled events".format(sent))
+
+    def flush(self, timeout=None):
+        """Wait until the queue is empty, return False if the timeout
+        expired before"""
+        deadline = time.time() + timeout if timeout is not None else None
+        with self.cond:
+            while self.queue or self.sending:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                self.cond.wait(remaining)
+        return True
+
+    def close(self, timeout=5):
+        """Send the queued events (at most for `timeout` seconds) and
+        disconnect"""
+        if self.closed or self.thread is None or self.pid != os.getpid():
+            return
+        self.closed = True
+        if not self.flush(timeout):
+            logger.warning(u"{} events not published".format(len(self.queue)))
+        if self.client is not None:
+            self.client.loop_stop()
+            self.client.disconnect()
+
+
+def get_publisher():
+    """Return the publisher of the process, started on first use"""
+    global _publisher
+    with _publisher_lock:
+        if _publisher is None:
+            from drastic import get_config
+            try:
+                cfg = get_config()
+            except ImportError:
+                cfg = {}
+            _publisher = EventPublisher(host=cfg.get('MQTT_HOST', 'localhost'),
+                                        port=cfg.get('MQTT_PORT', 1883),
+                                        maxsize=cfg.get('EVENT_QUEUE_SIZE', 10000),
+                                        policy=cfg.get('EVENT_OVERFLOW', 'block'),
+                                        block_timeout=cfg.get('EVENT_BLOCK_TIMEOUT', BLOCK_TIMEOUT),
+                                        spool_path=cfg.get('EVENT_SPOOL'))
+            _publisher.start()
+            atexit.register(_publisher.close)
+    return _publisher
+
+
+def publish(topic, payload):
+    """Publish an event on the MQTT broker, in the background"""
+    return get_publisher().publish(topic, payload)
+
+
+def clean_topic(topic):
+    """Remove the superfluous slashes and the MQTT wildcards of a topic"""
+    topic = '/'.join(filter(None, topic.split('/')))
+    return topic.replace('#', '').replace('+', '')
+
+
+class BulkEvents(object):
+    """Collects the events of the objects during a bulk operation"""
+
+    def __init__(self, mode='summary', batch_size=BULK_BATCH_SIZE, manifest_dir=None):
+        if mode not in BULK_MODES:
+            raise ValueError(u"Unknown bulk mode {}".format(mode))
+        self.mode = mode
+        self.batch_size = batch_size
+        # Write the ids and names in files instead of the payloads
+        self.manifest_dir = manifest_dir
+        self.lock = threading.Lock()
+        # (operation, object type, container) -> [(id, name)]
+        self.pending = {}
+        # "operation/object type" -> number of objects
+        self.counts = {}
+        self.started = datetime.utcnow()
+        self.finished = False
+
+    def add(self, operation, object_type, payload):
+        """Collect the event of an object, return False if the operation
+        is over"""
+        key = (operation, object_type, payload['container'])
+        batch = None
+        with self.lock:
+            if self.finished:
+                return False
+            count_key = u'{}/{}'.format(operation, object_type)
+            self.counts[count_key] = self.counts.get(count_key, 0) + 1
+            if self.mode == 'suppress':
+                return True
+            objects = self.pending.setdefault(key, [])
+            objects.append((payload['id'], payload['name']))
+            if len(objects) >= self.batch_size:
+                batch = self.pending.pop(key)
+        if batch:
+            self.send(key, batch)
+        return True
+
+    def send(self, key, objects):
+        """Publish the summary event of a batch of objects"""
+        operation, object_type, container = key
+        payload = {'operation': operation,
+                   'type': object_type,
+                   'container': container,
+                   'count': len(objects)}
+        if self.manifest_dir:
+            path = os.path.join(self.manifest_dir, '{}.json'.format(uuid.uuid4()))
+            with open(path, 'w') as f:
+                json.dump([{'id': i, 'name': n} for i, n in objects], f)
+            payload['manifest'] = path
+        else:
+            payload['ids'] = [i for i, _ in objects]
+            payload['names'] = [n for _, n in objects]
+        topic = clean_topic(u'bulk/{}/{}{}'.format(operation, object_type, container))
+        publish(topic, json.dumps(payload))
+
+    def finish(self):
+        """Publish the remaining batches and the summary of the operation"""
+        with self.lock:
+            self.finished = True
+            pending, self.pending = self.pending, {}
+        for key, objects in pending.iteritems():
+            self.send(key, objects)
+        publish('bulk/summary', json.dumps({'mode': self.mode,
+                                            'counts': self.counts,
+                                            'started': self.started.isoformat(),
+                                            'finished': datetime.utcnow().isoformat()}))
+
+
+@contextmanager
+def bulk(mode='summary', batch_size=BULK_BATCH_SIZE, manifest_dir=None):
+    """Collect the events of the objects of the thread in summary events,
+    or suppress them, until the end of the block. With a mode of None the
+    events are published as usual"""
+    if mode is None:
+        yield None
+        return
+    events = BulkEvents(mode, batch_size, manifest_dir)
+    previous = current_bulk()
+    _local.bulk = events
+    try:
+        yield events
+    finally:
+        _local.bulk = previous
+        events.finish()
+
+
+def current_bulk():
+    """Return the BulkEvents collecting the events of the thread, if any"""
+    return getattr(_local, 'bulk', None)
+
+
+def join_bulk(events):
+    """Collect the events of the thread in a bulk operation started by
+    another thread (None to stop), until the operation is over"""
+    _local.bulk = events
+
+
+def in_bulk(target):
+    """Wrap a function to be run by another thread, so that its events go
+    to the bulk operation of the calling thread"""
+    events = current_bulk()
+
+    def run(*args, **kwargs):
+        join_bulk(events)
+        return target(*args, **kwargs)
+    return run
+
+
+def collect(operation, object_type, payload):
+    """Called by the models before publishing the event of an object,
+    return True if the event is handled by a bulk operation"""
+    events = current_bulk()
+    if events is None:
+        return False
+    return events.add(operation, object_type, payload)
@@ -0,0 +1,163 @@
+"""Index maintenance
+
+Keeps the search index up to date when collections and resources are
+created, updated or deleted, without slowing the writes down: the models
+only put the object in a queue, worker threads reindex it in the
+background.
+
+Repeated changes to the same object before it is processed are coalesced,
+the object is reindexed once with its latest state. An object is reindexed
+by one worker at a time, a change made while it's being reindexed waits
+in the queue until the worker is done with it. The queue is only fed
+once it has been started in the process, with start_indexer(): the
+drastic command starts it for the ingest commands, the web application
+when it starts. A forked process doesn't inherit the worker threads, it
+must start its own queue.
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+from collections import OrderedDict
+from itertools import islice
+import os
+import threading
+import time
+
+from drastic.log import init_log
+
+logger = init_log('indexer')
+
+_queue = None
+
+
+class IndexQueue(object):
+    """Queue of the objects to reindex, processed by worker threads"""
+
+    def __init__(self, batch_size=100):
+        self.batch_size = batch_size
+        # object id -> latest version of the object, None if deleted
+        self.pending = OrderedDict()
+        self.cond = threading.Condition()
+        # Ids of the objects being reindexed
+        self.in_flight = set()
+        self.enqueued = 0
+        self.coalesced = 0
+        self.processed = 0
+        self.errors = 0
+        self.workers = []
+        # The process of the worker threads
+        self.pid = os.getpid()
+
+    def put(self, object_id, obj):
+        """Queue an object to reindex, obj is None if it has been deleted"""
+        with self.cond:
+            if object_id in self.pending:
+                # The object keeps its place in the queue
+                self.coalesced += 1
+            self.pending[object_id] = obj
+            self.enqueued += 1
+            self.cond.notify_all()
+
+    def depth(self):
+        """Return the number of objects waiting to be reindexed"""
+        return len(self.pending)
+
+    def metrics(self):
+        """Return a dictionary with the state of the queue"""
+        with self.cond:
+            return {
+                'depth': len(self.pending),
+                'in_flight': len(self.in_flight),
+                'enqueued': self.enqueued,
+                'coalesced': self.coalesced,
+                'processed': self.processed,
+                'errors': self.errors,
+                'workers': len(self.workers),
+            }
+
+    def start(self, workers=2):
+        for _ in range(workers):
+            t = threading.Thread(target=self.run)
+            t.setDaemon(True)
+            t.start()
+            self.workers.append(t)
+
+    def take(self):
+        """Wait for objects to reindex and return a batch of them, the
+        objects being reindexed by another worker are left in the queue"""
+        with self.cond:
+            while True:
+                ids = list(islice((object_id for object_id in self.pending
+                                   if object_id not in self.in_flight),
+                                  self.batch_size))
+                if ids:
+                    break
+                self.cond.wait()
+            batch = [(object_id, self.pending.pop(object_id)) for object_id in ids]
+            self.in_flight.update(ids)
+            return batch
+
+    def done(self, batch, errors=0):
+        """Called by a worker once it has reindexed a batch"""
+        with self.cond:
+            self.in_flight.difference_update(object_id for object_id, _ in batch)
+            self.processed += len(batch)
+            self.errors += errors
+            self.cond.notify_all()
+
+    def run(self):
+        from drastic.models.search import FIELDS, SearchIndex
+        while True:
+            batch = self.take()
+            errors = 0
+            for object_id, obj in batch:
+                try:
+                    SearchIndex.reset(object_id)
+                    if obj is not None:
+                        SearchIndex.index(obj, FIELDS)
+                except Exception as e:
+                    logger.error(u"Problem reindexing {}: {}".format(object_id, e))
+                    errors += 1
+            self.done(batch, errors)
+
+    def flush(self, timeout=None):
+        """Wait until every queued object has been reindexed, return False
+        if the timeout expired before"""
+        deadline = time.time() + timeout if timeout is not None else None
+        with self.cond:
+            while self.pending or self.in_flight:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                self.cond.wait(remaining)
+        return True
+
+
+def start_indexer(workers=2, batch_size=100):
+    """Start reindexing the objects changed in this process, return the
+    queue"""
+    global _queue
+    if _queue is None or _queue.pid != os.getpid():
+        _queue = IndexQueue(batch_size)
+        _queue.start(workers)
+        logger.info('Index maintenance started with {} workers'.format(workers))
+    return _queue
+
+
+def get_indexer():
+    """Return the queue of the process, None if it hasn't been started"""
+    if _queue is None or _queue.pid != os.getpid():
+        return None
+    return _queue
+
+
+def notify(obj, operation):
+    """Called by the models when an object is created, updated or
+    deleted"""
+    queue = get_indexer()
+    if queue is None:
+        return
+    queue.put(obj.id, None if operation == 'delete' else obj)
@@ -4,30 +4,54 @@ __copyright__ = "Copyright (C) 2016 University of Maryland"
 __license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
 
 
+from collections import OrderedDict
+from datetime import datetime
+import json
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import os
+import signal
+import stat
 import sys
+import threading
 import time
+import zlib
 from threading import Thread
 from mimetypes import guess_type
 from Queue import Queue
 
-from cassandra.cqlengine.query import BatchQuery
+from cassandra.cqlengine.query import BatchQuery, BatchType
 
-from drastic.models.search import SearchIndex
+from drastic.models.search import FIELDS, SearchIndex
 from drastic.models.blob import Blob
 from drastic.models.user import User
 from drastic.models.group import Group
 from drastic.models.collection import Collection
 from drastic.models.resource import Resource
-from drastic.models.errors import (
-    CollectionConflictError,
-    ResourceConflictError
-)
-from drastic.util import split
+from drastic.models.errors import ResourceConflictError
+from drastic import events, indexer
+from drastic.checksum import BLOB_ALGORITHM, HashPool, data_digests
+from drastic.models import initialise
+from drastic.manifest import IngestManifest
+from drastic.metrics import IngestMetrics
+from drastic.scanner import list_dir, read_filelist, walk_levels
+from drastic.throttle import Throttle
+from drastic.util import default_cdmi_id, default_uuid, split, with_retries
+from drastic.watcher import DEBOUNCE, Debouncer, Watcher, WatchError
 import log
 
 logger = log.init_log('ingest')
 SKIP = (".pyc",)
+# Maximum number of names in the IN clause of a lookup
+LOOKUP_CHUNK = 100
+# Seconds between two progress reports
+PROGRESS_INTERVAL = 10
+# Attempts of a single write (a blob part, a resource row, ...)
+WRITE_ATTEMPTS = 5
+# Attempts of a whole entry, the writes which succeeded aren't done again
+ENTRY_ATTEMPTS = 3
+# Files up to this size (in bytes) are stored in the row of their resource
+INLINE_THRESHOLD = 4096
 
 
 def decode_str(s):
@@ -42,8 +66,9 @@ def decode_str(s):
             return s_ignore
 
 
-# noinspection PyUnusedLocal
-def do_ingest(cfg, args):
+def check_arguments(args):
+    """Check that the user, the group and the folder of an ingest exist,
+    return them"""
     if not args.user or not args.group or not args.folder:
         msg = "Group, User and Folder are all required for ingesting data"
         logger.error(msg)
@@ -71,17 +96,163 @@ def do_ingest(cfg, args):
         msg = u"Could not find path {}".format(path)
         logger.error(msg)
         print msg
+    return user, group, path
 
+
+# noinspection PyUnusedLocal
+def do_ingest(cfg, args):
+    user, group, path = check_arguments(args)
     local_ip = args.local_ip
     skip_import = args.no_import
+    threads = args.workers or 8
+    # Objects events are published one by one with "each"
+    events_mode = None if args.events == 'each' else args.events
+    throttle = Throttle(args.max_bytes_rate, args.max_rows_rate,
+                        args.latency_target, args.control)
+    throttle.reload()
+    # The checksums of the resources aren't computed with "none"
+    checksum = None if args.checksum == 'none' else args.checksum
+    inline_threshold = inline_setting(cfg, args)
+
+    if args.watch and args.processes and args.processes > 1:
+        msg = "--watch can't be used with --processes"
+        logger.error(msg)
+        print msg
+        sys.exit(1)
+
+    if args.processes and args.processes > 1:
+        ingester = ShardedIngester(cfg, user, group, path, local_ip, skip_import,
+                                   processes=args.processes, threads=threads,
+                                   manifest=args.manifest, events_mode=events_mode,
+                                   report=args.report, filelist=args.filelist,
+                                   dead_letter=args.dead_letter, throttle=throttle,
+                                   checksum=checksum, hash_threads=args.hash_workers or 4,
+                                   inline_threshold=inline_threshold)
+    else:
+        ingester = Ingester(user, group, path, local_ip, skip_import, threads=threads,
+                            manifest=args.manifest, events_mode=events_mode,
+                            report=args.report, filelist=args.filelist,
+                            dead_letter=args.dead_letter, throttle=throttle,
+                            checksum=checksum, hash_threads=args.hash_workers or 4,
+                            watch=args.watch, debounce=args.debounce or DEBOUNCE,
+                            inline_threshold=inline_threshold)
+    # Read the control file again on SIGHUP
+    signal.signal(signal.SIGHUP, lambda signo, frame: ingester.reload_limits())
+    try:
+        ingester.start()
+    except WatchError as e:
+        msg = u"Unable to watch {}: {}".format(path, e)
+        logger.error(msg)
+        print msg
+        sys.exit(1)
+
+
+def inline_setting(cfg, args):
+    """Return the size up to which the files are stored inline, from the
+    arguments or the INLINE_THRESHOLD setting"""
+    if args.inline_threshold is not None:
+        return args.inline_threshold
+    return cfg.get("INLINE_THRESHOLD", INLINE_THRESHOLD)
 
-    ingester = Ingester(user, group, path, local_ip, skip_import)
-    ingester.start()
+
+# noinspection PyUnusedLocal
+def do_replay(cfg, args):
+    """Ingest again the entries of a dead-letter file"""
+    if len(args.command) < 2:
+        msg = "The dead-letter file is required for replaying failed entries"
+        logger.error(msg)
+        print msg
+        sys.exit(1)
+    path = args.command[1]
+    if not os.path.exists(path):
+        msg = u"Could not find the dead-letter file {}".format(path)
+        logger.error(msg)
+        print msg
+        sys.exit(1)
+    checksum = None if args.checksum == 'none' else args.checksum
+    replay_dead_letters(path, args.workers or 8, checksum, args.hash_workers or 4,
+                        inline_setting(cfg, args))
+
+
+def replay_dead_letters(path, threads=8, checksum='sha256', hash_threads=4,
+                        inline_threshold=INLINE_THRESHOLD):
+    """Ingest again the entries of a dead-letter file, the entries which
+    fail again are written back to the file. Return the number of entries
+    replayed"""
+    replaying = path + '.replaying'
+    os.rename(path, replaying)
+    dead_letters = DeadLetters(path)
+    metrics = IngestMetrics()
+
+    def progress(rdict, context, resource):
+        if resource is None:
+            metrics.file_failed()
+        else:
+            metrics.file_done(rdict.get('size'))
+
+    count = 0
+    hashes = HashPool(checksum, hash_threads) if checksum else None
+    queue, workers = initialize_threading(threads, progress, metrics, dead_letters,
+                                          hashes=hashes, inline_threshold=inline_threshold)
+    for rdict, context, do_load in DeadLetters.read(replaying):
+        try:
+            context['stat'] = os.stat(context['fullpath'])
+        except OSError as e:
+            logger.error(u"Skipping {}: {}".format(context['fullpath'], e))
+            continue
+        rdict['size'] = context['stat'].st_size
+        queue.put((rdict, context, do_load))
+        count += 1
+    terminate_threading(queue, workers)
+    if hashes:
+        hashes.close()
+    os.remove(replaying)
+    metrics.print_progress()
+    return count
+
+
+class DeadLetters(object):
+    """File of the entries which couldn't be ingested, one JSON document
+    per line, so that they can be replayed later"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def add(self, rdict, context, do_load, error):
+        context = dict((k, v) for k, v in context.iteritems() if k != 'stat')
+        context['written_parts'] = sorted(context.get('written_parts', ()))
+        line = json.dumps({'resource': rdict,
+                           'context': context,
+                           'load': do_load,
+                           'error': unicode(error),
+                           'time': datetime.utcnow().isoformat()}) + '\n'
+        with self.lock:
+            # Appended in a single write, the worker processes share the file
+            with open(self.path, 'a') as f:
+                f.write(line)
+
+    @staticmethod
+    def read(path):
+        """Yield the (resource dictionary, context, do_load) of the entries
+        of a file"""
+        with open(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                context = entry['context']
+                context['written_parts'] = set(context.get('written_parts', ()))
+                yield entry['resource'], context, entry['load']
 
 
 class Ingester(object):
 
-    def __init__(self, user, group, folder, local_ip='127.0.0.1', skip_import=False):
+    def __init__(self, user, group, folder, local_ip='127.0.0.1', skip_import=False,
+                 threads=8, manifest=None, events_mode='summary', report=None,
+                 filelist=None, dead_letter=None, throttle=None, checksum='sha256',
+                 hash_threads=4, watch=False, debounce=DEBOUNCE,
+                 inline_threshold=INLINE_THRESHOLD):
         self.groups = [group.id]
         self.user = user
         self.folder = folder
@@ -91,41 +262,43 @@ class Ingester(object):
             self.local_ip = local_ip
         else:
             self.local_ip = '127.0.0.1'
+        self.threads = threads
         self.queue = None
+        # Path of the manifest of a previous ingest of the folder
+        self.manifest_path = manifest
+        self.manifest = None
+        # How the events of the created objects are published, see
+        # events.bulk
+        self.events_mode = events_mode
+        # Path of the JSON report written at the end
+        self.report_path = report
+        self.metrics = IngestMetrics()
+        # File (or "-" for stdin) with the list of the files to ingest,
+        # instead of walking the folder
+        self.filelist = filelist
+        # File where the entries which failed are written
+        self.dead_letter_path = dead_letter
+        self.dead_letters = DeadLetters(dead_letter) if dead_letter else None
+        # Limits the rate of the writes
+        self.throttle = throttle
+        # Algorithm of the checksums of the resources, None for no
+        # checksum, and the number of threads hashing the files
+        self.checksum = checksum
+        self.hash_threads = hash_threads
+        # Keep ingesting the changes of the folder after the first ingest,
+        # once they have settled for `debounce` seconds
+        self.watch = watch
+        self.debounce = debounce
+        # Files up to this size are stored in their resource, 0 to store
+        # them all in blobs
+        self.inline_threshold = inline_threshold
 
-    def create_collection(self, parent_path, name, path):
-        try:
-            d = {'container': parent_path,
-                 'name': name,
-                 'write_access': self.groups,
-                 'delete_access': self.groups,
-                 'edit_access': self.groups,
-                 }
-            c = Collection.create(**d)
-        except CollectionConflictError:
-            # Collection already exists
-            c = Collection.find_by_path(path)
-        self.collection_cache[path] = c
-        return c
-
-    def get_collection(self, path):
-        c = self.collection_cache.get(path, None)
-        if c:
-            return c
-
-        c = Collection.find_by_path(path)
-        if c:
-            self.collection_cache[path] = c
-            return c
-
-        return None
-
-    def resource_for_file(self, path):
+    def resource_for_file(self, path, size=None):
         t, _ = guess_type(path)
         _, name = split(path)
         _, ext = os.path.splitext(path)
         return {"mimetype": t,
-                "size": os.path.getsize(path),
+                "size": os.path.getsize(path) if size is None else size,
                 # "read_access" : self.groups,
                 "write_access": self.groups,
                 "delete_access": self.groups,
@@ -136,188 +309,842 @@ class Ingester(object):
                 }
 
     def start(self):
-        """Walks the folder creating collections when it finds a folder,
-        and resources when it finds a file. This is done sequentially
-        so multiple copies of this program can be run in parallel (each
-        with a different root folder).
+        """Walks the folder creating collections for its folders and
+        resources for its files. The collection tree is planned first and
+        created level by level, the files are ingested by a pool of
+        threads. Multiple copies of this program can be run in parallel
+        (each with a different root folder).
+
+        With watch, the changes of the folder are then ingested as they
+        happen, until the ingest is interrupted.
         """
-        self.queue = initialize_threading()
-        self.do_work()
-        terminate_threading(self.queue)
+        self.open_manifest()
+        # The folder is watched before it's walked, so that nothing
+        # created during the walk is missed
+        watcher = Watcher(self.folder, self.threads) if self.watch else None
+        hashes = HashPool(self.checksum, self.hash_threads) if self.checksum else None
+        with events.bulk(self.events_mode):
+            self.queue, workers = initialize_threading(self.threads, self.entry_done,
+                                                       self.metrics, self.dead_letters,
+                                                       self.throttle, hashes,
+                                                       self.inline_threshold)
+            self.metrics.queue_depth = self.queue.qsize
+            self.metrics.start_reporter(PROGRESS_INTERVAL)
+            try:
+                self.do_work()
+            finally:
+                # When watching, the threads go on with the changes
+                terminate_threading(self.queue, () if watcher else workers)
+            self.metrics.stop_reporter()
+        if watcher:
+            # The events of the changes are published as they happen
+            try:
+                self.follow(watcher)
+            except KeyboardInterrupt:
+                pass
+            finally:
+                terminate_threading(self.queue, workers)
+                watcher.close()
+        if hashes:
+            hashes.close()
+        self.close_manifest()
+        self.write_report()
+
+    def follow(self, watcher):
+        """Ingest the changes reported by the watcher, with the pool of
+        threads of the first ingest"""
+        msg = u"Watching {} directories for changes".format(len(watcher.wds))
+        logger.info(msg)
+        print msg
+        debouncer = Debouncer(self.debounce)
+        while True:
+            for path, mask, _ in watcher.read(self.debounce / 2):
+                debouncer.add(path, mask)
+            if debouncer.overflow:
+                logger.warning(u"Missed some changes, walking {} again".format(
+                    decode_str(self.folder)))
+                debouncer = Debouncer(self.debounce)
+                self.do_work()
+                continue
+            files, dirs, deleted = debouncer.ready()
+            if deleted:
+                self.delete_paths(deleted)
+            # The content of a new directory comes with it, its changes
+            # from now on come from its watches
+            for dirpath in list(dirs):
+                dirs.extend(watcher.add_tree(dirpath))
+            for dirpath in dirs:
+                files.extend(os.path.join(dirpath, name) for name, _ in list_dir(dirpath)[1])
+            if files or dirs:
+                self.ingest_changes(files, dirs)
+                self.metrics.print_progress()
+
+    def ingest_changes(self, files, dirs=()):
+        """Ingest files which appeared or changed, and create the
+        collections of new directories"""
+        plan = CollectionPlan(self.folder).from_files(files, dirs)
+        self.ingest_plan(plan, [(self.folder, u'/')])
+
+    def delete_paths(self, paths):
+        """Delete the resources, or collections, of paths which
+        disappeared, and their postings in the search index"""
+        for p in paths:
+            path = decode_str(p[len(self.folder):])
+            resource = Resource.find_by_path(path)
+            if resource:
+                logger.info(u"Deleting resource {}".format(path))
+                self.delete_resource(resource)
+                continue
+            collection = Collection.find_by_path(path)
+            if collection:
+                logger.info(u"Deleting collection {}".format(path))
+                self.delete_collection(collection)
+
+    def delete_resource(self, resource):
+        resource.delete()
+        SearchIndex.reset(resource.id)
+        if self.manifest:
+            self.manifest.forget(self.folder + resource.path())
+
+    def delete_collection(self, collection):
+        """Delete a collection and its content recursively, like
+        Collection.delete_all"""
+        for resource in list(collection.get_child_resources()):
+            self.delete_resource(resource)
+        for child in list(collection.get_child_collections()):
+            self.delete_collection(child)
+        collection.delete()
+        SearchIndex.reset(collection.id)
+        self.collection_cache.pop(collection.path(), None)
+
+    def reload_limits(self):
+        """Read the limits from the control file again"""
+        if self.throttle:
+            self.throttle.reload(force=True)
+
+    def write_report(self):
+        """Log the time spent in each stage and write the JSON report"""
+        self.metrics.summary()
+        if self.throttle:
+            logger.info(u"Throttle: {}".format(self.throttle.metrics()))
+        if self.report_path:
+            self.metrics.write_report(self.report_path)
+            msg = u"Report written in {}".format(self.report_path)
+            logger.info(msg)
+            print msg
+
+    def open_manifest(self):
+        """Open the manifest, if there's one, and start a new run (or
+        resume the last one if it didn't finish)"""
+        if self.manifest_path:
+            self.manifest = IngestManifest(self.manifest_path, self.folder)
+            self.manifest.begin_run()
+
+    def close_manifest(self):
+        """Report the files deleted since the last run and finish the run.
+        The files missing from a list of files aren't deleted, only a
+        walk of the whole folder finds the deleted files"""
+        if not self.manifest:
+            return
+        complete = not self.filelist
+        if complete:
+            deleted = self.manifest.deleted()
+            for path in deleted:
+                logger.info(u"Deleted since the last ingest: {}".format(path))
+            msg = u"{} files deleted since the last ingest".format(len(deleted))
+            logger.info(msg)
+            print msg
+        self.manifest.finish_run(complete)
+        self.manifest.close()
+
+    def entry_done(self, rdict, context, resource):
+        """Called by the worker threads when an entry has been processed,
+        resource is None if it failed"""
+        if resource is None:
+            self.metrics.file_failed()
+            return
+        self.metrics.file_done(rdict.get('size'))
+        if self.manifest:
+            self.manifest.record(context['fullpath'], context['stat'],
+                                 context.get('hash'), resource.id)
 
     def create_entry(self, rdict, context, do_load):
         self.queue.put((rdict.copy(), context.copy(), do_load))
         return
 
     def do_work(self):
-        timer = TimerCounter()
+        """Plan the collection tree, create it level by level in a
+        background thread and queue the files of each directory as soon
+        as its level exists"""
+        self.get_root()
+        with self.metrics.stage('plan'):
+            plan = self.make_plan()
+        self.ingest_plan(plan, [(self.folder, u'/')])
 
+    def get_root(self):
+        """Return the root collection, created if needed"""
         root_collection = Collection.get_root_collection()
         if not root_collection:
             root_collection = Collection.create_root()
         self.collection_cache["/"] = root_collection
+        return root_collection
 
-        for (path, dirs, files) in os.walk(self.folder, topdown=True, followlinks=True):
-            if '/.' in path:
-                continue  # Ignore .paths
+    def make_plan(self):
+        """Return the plan of the collection tree"""
+        plan = CollectionPlan(self.folder)
+        if self.filelist:
+            plan.from_files(read_filelist(self.filelist))
+        else:
+            plan.build(self.threads)
+        return plan
 
-            # Remove prefix
-            path = path[len(self.folder):]
-            # Convert to unicode
-            path = decode_str(path)
-            parent_path, name = split(path)
-            logger.info(u"Processing {} - '{}'".format(parent_path, name))
-            print u"Processing {}".format(path)
-
-            if name:
-                timer.enter('get-collection')
-                # parent = self.get_collection(parent_path)
-
-                current_collection = self.get_collection(path)
-                if not current_collection:
-                    current_collection = self.create_collection(parent_path,  # parent.path(),
-                                                                name,
-                                                                path)
-                timer.exit('get-collection')
-            else:
-                current_collection = root_collection
+    def ingest_plan(self, plan, roots):
+        """Create the collections of a plan and queue the files of its
+        directories, and of the (dirpath, path) roots whose collections
+        are already in the cache"""
+        msg = u"Planned {} collections in {} levels".format(len(plan), len(plan.levels))
+        logger.info(msg)
+        print msg
 
-            # Now we can add the resources from self.folder + path
-            for entry in files:
-                entry = decode_str(entry)
-                fullpath = self.folder + path + '/' + entry
-                if entry.startswith("."):
-                    continue
-                if entry.endswith(SKIP):
-                    continue
-                if not os.path.isfile(fullpath):
+        creator = Thread(target=events.in_bulk(self.create_collections), args=(plan,))
+        creator.setDaemon(True)
+        creator.start()
+
+        # The directories are listed by a pool of threads
+        pool = ThreadPool(self.threads)
+        try:
+            self.queue_directories(plan, roots, pool)
+            for depth, level in enumerate(plan.levels):
+                with self.metrics.stage('wait-level'):
+                    plan.ready[depth].wait()
+                # Skip the collections which couldn't be created, already
+                # logged
+                self.queue_directories(plan,
+                                       [(dirpath, path) for dirpath, _, _, path in level
+                                        if path in self.collection_cache],
+                                       pool)
+        finally:
+            pool.close()
+        creator.join()
+
+    def queue_directories(self, plan, directories, pool):
+        """Queue the files of a list of (dirpath, path), the directories are
+        listed in parallel a chunk at a time"""
+        chunk_size = self.threads * 4
+        for i in range(0, len(directories), chunk_size):
+            chunk = directories[i:i + chunk_size]
+            with self.metrics.stage('list'):
+                listings = pool.map(plan.list_files, [dirpath for dirpath, _ in chunk])
+            for (_, path), files in zip(chunk, listings):
+                self.queue_files(path, self.collection_cache[path], files)
+
+    def queue_files(self, path, collection, files):
+        """Queue the files of a directory, path is the path of the
+        directory relative to the ingested folder and files the (name,
+        stat result) of its regular files"""
+        logger.info(u"Processing {}".format(path))
+        print u"Processing {}".format(path)
+        if path == u'/':
+            path = u''
+        entries = []
+        for entry, st in files:
+            entry = decode_str(entry)
+            fullpath = self.folder + path + '/' + entry
+            if entry.startswith("."):
+                continue
+            if entry.endswith(SKIP):
+                continue
+
+            context = {"fullpath": fullpath,
+                       "container": collection.path(),
+                       "local_ip": self.local_ip,
+                       "path": path,
+                       "entry": entry,
+                       "stat": st
+                       }
+            if self.manifest:
+                unchanged, resource_id = self.manifest.check(fullpath, st)
+                if unchanged:
+                    self.metrics.file_skipped()
                     continue
+                if resource_id:
+                    # Update the resource created by the previous run
+                    context["resource_id"] = resource_id
+            entries.append((entry, st, context))
+
+        # A file ingested before keeps the id of its resource, so that
+        # the postings of that id are reset
+        ids = self.existing_ids(collection.path(),
+                                [e for e, _, c in entries if "resource_id" not in c])
+        for entry, st, context in entries:
+            fullpath = context["fullpath"]
+            if entry in ids:
+                context["resource_id"] = ids[entry]
+            rdict = self.resource_for_file(fullpath, st.st_size)
+            rdict["container"] = collection.path()
+            # The ids are chosen once so that retrying the entry overwrites
+            # what a failed attempt wrote
+            rdict["id"] = context.get("resource_id") or default_cdmi_id()
+            context["blob_id"] = default_uuid()
+            with self.metrics.stage('push'):
+                self.create_entry(rdict, context, not self.skip_import)
+
+    def existing_ids(self, container, names):
+        """Return a dictionary of the ids of the resources of a collection
+        which have one of the names, looked up a chunk of names at a
+        time"""
+        ids = {}
+        for i in range(0, len(names), LOOKUP_CHUNK):
+            chunk = names[i:i + LOOKUP_CHUNK]
+            for r in Resource.objects.filter(container=container, name__in=chunk):
+                ids[r.name] = r.id
+        return ids
+
+    def create_collections(self, plan):
+        """Create the collections of a plan, level by level. The event of
+        a level is set once its collections are in the cache"""
+        pool = ThreadPool(self.threads)
+        try:
+            for depth, level in enumerate(plan.levels):
+                t0 = time.time()
+                self.create_level(level, pool)
+                plan.ready[depth].set()
+                elapsed = time.time() - t0
+                self.metrics.observe('create-level', elapsed)
+                logger.info(u"Level {}: {} collections in {:.2f} seconds".format(
+                    depth + 1, len(level), elapsed))
+        except Exception as e:
+            logger.error(u"Problem creating the collections: {}".format(e))
+        finally:
+            # Don't leave the walk waiting for a level which won't come
+            for event in plan.ready:
+                event.set()
+            pool.close()
+
+    def create_level(self, level, pool):
+        """Create the collections of one level of the plan, concurrently,
+        one group per parent collection"""
+        children = OrderedDict()
+        for _, parent_path, name, path in level:
+            children.setdefault(parent_path, []).append((name, path))
+        for created in pool.imap_unordered(events.in_bulk(self.create_children),
+                                           children.items()):
+            for path, collection in created:
+                self.collection_cache[path] = collection
+
+    def create_children(self, item):
+        """Create the missing collections of a parent with one unlogged
+        batch (they all go to the same partition). Return the list of
+        (path, collection)"""
+        parent_path, children = item
+        if parent_path not in self.collection_cache:
+            for _, path in children:
+                logger.error(u"Skipping {}, its parent collection is missing".format(path))
+            return []
+        names = [name for name, _ in children]
+        existing = {}
+        resources = set()
+        for i in range(0, len(names), LOOKUP_CHUNK):
+            chunk = names[i:i + LOOKUP_CHUNK]
+            for c in Collection.objects.filter(container=parent_path, name__in=chunk):
+                existing[c.name] = c
+            for r in Resource.objects.filter(container=parent_path, name__in=chunk):
+                resources.add(r.name)
+
+        b = BatchQuery(batch_type=BatchType.Unlogged)
+        now = datetime.now()
+        created = []
+        new = []
+        for name, path in children:
+            if name in resources:
+                logger.error(u"Skipping {}, a resource has the same name".format(path))
+                continue
+            c = existing.get(name)
+            if c is None:
+                c = Collection.batch(b).create(container=parent_path,
+                                               name=name,
+                                               write_access=self.groups,
+                                               delete_access=self.groups,
+                                               edit_access=self.groups,
+                                               create_ts=now,
+                                               modified_ts=now)
+                new.append(c)
+            created.append((path, c))
+        b.execute()
+        for c in new:
+            c.mqtt_publish('create')
+            indexer.notify(c, 'create')
+        return created
+
+
+class CollectionPlan(object):
+    """The directories of a folder to ingest, grouped by depth so that
+    each level of collections can be created in one go once its parent
+    level exists"""
+
+    def __init__(self, folder):
+        self.folder = folder
+        # levels[d] lists the (dirpath, parent_path, name, path) of the
+        # directories at depth d + 1, the paths are relative to the folder
+        self.levels = []
+        # ready[d] is set when the collections of levels[d] exist
+        self.ready = []
+        # dirpath -> names of the files to ingest, when the plan comes
+        # from a list of files. None if the directories are listed
+        self.files = None
+
+    def __len__(self):
+        return sum(len(level) for level in self.levels)
+
+    def add(self, dirpath):
+        """Add a directory below the folder to the plan"""
+        path = decode_str(dirpath[len(self.folder):])
+        parent_path, name = split(path)
+        depth = path.count('/')
+        while len(self.levels) < depth:
+            self.levels.append([])
+            self.ready.append(threading.Event())
+        self.levels[depth - 1].append((dirpath, parent_path, name, path))
+
+    def build(self, threads=8, root=None, max_depth=None):
+        """Walk the folder (hidden directories excluded), or only the
+        subtree of the root directory, down to max_depth levels below it.
+        Return the plan"""
+        for level in walk_levels(root or self.folder, threads, max_depth):
+            for dirpath in level:
+                self.add(dirpath)
+        return self
+
+    def from_files(self, paths, directories=()):
+        """Build the plan from a list of files, and of directories which
+        may be empty, absolute or relative to the folder. Return the
+        plan"""
+        self.files = {}
+        dirs = set()
+        for p, is_dir in [(p, False) for p in paths] + [(d, True) for d in directories]:
+            p = os.path.normpath(os.path.join(self.folder, p))
+            relpath = p[len(self.folder):]
+            if not p.startswith(self.folder) or not relpath.startswith('/'):
+                logger.warning(u"Skipping {}, not in {}".format(decode_str(p), decode_str(self.folder)))
+                continue
+            if '/.' in relpath:
+                continue  # Ignore .paths
+            if is_dir:
+                dirpath = p
+            else:
+                dirpath, name = os.path.split(p)
+                self.files.setdefault(dirpath, []).append(name)
+            while dirpath != self.folder and dirpath not in dirs:
+                dirs.add(dirpath)
+                dirpath = os.path.dirname(dirpath)
+        for dirpath in sorted(dirs):
+            self.add(dirpath)
+        return self
+
+    def list_files(self, dirpath):
+        """Return the (name, stat result) of the regular files of a
+        directory to ingest"""
+        if self.files is None:
+            return list_dir(dirpath)[1]
+        files = []
+        for name in sorted(set(self.files.get(dirpath, ()))):
+            try:
+                st = os.stat(os.path.join(dirpath, name))
+            except OSError as e:
+                logger.warning(u"Skipping {}: {}".format(decode_str(name), e))
+                continue
+            if stat.S_ISREG(st.st_mode):
+                files.append((name, st))
+        return files
+
+
+class ShardedIngester(Ingester):
+    """Ingester which shards the files across several worker processes,
+    each with its own Cassandra session and pool of threads.
 
-                rdict = self.resource_for_file(fullpath)
-                rdict["container"] = current_collection.path()
-                timer.enter('push')
-                self.create_entry(rdict,
-                                  {"fullpath": fullpath,
-                                   "container": current_collection.path(),
-                                   "local_ip": self.local_ip,
-                                   "path": path,
-                                   "entry": entry
-                                   },
-                                  not self.skip_import)
-                timer.exit('push')
+    The folder is walked by the main process, which also creates the
+    collections so that each of them is created exactly once, before the
+    files it contains are sent to the workers. A file always goes to the
+    same worker.
+    """
 
-        timer.summary()
+    # Seconds between two progress reports
+    progress_interval = 10
+
+    def __init__(self, cfg, user, group, folder, local_ip='127.0.0.1', skip_import=False,
+                 processes=4, threads=8, manifest=None, events_mode='summary',
+                 report=None, filelist=None, dead_letter=None, throttle=None,
+                 checksum='sha256', hash_threads=4, inline_threshold=INLINE_THRESHOLD):
+        super(ShardedIngester, self).__init__(user, group, folder, local_ip, skip_import,
+                                              threads, manifest, events_mode, report,
+                                              filelist, dead_letter, throttle, checksum,
+                                              hash_threads, inline_threshold=inline_threshold)
+        self.cfg = cfg
+        self.processes = processes
+        self.shards = []
+        self.files_done = multiprocessing.Value('L', 0)
+        self.bytes_done = multiprocessing.Value('L', 0)
+        self.workers = []
+
+    def start(self):
+        """Start the worker processes, walk the folder feeding them and
+        wait for them to finish"""
+        self.open_manifest()
+        # The workers send the files they ingested, the manifest is only
+        # written by this process
+        records = multiprocessing.Queue() if self.manifest else None
+        recorder = None
+        if records is not None:
+            recorder = Thread(target=self.record_files, args=(records,))
+            recorder.setDaemon(True)
+            recorder.start()
+        self.shards = [multiprocessing.Queue(maxsize=900) for _ in range(self.processes)]
+        # The workers send the report of their metrics when they finish
+        reports = multiprocessing.Queue()
+        # Each worker gets its share of the limits
+        throttle = self.throttle.settings(1.0 / self.processes) if self.throttle else None
+        self.workers = workers = [multiprocessing.Process(target=shard_worker,
+                                                          args=(self.cfg, shard, self.threads,
+                                                                self.files_done, self.bytes_done,
+                                                                records, self.events_mode, reports,
+                                                                self.dead_letter_path, throttle,
+                                                                self.checksum, self.hash_threads,
+                                                                self.inline_threshold))
+                                  for shard in self.shards]
+        for w in workers:
+            w.daemon = True
+            w.start()
+
+        t0 = time.time()
+        # The workers publish the events of their resources themselves
+        with events.bulk(self.events_mode):
+            self.do_work()
+        for shard in self.shards:
+            shard.put(None)
+
+        received = 0
+        while any(w.is_alive() for w in workers):
+            for w in workers:
+                w.join(self.progress_interval / float(len(workers)))
+            received += self.merge_reports(reports)
+            self.report(t0)
+        while received < len(workers) and not reports.empty():
+            received += self.merge_reports(reports)
+        self.report(t0)
+        if recorder is not None:
+            records.put(None)
+            recorder.join()
+        self.close_manifest()
+        self.write_report()
+
+    def record_files(self, records):
+        """Record the (path, stat, hash, resource id) of the files ingested
+        by the workers in the manifest, until None is received"""
+        while True:
+            record = records.get()
+            if record is None:
+                break
+            self.manifest.record(*record)
+
+    def reload_limits(self):
+        """The workers have their own throttle, pass the signal on"""
+        for w in self.workers:
+            if w.is_alive():
+                os.kill(w.pid, signal.SIGHUP)
+
+    def merge_reports(self, reports):
+        """Merge the metrics sent by the workers which have finished,
+        return their number"""
+        count = 0
+        while not reports.empty():
+            self.metrics.merge(reports.get())
+            count += 1
+        return count
+
+    def create_entry(self, rdict, context, do_load):
+        shard = zlib.crc32(context['fullpath'].encode('utf8')) % len(self.shards)
+        self.shards[shard].put((rdict.copy(), context.copy(), do_load))
+
+    def report(self, t0):
+        """Print the files and bytes ingested by all the workers"""
+        elapsed = time.time() - t0
+        msg = u"Ingested {} files, {} bytes in {:.0f} seconds ({:.1f} files/s)".format(
+            self.files_done.value, self.bytes_done.value, elapsed,
+            self.files_done.value / elapsed if elapsed else 0.0)
+        logger.info(msg)
+        print msg
+
+
+def shard_worker(cfg, shard, threads, files_done, bytes_done,
+                 records=None, events_mode='summary',
+                 reports=None, dead_letter=None, throttle=None, checksum='sha256',
+                 hash_threads=4, inline_threshold=INLINE_THRESHOLD):
+    """Worker process of the ShardedIngester: feed the entries received
+    from the main process to a pool of threads. The files ingested are
+    sent to the records queue, for the manifest"""
+    # A session can't be shared with the parent process, open our own
+    initialise(cfg.get("KEYSPACE", "drastic"),
+               hosts=cfg.get("CASSANDRA_HOSTS", ["127.0.0.1", ]))
+    metrics = IngestMetrics()
+    if throttle is not None:
+        throttle = Throttle(**throttle)
+        throttle.reload()
+        signal.signal(signal.SIGHUP, lambda signo, frame: throttle.reload(force=True))
+
+    def progress(rdict, context, resource):
+        if resource is None:
+            metrics.file_failed()
+            return
+        metrics.file_done(rdict.get('size'))
+        if records is not None:
+            records.put((context['fullpath'], context['stat'],
+                         context.get('hash'), resource.id))
+        with files_done.get_lock():
+            files_done.value += 1
+        with bytes_done.get_lock():
+            bytes_done.value += rdict.get('size') or 0
+
+    hashes = HashPool(checksum, hash_threads) if checksum else None
+    with events.bulk(events_mode):
+        queue, workers = initialize_threading(threads, progress, metrics,
+                                              DeadLetters(dead_letter) if dead_letter else None,
+                                              throttle, hashes, inline_threshold)
+        while True:
+            entry = shard.get()
+            if entry is None:
+                break
+            queue.put(entry)
+        terminate_threading(queue, workers)
+    if hashes:
+        hashes.close()
+    if reports is not None:
+        reports.put(metrics.report())
 
 
 ###############
 # Heavy Lifting
 ###############
-def initialize_threading(ctr=8):
+def initialize_threading(ctr=8, progress=None, metrics=None, dead_letters=None, throttle=None,
+                         hashes=None, inline_threshold=INLINE_THRESHOLD):
+    """Start ctr worker threads, return the queue of the entries and the
+    list of the threads"""
     create_queue = Queue(maxsize=900)   # Create a queue on which to put the create requests
+    if metrics is None:
+        metrics = IngestMetrics()
+    threads = []
     for k in range(abs(ctr)):
-        t = ThreadClass(create_queue)    # Create a number of threads
+        t = ThreadClass(create_queue, progress, metrics, dead_letters, throttle, hashes,
+                        inline_threshold)       # Create a number of threads
         t.setDaemon(True)               # Stops us finishing until all the threads gae exited
         t.start()                       # let it rip
-    return create_queue
+        threads.append(t)
+    return create_queue, threads
 
 
-def terminate_threading(queue):
+def terminate_threading(queue, threads=()):
+    """Wait until the queued entries have been processed, then stop the
+    given worker threads"""
     from time import time
     t0 = time()
     queue.join()
     print('{} seconds to wrap up outstanding'.format(time() - t0))
+    # One None for each thread, which stops when it gets it
+    for _ in threads:
+        queue.put(None)
+    for t in threads:
+        t.join()
 
 
 class ThreadClass(Thread):
 
-    def __init__(self, q):
+    def __init__(self, q, progress=None, metrics=None, dead_letters=None, throttle=None,
+                 hashes=None, inline_threshold=INLINE_THRESHOLD):
         Thread.__init__(self)
         self.queue = q
+        # Called with the resource dictionary, the context and the
+        # resource (None if it failed) when an entry is done
+        self.progress = progress
+        self.metrics = metrics or IngestMetrics()
+        # Where the entries which failed are written, if anywhere
+        self.dead_letters = dead_letters
+        self.throttle = throttle
+        # Computes the checksums, if they are wanted
+        self.hashes = hashes
+        self.inline_threshold = inline_threshold
+        # The events of the thread go to the bulk operation it's started in
+        self.bulk = events.current_bulk()
+
+    def retry(self, write, rows=1):
+        """Do a single write of a number of rows, retried with an
+        exponential backoff"""
+        def on_retry(attempt, e):
+            self.metrics.retry()
+            logger.warning(u"Write failed, attempt {}: {}".format(attempt, e))
+        return with_retries(lambda: self.throttled(write, rows), WRITE_ATTEMPTS,
+                            on_retry=on_retry)
+
+    def throttled(self, write, rows=1):
+        """Do a write of a number of rows within the limits, its latency
+        adapts them"""
+        if not self.throttle:
+            return write()
+        self.throttle.wait_rows(rows)
+        t0 = time.time()
+        try:
+            result = write()
+        except Exception:
+            self.throttle.observe(time.time() - t0, failed=True)
+            raise
+        self.throttle.observe(time.time() - t0)
+        return result
+
+    def wait_bytes(self, n):
+        """Wait before writing n bytes, the upload of a blob waits before
+        each of its parts"""
+        if not self.throttle:
+            return
+        with self.metrics.stage('throttle'):
+            self.throttle.wait_bytes(n)
 
     def run(self):
+        events.join_bulk(self.bulk)
         while True:
             args = self.queue.get()
-            self.process_create_entry(*args)
+            if args is None:
+                self.queue.task_done()
+                return
+            resource = self.process_create_entry(*args)
+            if self.progress:
+                self.progress(args[0], args[1], resource)
             self.queue.task_done()
 
+    def read_inline(self, path, size):
+        """Return the content of a file small enough to be stored in its
+        resource, None if it's bigger"""
+        if not self.inline_threshold or size > self.inline_threshold:
+            return None
+        with open(path, 'rb') as f:
+            # The file may have grown since it was listed
+            data = f.read(self.inline_threshold + 1)
+        return data if len(data) <= self.inline_threshold else None
+
     def process_create_entry_work(self, rdict, context, do_load):
         b = BatchQuery()
+        digests = None
+        content = None
+        # The resource already exists, it has postings to delete
+        existing = bool(context.get('resource_id'))
         # MOSTLY the resource will not exist. So start by calculating the URL and trying to insert the entire record.
         if not do_load:
             url = u"file://{}{}/{}".format(decode_str(context['local_ip']),
                                            decode_str(context['path']),
                                            decode_str(context['entry']))
+            if self.hashes:
+                # The file stays on this host, it's hashed by the pool
+                with self.metrics.stage('checksum'):
+                    digests = self.hashes.file(context['fullpath']).get()
+                context['hash'] = digests[BLOB_ALGORITHM]
         else:
-            with open(context['fullpath'], 'r') as f:
-                blob = Blob.create_from_file(f, rdict['size'])
+            with self.metrics.stage('inline-read'):
+                content = self.read_inline(context['fullpath'], rdict['size'])
+            if content is not None:
+                self.wait_bytes(len(content))
+        if content is not None:
+            # A small file goes in the resource row, no blob
+            url = u"inline://{}".format(rdict['id'])
+            digests = data_digests(content, self.hashes.algorithms if self.hashes
+                                   else [BLOB_ALGORITHM])
+            context['hash'] = digests[BLOB_ALGORITHM]
+        elif do_load:
+            # The parts written by a previous attempt are kept
+            written = context.setdefault('written_parts', set())
+            # The chunks are hashed by the pool while they are uploaded
+            digest = self.hashes.stream() if self.hashes else None
+            with open(context['fullpath'], 'r') as f, self.metrics.stage('blob-upload'):
+                blob = Blob.create_from_file(f, rdict['size'], context['blob_id'],
+                                             self.retry, written, digest, self.hashes,
+                                             self.wait_bytes)
                 if blob:
                     url = "cassandra://{}".format(blob.id)
+                    context['hash'] = blob.hash
                 else:
                     return None
+            if digest:
+                digests = digest.hexdigests()
+        if digests and self.hashes:
+            rdict['checksum'] = digests[self.hashes.algorithm]
 
         try:
             # OK -- try to insert ( create ) the record...
             t1 = time.time()
-            resource = Resource.batch(b).create(url=url, **rdict)
-            msg = u'Resource {} created --> {}'.format(resource.name,
-                                                       time.time() - t1)
+            resource = Resource.batch(b).create(url=url, content=content, **rdict)
+            elapsed = time.time() - t1
+            self.metrics.observe('resource-insert', elapsed)
+            msg = u'Resource {} created --> {}'.format(resource.name, elapsed)
             logger.info(msg)
         except ResourceConflictError:
             # If the create fails, the record already exists... so retrieve it...
             t1 = time.time()
-            resource = Resource.objects().get(container=context['collection'], name=rdict['name'])
-            msg = u"{} ::: Fetch Object -> {}".format(resource.name, time.time() - t1)
+            resource = Resource.objects().get(container=rdict['container'], name=rdict['name'])
+            existing = True
+            elapsed = time.time() - t1
+            self.metrics.observe('resource-fetch', elapsed)
+            msg = u"{} ::: Fetch Object -> {}".format(resource.name, elapsed)
             logger.info(msg)
+            if content is not None:
+                url = u"inline://{}".format(resource.id)
 
         # if the url is not correct then update
         # TODO: If the URL is a block set that's stored internally, reduce its count so that it can be garbage collected
-        # t3 = None
-        if resource.url != url:
-            t2 = time.time()
+        changes = {}
+        if resource.url != url or resource.content != content:
             # if url.startswith('cassandra://') : tidy up the stored block count...
-            resource.batch(b).update(url=url)
+            changes.update(url=url, content=content)
+        if rdict.get('checksum') and resource.checksum != rdict['checksum']:
+            changes['checksum'] = rdict['checksum']
+        if changes:
+            t2 = time.time()
+            changes['modified_ts'] = datetime.now()
+            # One write in the batch, not Resource.update which would publish
+            # an event and queue a reindex: both are done below
+            Resource.objects.filter(container=resource.container,
+                                    name=resource.name).batch(b).update(**changes)
+            for name, value in changes.iteritems():
+                setattr(resource, name, value)
             t3 = time.time()
             msg = u"{} ::: update -> {}".format(resource.name, t3 - t2)
             logger.info(msg)
 
-        # t1 = time.time()
-        SearchIndex.reset(resource.id)
-        SearchIndex.index(resource, ['name', 'metadata'])
+        # The rows limit counts each posting, not each call
+        rows = SearchIndex.posting_rows(SearchIndex.postings(resource, FIELDS))
+        with self.metrics.stage('index-reset'):
+            # The previous postings of the resource are about as many
+            self.retry(lambda: SearchIndex.reset(resource.id), rows if existing else 1)
+        with self.metrics.stage('index-insert'):
+            self.retry(lambda: SearchIndex.index(resource, FIELDS), rows)
 
-        # msg = "Index Management -> {}".format(time.time() - t1)
-        # logger.info(msg)
-        b.execute()
+        with self.metrics.stage('batch-execute'):
+            self.retry(b.execute, len(b.queries))
+        # The resource was created in the batch, publish its event here
+        with self.metrics.stage('publish'):
+            resource.mqtt_publish('update' if context.get('resource_id') else 'create')
+        return resource
 
     def process_create_entry(self, rdict, context, do_load):
-        retries = 4
-        while retries > 0:
-            try:
-                return self.process_create_entry_work(rdict, context, do_load)
-            except Exception as e:
-                logger.error(u"Problem creating entry: {}/{}, retry number: {} - {}".format(rdict['name'],
-                                                                                            rdict['container'],
-                                                                                            retries,
-                                                                                            e))
-                retries -= 1
-        raise
-
-
-class TimerCounter(dict):
-    # Store triples of current start time, count and total time
-    trigger = 1
-
-    # noinspection PyTypeChecker
-    def enter(self, tag):
-        rcd = self.get(tag, [0, 0, 0.0])
-        rcd[0] = time.time()
-        rcd[1] += 1
-        self[tag] = rcd
-
-    # noinspection PyTypeChecker
-    def exit(self, tag):
-        rcd = self.get(tag, [time.time(), 1, 0.0])
-        rcd[2] += (time.time() - rcd[0])
-
-    def summary(self):
-        for t, v in self.items():
-            logger.info('{0:15s}:total:{3}, count:{2}'.format(t, *v))
+        """Process an entry, return the resource or None if it failed. An
+        entry which failed is written to the dead-letter file"""
+        def on_retry(attempt, e):
+            self.metrics.retry()
+            logger.error(u"Problem creating entry: {}/{}, attempt {} - {}".format(rdict['container'],
+                                                                                 rdict['name'],
+                                                                                 attempt, e))
+        try:
+            return with_retries(lambda: self.process_create_entry_work(rdict, context, do_load),
+                                ENTRY_ATTEMPTS, base_delay=1.0, on_retry=on_retry)
+        except Exception as e:
+            logger.error(u"Giving up on entry: {}/{} - {}".format(rdict['container'],
+                                                                  rdict['name'], e))
+            if self.dead_letters:
+                self.dead_letters.add(rdict, context, do_load, e)
+        # The worker thread carries on with the next entry
+        return None
@@ -1,14 +1,21 @@
 """Listener
 Listens for CRUD events to the database and executes user-defined scripts based on those events.
 
+Each script has a pool of long-lived workers which run it for the events
+of its topic.
+
 Usage:
-  listener.py <script_directory> <script_collection> [--quiet | --verbose]
+  listener.py <script_directory> <script_collection> [--quiet | --verbose] [options]
   listener.py -h | --help
 
 Options:
-  -h, --help  Show this message.
-  --verbose   Increase logging output to DEBUG level.
-  --quiet     Decrease logging output to WARNING level.
+  -h, --help           Show this message.
+  --verbose            Increase logging output to DEBUG level.
+  --quiet              Decrease logging output to WARNING level.
+  --backend=<backend>  Run the workers with docker or subprocess [default: docker].
+  --workers=<n>        Number of workers per script [default: 2].
+  --max-events=<n>     Number of events a worker runs before it is replaced [default: 100].
+  --max-memory=<mb>    Memory (in MB) above which a worker is replaced.
 
 """
 __copyright__ = "Copyright (C) 2016 University of Maryland"
@@ -19,7 +26,6 @@ import logging
 import json
 import os
 import StringIO
-import subprocess
 import sys
 import signal
 
@@ -35,9 +41,21 @@ from drastic import get_config
 from drastic import drivers
 import log
 from models import initialise, Collection
+from topics import TopicTrie, reduce_filters
 from util import meta_cassandra_to_cdmi
+from workers import BACKENDS, WorkerPool
 
 scripts = dict()
+# The trigger topics of the scripts -> names of the scripts
+triggers = TopicTrie()
+# The topics the client is subscribed to
+subscribed = set()
+mqtt_client = None
+# Script name -> pool of workers, started with the first event
+pools = dict()
+# Backend and options of the pools
+backend = None
+pool_options = dict()
 MAX_PROC_TIME = 12
 
 
@@ -47,11 +65,52 @@ def on_connect(client, userdata, flags, rc):
 
     # Subscribing in on_connect() means that if we lose the connection and
     # reconnect then subscriptions will be renewed.
-    client.subscribe('#')
-    logger.info('Subscribing to all topics')
+    subscribed.clear()
+    update_subscriptions(client)
     logger.info('Listening on "{0}" for scripts'.format(script_directory_topic))
 
 
+def update_subscriptions(client=None):
+    """Subscribe to the union of the trigger topics of the scripts and of
+    the topic of the script collection, without the topics covered by
+    another one"""
+    client = client or mqtt_client
+    if client is None:
+        return
+    wanted = set(reduce_filters(list(triggers.filters) + [script_directory_topic]))
+    added = sorted(wanted - subscribed)
+    removed = sorted(subscribed - wanted)
+    # Subscribe first so that no message falls in between
+    if added:
+        client.subscribe([(topic, 0) for topic in added])
+        logger.info('Subscribing to {0}'.format(', '.join(added)))
+    if removed:
+        client.unsubscribe(removed)
+        logger.info('Unsubscribing from {0}'.format(', '.join(removed)))
+    subscribed.clear()
+    subscribed.update(wanted)
+
+
+def add_script(script, trigger_topic, path):
+    """Register a script, or its new version"""
+    remove_script(script, update=False)
+    scripts[script] = {'topic': trigger_topic, 'path': path}
+    triggers.add(trigger_topic, script)
+    update_subscriptions()
+
+
+def remove_script(script, update=True):
+    old = scripts.pop(script, None)
+    if old is not None:
+        triggers.remove(old['topic'], script)
+        if update:
+            update_subscriptions()
+    # The workers run the previous version of the script
+    pool = pools.pop(script, None)
+    if pool is not None:
+        gevent.spawn(pool.close)
+
+
 # noinspection PyUnusedLocal
 def on_disconnect(client, userdata, rc):
     if rc != 0:
@@ -83,9 +142,9 @@ def on_message(client, userdata, msg):
         script_path = os.path.dirname(script_full_path)
         script_file_name = os.path.basename(script_full_path)
 
-        if operation is 'delete':
+        if operation == 'delete':
             logger.info('{1} script "{0}" for topic "{2}"'.format(script, operation, trigger_topic))
-            del scripts[script]
+            remove_script(script)
             os.unlink(os.path.join(script_path, script_file_name))
             return
 
@@ -111,32 +170,19 @@ def on_message(client, userdata, msg):
             with open(script_full_path, 'w') as f:
                 f.write(script_contents.getvalue())
 
-            scripts[script] = {'topic': trigger_topic, 'path': script_full_path}
+            add_script(script, trigger_topic, script_full_path)
         else:
             logger.warning('File "{0}" appears not to be a Python script. Ignoring.'.format(script))
     else:
-        useful_topic = False
+        matched = triggers.match(msg.topic)
 
-        for script, sub in scripts.iteritems():
-            if mqtt.topic_matches_sub(sub['topic'], msg.topic):
-                useful_topic = True
-                execute_script(sub['path'], msg.topic, msg.payload)
+        for script in sorted(matched):
+            execute_script(script, msg.topic, msg.payload)
 
-        if not useful_topic:
+        if not matched:
             logger.debug('Topic: {}'.format(msg.topic))
 
 
-def kill_container(pid):
-    logger.debug('Attempting to kill PID: {0}'.format(pid))
-    try:
-        os.kill(pid, signal.SIGKILL)
-        logger.warning('Process {0} was killed after {1} seconds. '
-                       'This might be just because the process is zombified '
-                       'and probably isn\'t anything to worry about'.format(pid, MAX_PROC_TIME))
-    except OSError:
-        logger.debug('Process {0} has already terminated'.format(pid))
-
-
 def mqtt_loop():
     while True:
         mqtt_client.loop()
@@ -144,21 +190,14 @@ def mqtt_loop():
 
 
 def execute_script(script, topic, payload):
+    """Hand an event to a worker of the script, in a greenlet which waits
+    for a free worker"""
     logger.info('execute script "{0}" for topic "{1}"'.format(script, topic))
-    absolute_path = os.path.abspath(script)
-    directory = os.path.dirname(absolute_path)
-    filename = os.path.basename(absolute_path)
-
-    # TODO: Limit the available memory for each instance.
-    # TODO: Open up certain ports.
-    docker_cmd = 'docker run --rm -i -v {0}:/scripts alloy_python'.format(directory)
-    logger.debug('{0} {1} {2} {3}'.format(docker_cmd, filename, topic, payload))
-    params = docker_cmd.split()
-    params.extend((filename, topic, payload))
-    proc = subprocess.Popen(params, shell=False, stdin=subprocess.PIPE, stdout=DEVNULL, stderr=subprocess.STDOUT)
-    gevent.spawn_later(MAX_PROC_TIME, kill_container, proc.pid)
-    proc.stdin.write(payload)
-    proc.stdin.close()
+    pool = pools.get(script)
+    if pool is None:
+        pool = pools[script] = WorkerPool(backend, scripts[script]['path'], timeout=MAX_PROC_TIME,
+                                          stderr=DEVNULL, **pool_options)
+    gevent.spawn(pool.submit, topic, payload)
 
 
 def scan_script_collection(directory):
@@ -175,7 +214,7 @@ def scan_script_collection(directory):
     # TODO: Refactor this and combine it with the on_message() function.
     for resource in collection.get_child_resources():
         url = resource.url
-        driver = drivers.get_driver(url)
+        driver = drivers.get_driver(url, resource)
 
         script_contents = StringIO.StringIO()
 
@@ -199,7 +238,7 @@ def scan_script_collection(directory):
             with open(script_full_path, 'w') as f:
                 f.write(script_contents.getvalue())
 
-            scripts[script] = {'topic': trigger_topic, 'path': script_full_path}
+            add_script(script, trigger_topic, script_full_path)
 
 
 def init_mqtt():
@@ -218,6 +257,10 @@ def shutdown(_signo, _stack_frame):
     logger.info('Stopping MQTT...')
     mqtt_client.disconnect()
 
+    logger.info('Stopping the workers...')
+    for pool in pools.values():
+        pool.close()
+
     logger.info('Dereticulating splines... Done!')
 
     sys.exit(0)
@@ -246,5 +289,14 @@ if __name__ == '__main__':
 
     DEVNULL = open('/dev/null', 'w')
 
+    max_memory = arguments['--max-memory'] and int(arguments['--max-memory'])
+    if arguments['--backend'] == 'docker':
+        backend = BACKENDS['docker'](memory=max_memory and '{0}m'.format(max_memory))
+    else:
+        backend = BACKENDS[arguments['--backend']]()
+    pool_options = {'size': int(arguments['--workers']),
+                    'max_events': int(arguments['--max-events']),
+                    'max_memory': max_memory and max_memory * 1024 * 1024}
+
     mqtt_client = init_mqtt()
     mqtt_loop()
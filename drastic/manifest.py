@@ -0,0 +1,155 @@
+"""Ingest manifest
+
+A local SQLite database which records, for each file ingested from a
+folder, the state of the file (size, mtime, inode), its content hash and
+the id of the resource created for it. The ingester uses it to skip the
+files which haven't changed since the last run and to report the files
+which have been deleted.
+
+Each ingest is a run. The files found by the run are marked with its id
+and the changes are committed regularly, so a run which crashed is
+resumed by the next one: the files it already ingested are skipped. A
+file which changed but couldn't be ingested keeps its previous hash and
+resource id. Only a run which walked the whole folder forgets the files
+it hasn't seen, a run over a list of files leaves them alone.
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+import sqlite3
+import threading
+import time
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    folder TEXT NOT NULL,
+    size INTEGER,
+    mtime REAL,
+    inode INTEGER,
+    hash TEXT,
+    resource_id TEXT,
+    run INTEGER
+);
+CREATE INDEX IF NOT EXISTS files_folder_run ON files (folder, run);
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    folder TEXT NOT NULL,
+    started REAL,
+    finished REAL
+);
+"""
+
+# Commit the changes after this many updates or this many seconds
+CHECKPOINT_COUNT = 1000
+CHECKPOINT_INTERVAL = 5.0
+
+
+class IngestManifest(object):
+    """Manifest of the files ingested from a folder"""
+
+    def __init__(self, path, folder, run=None):
+        self.path = path
+        self.folder = folder
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.conn.executescript(SCHEMA)
+        self.run = run
+        self.pending = 0
+        self.last_checkpoint = time.time()
+
+    def begin_run(self):
+        """Start a new run, or resume the last one if it didn't finish.
+        Return the id of the run"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT id, finished FROM runs WHERE folder = ? ORDER BY id DESC LIMIT 1",
+                (self.folder,)).fetchone()
+            if row and row[1] is None:
+                self.run = row[0]
+            else:
+                cursor = self.conn.execute(
+                    "INSERT INTO runs (folder, started) VALUES (?, ?)",
+                    (self.folder, time.time()))
+                self.run = cursor.lastrowid
+            self.conn.commit()
+        return self.run
+
+    def lookup(self, path):
+        """Return the (size, mtime, inode, hash, resource_id) recorded for
+        a file, None if it isn't in the manifest"""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT size, mtime, inode, hash, resource_id FROM files WHERE path = ?",
+                (path,)).fetchone()
+
+    def check(self, path, st):
+        """Compare a file with its entry in the manifest, `st` is the result
+        of a stat of the file.
+
+        Return (unchanged, resource_id), resource_id is the id of the
+        resource previously created for the file, if any. The file is marked
+        as seen by this run, whether it's ingested again or not, so that it
+        isn't taken for a deleted one if its ingest fails.
+        """
+        entry = self.lookup(path)
+        if entry is None:
+            return False, None
+        size, mtime, inode, _, resource_id = entry
+        self._execute("UPDATE files SET run = ? WHERE path = ?", (self.run, path))
+        return (size == st.st_size and mtime == st.st_mtime and inode == st.st_ino), resource_id
+
+    def record(self, path, st, hash_, resource_id):
+        """Record a file which has been ingested"""
+        self._execute(
+            "INSERT OR REPLACE INTO files (path, folder, size, mtime, inode, hash, resource_id, run) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (path, self.folder, st.st_size, st.st_mtime, st.st_ino, hash_, resource_id, self.run))
+
+    def forget(self, path):
+        """Remove a file which has been deleted"""
+        self._execute("DELETE FROM files WHERE path = ?", (path,))
+
+    def _execute(self, sql, params):
+        with self.lock:
+            self.conn.execute(sql, params)
+            self.pending += 1
+            now = time.time()
+            if (self.pending >= CHECKPOINT_COUNT or
+                    now - self.last_checkpoint >= CHECKPOINT_INTERVAL):
+                self._checkpoint(now)
+
+    def _checkpoint(self, now=None):
+        self.conn.commit()
+        self.pending = 0
+        self.last_checkpoint = now or time.time()
+
+    def checkpoint(self):
+        """Commit the changes"""
+        with self.lock:
+            self._checkpoint()
+
+    def deleted(self):
+        """Return the paths of the files of the folder which haven't been
+        seen by the current run"""
+        with self.lock:
+            return [row[0] for row in self.conn.execute(
+                "SELECT path FROM files WHERE folder = ? AND (run IS NULL OR run != ?)",
+                (self.folder, self.run))]
+
+    def finish_run(self, complete=True):
+        """Mark the run as finished. If it walked the whole folder
+        (complete), the files it hasn't seen are forgotten"""
+        with self.lock:
+            if complete:
+                self.conn.execute("DELETE FROM files WHERE folder = ? AND (run IS NULL OR run != ?)",
+                                  (self.folder, self.run))
+            self.conn.execute("UPDATE runs SET finished = ? WHERE id = ?",
+                              (time.time(), self.run))
+            self._checkpoint()
+
+    def close(self):
+        self.checkpoint()
+        self.conn.close()
@@ -0,0 +1,206 @@
+"""Ingest metrics
+
+Thread-safe counters and latency histograms for the stages of an ingest,
+with a periodic progress line and a final JSON report.
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+import bisect
+from contextlib import contextmanager
+import json
+import threading
+import time
+
+from drastic.log import init_log
+
+logger = init_log('metrics')
+
+# Upper bounds of the buckets of the histograms, in seconds. The last
+# bucket counts everything above
+BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+           1.0, 2.0, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram(object):
+    """Latency histogram with fixed buckets, not thread-safe"""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+
+    def percentile(self, p):
+        """Return the upper bound of the bucket of the p-th percentile, the
+        maximum for the last bucket"""
+        if not self.count:
+            return None
+        rank = p / 100.0 * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                return BUCKETS[i] if i < len(BUCKETS) else self.max
+        return self.max
+
+    def merge(self, other):
+        """Add the observations of a histogram report"""
+        for i, n in enumerate(other['buckets']):
+            self.counts[i] += n
+        self.count += other['count']
+        self.total += other['total']
+        for attr, fn in (('min', min), ('max', max)):
+            value = other[attr]
+            if value is not None:
+                current = getattr(self, attr)
+                setattr(self, attr, value if current is None else fn(current, value))
+
+    def report(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'buckets': list(self.counts),
+        }
+
+
+class IngestMetrics(object):
+    """Metrics of an ingest, shared by the threads"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.t0 = time.time()
+        self.stages = {}
+        self.files = 0
+        self.bytes = 0
+        self.failed = 0
+        self.retries = 0
+        self.skipped = 0
+        # Returns the number of entries waiting to be processed
+        self.queue_depth = None
+        self.reporter = None
+        self.stopped = threading.Event()
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def stage(self, stage):
+        """Time the block as a stage"""
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.time() - t0)
+
+    def file_done(self, size):
+        with self.lock:
+            self.files += 1
+            self.bytes += size or 0
+
+    def file_failed(self):
+        with self.lock:
+            self.failed += 1
+
+    def file_skipped(self):
+        with self.lock:
+            self.skipped += 1
+
+    def retry(self):
+        with self.lock:
+            self.retries += 1
+
+    def merge(self, report):
+        """Add the counters and histograms of the report of another
+        process"""
+        with self.lock:
+            self.files += report['files']
+            self.bytes += report['bytes']
+            self.failed += report['failed']
+            self.retries += report['retries']
+            self.skipped += report['skipped']
+            for stage, histogram in report['stages'].iteritems():
+                self.stages.setdefault(stage, Histogram()).merge(histogram)
+
+    def progress_line(self):
+        with self.lock:
+            elapsed = time.time() - self.t0
+            files, size, failed = self.files, self.bytes, self.failed
+        line = u"Ingested {} files, {} bytes in {:.0f} seconds ({:.1f} files/s, {:.0f} bytes/s), {} failed".format(
+            files, size, elapsed, files / elapsed if elapsed else 0.0,
+            size / elapsed if elapsed else 0.0, failed)
+        if self.queue_depth:
+            line += u", {} queued".format(self.queue_depth())
+        return line
+
+    def report(self):
+        """Return the metrics as a dictionary"""
+        with self.lock:
+            elapsed = time.time() - self.t0
+            return {
+                'elapsed': elapsed,
+                'files': self.files,
+                'bytes': self.bytes,
+                'failed': self.failed,
+                'retries': self.retries,
+                'skipped': self.skipped,
+                'files_per_second': self.files / elapsed if elapsed else 0.0,
+                'bytes_per_second': self.bytes / elapsed if elapsed else 0.0,
+                'stages': dict((stage, histogram.report())
+                               for stage, histogram in self.stages.iteritems()),
+            }
+
+    def write_report(self, path):
+        """Write the report in a JSON file"""
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+
+    def start_reporter(self, interval=10):
+        """Log and print the progress every `interval` seconds, until
+        stop_reporter is called"""
+        def run():
+            while not self.stopped.wait(interval):
+                self.print_progress()
+
+        self.reporter = threading.Thread(target=run)
+        self.reporter.setDaemon(True)
+        self.reporter.start()
+
+    def stop_reporter(self):
+        self.stopped.set()
+        if self.reporter is not None:
+            self.reporter.join()
+        self.print_progress()
+
+    def print_progress(self):
+        line = self.progress_line()
+        logger.info(line)
+        print line
+
+    def summary(self):
+        """Log the time spent in each stage"""
+        with self.lock:
+            stages = sorted(self.stages.iteritems())
+        for stage, histogram in stages:
+            logger.info(u'{0:15s}:total:{1:.3f}, count:{2}, p50:{3}, p99:{4}'.format(
+                stage, histogram.total, histogram.count,
+                histogram.percentile(50), histogram.percentile(99)))
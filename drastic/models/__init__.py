@@ -20,10 +20,18 @@ from drastic.models.group import Group
 from drastic.models.user import User
 from drastic.models.node import Node
 from drastic.models.collection import Collection
-from drastic.models.search import SearchIndex
+from drastic.models.search import (
+    LegacySearchIndex,
+    SearchIndex,
+    SearchTerm,
+    SearchGram,
+    SearchFacet,
+    SearchObjectTerm
+)
 from drastic.models.resource import Resource
 from drastic.models.blob import Blob, BlobPart
 from drastic.models.activity import Activity
+from drastic.models.ingest_job import IngestJob, WorkUnit
 
 from drastic.log import init_log
 
@@ -58,7 +66,11 @@ def initialise(keyspace, hosts=('127.0.0.1',), strategy='SimpleStrategy',
 
 def sync():
     """Create tables for the different models"""
-    tables = (User, Node, Collection, Resource, Group, SearchIndex, Blob, BlobPart, Activity)
+    # The legacy search index is still read by search-migrate, which must
+    # work on any keyspace
+    tables = (User, Node, Collection, Resource, Group, SearchTerm, SearchGram,
+              SearchFacet, SearchObjectTerm, LegacySearchIndex, Blob, BlobPart,
+              Activity, IngestJob, WorkUnit)
 
     for table in tables:
         logger.info('Syncing table "{0}"'.format(table.__name__))
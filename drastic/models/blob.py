@@ -4,11 +4,20 @@ __copyright__ = "Copyright (C) 2016 University of Maryland"
 __license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
 
 
+from collections import deque
+from cStringIO import StringIO
 import hashlib
+import zipfile
 from cassandra.cqlengine import columns
 from cassandra.cqlengine.models import Model
 
-from drastic.util import default_uuid
+from drastic.checksum import part_hash, tree_hash
+from drastic.util import default_uuid, derived_uuid
+
+# Parts read ahead of the one being written, while they are hashed
+HASH_WINDOW = 2
+# Maximum number of ids in the IN clause of a lookup
+LOOKUP_CHUNK = 100
 
 
 class Blob(Model):
@@ -17,26 +26,73 @@ class Blob(Model):
     parts = columns.List(columns.Text, default=[], index=True)
     size = columns.Integer(default=0)
     hash = columns.Text(default="")
+    # Root of the Merkle tree of the hashes of the parts
+    tree_hash = columns.Text(default="")
 
     @classmethod
-    def create_from_file(cls, fileobj, size):
-        """Create an object from an opened file"""
-        blob = cls.create(size=size)
-        hasher = hashlib.sha256()
+    def create_from_file(cls, fileobj, size, blob_id=None, retry=None, written=None,
+                         digest=None, hashes=None, wait_bytes=None):
+        """Create an object from an opened file.
+
+        The ids of the parts are derived from the id of the blob, so
+        creating a blob again with the same id overwrites its parts
+        instead of leaving them behind. `retry` is called with each write
+        (a function without arguments) and returns its result, `written` is
+        a set of the ids of the parts which have already been written by a
+        previous attempt, they aren't written again. The ids of the parts
+        are added to it once written. The blob itself is written last.
+        The chunks are hashed by `digest` (a checksum.StreamDigest) if it's
+        given, instead of the uploading thread, and the parts by the
+        `hashes` pool (a checksum.HashPool), a few parts ahead of the one
+        being written. `wait_bytes` is called with the size of each part
+        before it's written, to limit the rate of the upload."""
+        if blob_id is None:
+            blob_id = default_uuid()
+        if retry is None:
+            retry = lambda write: write()
+        if written is None:
+            written = set()
+        hasher = hashlib.sha256() if digest is None else digest
 
         chunk_size = 1024 * 1024 * 1
         parts = []
-        while True:
-            data = fileobj.read(chunk_size)
-            if not data:
-                break
-            part = BlobPart.create(content=data, blob_id=blob.id)
-            parts.append(part.id)
-
-            hasher.update(data)
-
-        blob.update(parts=parts, hash=hasher.hexdigest())
-        return blob
+        part_hashes = []
+        # (part id, data, hash or AsyncResult of the hash) of the parts
+        # read but not written yet
+        pending = deque()
+
+        def write_parts(keep):
+            while len(pending) > keep:
+                part_id, data, result = pending.popleft()
+                hash_ = result.get() if hashes is not None else result
+                part_hashes.append(hash_)
+                if part_id not in written:
+                    if wait_bytes is not None:
+                        wait_bytes(len(data))
+                    retry(lambda: BlobPart.create(id=part_id, content=data,
+                                                  blob_id=blob_id, hash=hash_))
+                    written.add(part_id)
+
+        try:
+            while True:
+                data = fileobj.read(chunk_size)
+                if not data:
+                    break
+                part_id = derived_uuid(blob_id, len(parts))
+                pending.append((part_id, data,
+                                hashes.part(data) if hashes is not None else part_hash(data)))
+                parts.append(part_id)
+                hasher.update(data)
+                write_parts(HASH_WINDOW)
+            write_parts(0)
+        finally:
+            if digest is not None:
+                # Ends the stream, even if the upload failed
+                digest.hexdigests()
+
+        return retry(lambda: cls.create(id=blob_id, size=size, parts=parts,
+                                        hash=hasher.hexdigest(),
+                                        tree_hash=tree_hash(part_hashes)))
 
     @classmethod
     def find(cls, id_):
@@ -46,6 +102,35 @@ class Blob(Model):
     def __unicode__(self):
         return unicode(self.id)
 
+    def get_parts(self, first=0, last=None):
+        """Return the parts first to last (included), in order"""
+        ids = self.parts[first:None if last is None else last + 1]
+        found = {}
+        for i in range(0, len(ids), LOOKUP_CHUNK):
+            for part in BlobPart.objects.filter(id__in=ids[i:i + LOOKUP_CHUNK]):
+                found[part.id] = part
+        return [found.get(id_) for id_ in ids]
+
+    def verify_parts(self, first=0, last=None):
+        """Check the content of the parts first to last (included) against
+        their hashes, return the indexes of the parts which are missing or
+        don't match"""
+        bad = []
+        for i, part in enumerate(self.get_parts(first, last), first):
+            if part is None or not part.verify():
+                bad.append(i)
+        return bad
+
+    def verify_tree(self):
+        """Check that the hashes of the parts make up the tree hash, None if
+        the blob was created without one"""
+        if not self.tree_hash:
+            return None
+        parts = self.get_parts()
+        if any(part is None or not part.hash for part in parts):
+            return False
+        return tree_hash([part.hash for part in parts]) == self.tree_hash
+
 
 class BlobPart(Model):
     """Blob Part Model"""
@@ -53,6 +138,8 @@ class BlobPart(Model):
     content = columns.Bytes()
     compressed = columns.Boolean(default=False)
     blob_id = columns.Text(index=True)
+    # SHA-256 of the uncompressed content
+    hash = columns.Text(default="")
 
     @classmethod
     def find(cls, id_):
@@ -62,6 +149,24 @@ class BlobPart(Model):
     def __unicode__(self):
         return unicode(self.id)
 
+    def data(self):
+        """Return the uncompressed content"""
+        if not self.compressed:
+            return self.content
+        data = StringIO(self.content)
+        z = zipfile.ZipFile(data, 'r')
+        content = z.read("data")
+        data.close()
+        z.close()
+        return content
+
+    def verify(self):
+        """Check the content against its hash, a part without hash can't
+        be checked and is reported as valid"""
+        if not self.hash:
+            return True
+        return part_hash(self.data()) == self.hash
+
     def length(self):
         """Return length of the activity"""
         return len(self.content)
@@ -8,7 +8,6 @@ from datetime import datetime
 import json
 from cassandra.cqlengine import columns
 from cassandra.cqlengine.models import Model
-import paho.mqtt.publish as publish
 import logging
 
 from drastic.models.resource import Resource
@@ -22,6 +21,7 @@ from drastic.util import (
     split,
     datetime_serializer
 )
+from drastic import events, indexer
 from drastic.acl import serialize_acl_metadata
 from drastic.models.errors import (
     CollectionConflictError,
@@ -89,6 +89,7 @@ class Collection(Model):
 
         res = super(Collection, cls).create(**kwargs)
         res.mqtt_publish('create')
+        indexer.notify(res, 'create')
 
         return res
 
@@ -112,6 +113,9 @@ class Collection(Model):
         payload['create_ts'] = self.create_ts
         payload['modified_ts'] = self.modified_ts
         payload['metadata'] = meta_cassandra_to_cdmi(self.metadata)
+        payload['read_access'] = self.read_access
+        if events.collect(operation, 'collection', payload):
+            return
         topic = u'{2}/collection{0}/{1}'.format(self.container, self.name, operation)
         # Clean up the topic by removing superfluous slashes.
         topic = '/'.join(filter(None, topic.split('/')))
@@ -119,11 +123,12 @@ class Collection(Model):
         # script is set to run on such a collection name. But that's what you get if you use stupid names for things.
         topic = topic.replace('#', '').replace('+', '')
         logging.info(u'Publishing on topic "{0}"'.format(topic))
-        publish.single(topic, json.dumps(payload, default=datetime_serializer))
+        events.publish(topic, json.dumps(payload, default=datetime_serializer))
 
     def delete(self):
-        #self.mqtt_publish('delete')
+        self.mqtt_publish('delete')
         super(Collection, self).delete()
+        indexer.notify(self, 'delete')
 
     @classmethod
     def delete_all(cls, path):
@@ -238,9 +243,16 @@ class Collection(Model):
         if 'metadata' in kwargs:
             kwargs['metadata'] = meta_cdmi_to_cassandra(kwargs['metadata'])
 
+        super(Collection, self).update(**kwargs)
+
+        if 'read_access' in kwargs:
+            from drastic.models.search import SearchIndex
+            SearchIndex.update_acl(self)
+
         self.mqtt_publish('update')
+        indexer.notify(self, 'update')
 
-        return super(Collection, self).update(**kwargs)
+        return self
 
     def user_can(self, user, action):
         """
@@ -0,0 +1,118 @@
+"""Ingest Job Model
+
+A distributed ingest is a job split into work units. The units are leased
+by the workers with lightweight transactions: a worker claims a unit by
+bumping its lease version, on the condition that nobody did it before,
+and renews the lease while it works on it. A unit whose lease expired is
+taken over by another worker.
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+from datetime import datetime, timedelta
+from cassandra.cqlengine import columns
+from cassandra.cqlengine.models import Model
+from cassandra.cqlengine.query import LWTException
+
+from drastic.util import default_uuid
+
+# States of a work unit
+PENDING = "PENDING"
+RUNNING = "RUNNING"
+DONE = "DONE"
+FAILED = "FAILED"
+
+
+class IngestJob(Model):
+    """Ingest Job Model"""
+    id = columns.Text(primary_key=True, default=default_uuid)
+    folder = columns.Text(required=True)
+    # Ids of the user and of the group of the ingest
+    user = columns.Text(required=True)
+    group = columns.Text(required=True)
+    local_ip = columns.Text()
+    skip_import = columns.Boolean(default=False)
+    units = columns.Integer(default=0)
+    create_ts = columns.DateTime()
+
+    @classmethod
+    def find(cls, id_):
+        """Find a job from its id"""
+        return cls.objects.filter(id=id_).first()
+
+    def get_units(self):
+        """Return the work units of the job"""
+        return WorkUnit.objects.filter(job=self.id).limit(None)
+
+
+class WorkUnit(Model):
+    """Work Unit Model
+
+    A unit is either the subtree of a directory ("tree"), the files of a
+    list of directories without their subdirectories ("dirs") or a segment
+    of a list of files ("files"). The paths are relative to the folder of
+    the job, except for the files."""
+    job = columns.Text(partition_key=True)
+    id = columns.Text(primary_key=True)
+    kind = columns.Text(required=True)
+    paths = columns.List(columns.Text)
+    state = columns.Text(default=PENDING)
+    owner = columns.Text()
+    lease_version = columns.Integer(default=0)
+    lease_expires = columns.DateTime()
+    attempts = columns.Integer(default=0)
+    files = columns.BigInt(default=0)
+    bytes = columns.BigInt(default=0)
+    failed = columns.BigInt(default=0)
+    modified_ts = columns.DateTime()
+
+    def claimable(self, now=None):
+        """Check if the unit is waiting for a worker or if the lease of its
+        worker expired"""
+        now = now or datetime.utcnow()
+        if self.state == PENDING:
+            return True
+        return self.state == RUNNING and self.lease_expires is not None and self.lease_expires < now
+
+    def claim(self, owner, ttl):
+        """Try to lease the unit for ttl seconds, return True if it
+        worked"""
+        now = datetime.utcnow()
+        try:
+            self.iff(lease_version=self.lease_version).update(
+                state=RUNNING,
+                owner=owner,
+                lease_version=self.lease_version + 1,
+                lease_expires=now + timedelta(seconds=ttl),
+                attempts=self.attempts + 1,
+                modified_ts=now)
+        except LWTException:
+            return False
+        return True
+
+    def renew(self, owner, ttl):
+        """Extend the lease, return False if it has been lost"""
+        now = datetime.utcnow()
+        try:
+            self.iff(owner=owner, lease_version=self.lease_version).update(
+                lease_expires=now + timedelta(seconds=ttl),
+                modified_ts=now)
+        except LWTException:
+            return False
+        return True
+
+    def finish(self, owner, state, files=0, bytes_=0, failed=0):
+        """Mark the unit as done (or failed), return False if the lease
+        has been lost in the meantime"""
+        try:
+            self.iff(owner=owner, lease_version=self.lease_version).update(
+                state=state,
+                files=files,
+                bytes=bytes_,
+                failed=failed,
+                lease_expires=None,
+                modified_ts=datetime.utcnow())
+        except LWTException:
+            return False
+        return True
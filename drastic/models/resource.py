@@ -9,12 +9,12 @@ import json
 import logging
 from cassandra.cqlengine import columns
 from cassandra.cqlengine.models import Model
-from paho.mqtt import publish
 
 from drastic.models.errors import (
     NoSuchCollectionError,
     ResourceConflictError
 )
+from drastic import events, indexer
 from drastic.acl import serialize_acl_metadata
 from drastic.util import (
     decode_meta,
@@ -38,6 +38,9 @@ class Resource(Model):
     metadata = columns.Map(columns.Text, columns.Text, index=True)
     mimetype = columns.Text(required=False)
     url = columns.Text(required=False)
+    # Content of a small resource stored in its row, its url is
+    # inline://<id>
+    content = columns.Bytes(required=False)
     create_ts = columns.DateTime()
     modified_ts = columns.DateTime()
     file_name = columns.Text(required=False, default="")
@@ -87,6 +90,7 @@ class Resource(Model):
         res = super(Resource, cls).create(**kwargs)
 
         res.mqtt_publish('create')
+        indexer.notify(res, 'create')
 
         return res
 
@@ -99,6 +103,9 @@ class Resource(Model):
         payload['create_ts'] = self.create_ts
         payload['modified_ts'] = self.modified_ts
         payload['metadata'] = meta_cassandra_to_cdmi(self.metadata)
+        payload['read_access'] = self.read_access
+        if events.collect(operation, 'resource', payload):
+            return
         topic = '{2}/resource{0}/{1}'.format(self.container, self.name, operation)
         # Clean up the topic by removing superfluous slashes.
         topic = '/'.join(filter(None, topic.split('/')))
@@ -106,11 +113,12 @@ class Resource(Model):
         # script is set to run on such a resource name. But that's what you get if you use stupid names for things.
         topic = topic.replace('#', '').replace('+', '')
         logging.info('Publishing on topic "{0}"'.format(topic))
-        publish.single(topic, json.dumps(payload, default=datetime_serializer))
+        events.publish(topic, json.dumps(payload, default=datetime_serializer))
 
     def delete(self):
         self.mqtt_publish('delete')
         super(Resource, self).delete()
+        indexer.notify(self, 'delete')
 
     @classmethod
     def find_by_id(cls, id_string):
@@ -189,7 +197,12 @@ class Resource(Model):
 
         super(Resource, self).update(**kwargs)
 
+        if 'read_access' in kwargs:
+            from drastic.models.search import SearchIndex
+            SearchIndex.update_acl(self)
+
         self.mqtt_publish('update')
+        indexer.notify(self, 'update')
 
         return self
 
@@ -5,87 +5,589 @@ only having direct matches and manually checking across each specific
 field.  This isn't ideal.
 
 Until such a time as we have a better solution to searching, this model
-provides a simple index (and very, very simple retrieval algorithm) for
+provides a simple inverted index (and a simple retrieval algorithm) for
 matching words with resources and collections.  It does *not* search the
 data itself.
+
+The index is stored in the SearchTerm table, partitioned by term and
+clustered by object id, so the posting list of a term is a single
+partition read and multi-term queries are answered by merging sorted
+posting lists.
+
+Prefix and substring matches are answered by the SearchGram table which
+maps the trigrams of each indexed term (and the edge grams of its first
+characters) to the objects containing the term. The grams of a query
+give a small set of candidate terms which are then checked in memory.
+
+The SearchObjectTerm table lists the terms indexed for each object, so
+the postings of an object can be deleted without a secondary index.
+
+Metadata values and the type/mimetype columns are also indexed as field
+terms ("creator=smith", "type=pdf") which can be used as filters in a
+query. The SearchFacet table lists the values indexed for each field so
+that facet counts can be computed from the sizes of their posting lists.
+
+Each posting carries a 63 bits Bloom filter of the groups allowed to read
+the object (0 if the object is readable by every authenticated user), so
+most of the objects a user can't read are discarded before they are
+loaded. Loaded objects are still checked with user_can, as a Bloom filter
+can give false positives.
 """
 __copyright__ = "Copyright (C) 2016 University of Maryland"
 __license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
 
 
+from collections import Counter
+import hashlib
+import heapq
+import itertools
+import shlex
+import struct
+from multiprocessing.pool import ThreadPool
+import threading
+
 from cassandra.cqlengine import columns
 from cassandra.cqlengine.models import Model
+from cassandra.cqlengine.query import BatchQuery, BatchType
+
+from drastic.log import init_log
+from drastic.util import decode_meta, default_uuid
+
+logger = init_log('search')
+
+# Maximum number of objects returned by a search
+SEARCH_LIMIT = 100
+# Number of objects loaded concurrently when hydrating search results
+SEARCH_BATCH_SIZE = 32
+# Length of the grams used for prefix and substring matches
+GRAM_SIZE = 3
+# Maximum number of postings read from the partition of the single gram
+# of a very short query, this bounds its cost. The partitions of the grams
+# of longer queries are read in full when needed
+GRAM_SCAN_LIMIT = 10000
+# Number of objects looked up at once in a gram partition
+GRAM_LOOKUP_CHUNK = 100
+# Marks the start of a term in its grams
+START_MARKER = u'^'
+# Separates the field from the value in a field term
+FIELD_SEPARATOR = u'='
+# Columns indexed as field terms, along with the metadata
+FIELD_COLUMNS = ('type', 'mimetype')
+# Fields of the collections and resources which are indexed
+FIELDS = ['name', 'metadata']
+# Size of the Bloom filter of the groups who can read an object, it must fit
+# in a positive Cassandra bigint
+ACL_BITS = 63
+
+_lookup_pool = None
+_lookup_pool_lock = threading.Lock()
+
+
+def get_lookup_pool():
+    """Return the thread pool used to load search results, the pool is
+    shared by all the searches of the process"""
+    global _lookup_pool
+    with _lookup_pool_lock:
+        if _lookup_pool is None:
+            _lookup_pool = ThreadPool(SEARCH_BATCH_SIZE)
+    return _lookup_pool
+
+
+def load_object(candidate):
+    """Load the model object for an (object_id, object_type, count)
+    candidate, return None if it doesn't exist anymore"""
+    from drastic.models.collection import Collection
+    from drastic.models.resource import Resource
+    object_id, object_type, _ = candidate
+    if object_type == 'Collection':
+        return Collection.find_by_id(object_id)
+    elif object_type == 'Resource':
+        return Resource.find_by_id(object_id)
+    return None
+
+
+def ranked(postings):
+    """Yield (object_id, object_type, frequency) postings, most frequent
+    first and ties broken on the id so that the order is stable between
+    two identical queries.
+
+    The postings are kept in a heap, only the candidates which are
+    actually consumed are ordered.
+    """
+    heap = [(-p[2], p[0], p[1]) for p in postings]
+    heapq.heapify(heap)
+    while heap:
+        frequency, object_id, object_type = heapq.heappop(heap)
+        yield (object_id, object_type, -frequency)
+
+
+def hydrate(candidates, user, limit=None, skip=0):
+    """Transform ranked (object_id, object_type, count) candidates in a
+    list of dictionaries for the web ui.
+
+    The candidates are loaded by batches, the objects of a batch are
+    fetched concurrently and filtered against the user's read permission.
+    The first `skip` readable objects are not returned and we stop as soon
+    as we have `limit` readable objects.
+
+    Return the results and the number of candidates consumed to get them,
+    or None if the candidates ran out.
+    """
+    results = []
+    pool = get_lookup_pool()
+    candidates = iter(candidates)
+    consumed = 0
+    while True:
+        size = SEARCH_BATCH_SIZE
+        if limit:
+            # Don't load more objects than the page can still hold
+            size = min(size, skip + limit - len(results))
+        batch = list(itertools.islice(candidates, size))
+        if not batch:
+            return results, None
+        objects = pool.map(load_object, batch)
+        for (_, object_type, count), obj in zip(batch, objects):
+            consumed += 1
+            if obj is None or not obj.user_can(user, "read"):
+                continue
+            if skip:
+                skip -= 1
+                continue
+            result = obj.to_dict(user)
+            result['result_type'] = object_type
+            result['hit_count'] = count
+            results.append(result)
+            if limit and len(results) >= limit:
+                return results, consumed
+
+
+def metadata_values(value):
+    """Return the list of strings stored in a metadata value, the value
+    can be stored as in Cassandra ({'json': val}) or be a CDMI value"""
+    if isinstance(value, basestring):
+        try:
+            value = decode_meta(value)
+        except AttributeError:
+            # Valid JSON but not a {'json': val} dictionary, keep it as is
+            pass
+    if isinstance(value, list):
+        return [unicode(v) for v in value if v]
+    if value:
+        return [unicode(value)]
+    return []
+
+
+def term_grams(term):
+    """Return the set of grams indexed for a term: the trigrams of the term
+    with a start marker and its edge grams shorter than a trigram"""
+    padded = START_MARKER + term
+    grams = set(padded[:i] for i in xrange(2, min(GRAM_SIZE, len(padded)) + 1))
+    grams.update(padded[i:i + GRAM_SIZE]
+                 for i in xrange(len(padded) - GRAM_SIZE + 1))
+    return grams
+
+
+def query_grams(query, match):
+    """Return the grams every term matching a prefix or substring query
+    must have"""
+    if match == "substring" and len(query) >= GRAM_SIZE:
+        text = query
+    else:
+        # A substring shorter than a gram can't be looked up without
+        # scanning every gram, it's matched as a prefix instead
+        text = START_MARKER + query
+    if len(text) <= GRAM_SIZE:
+        return set([text])
+    return set(text[i:i + GRAM_SIZE] for i in xrange(len(text) - GRAM_SIZE + 1))
+
+
+def field_term(field, value):
+    """Return the field term for a value of a field"""
+    return u"{}{}{}".format(field.strip().lower(), FIELD_SEPARATOR,
+                            value.strip().lower())
+
 
-from drastic.util import default_uuid
+def is_field_term(term):
+    """Check if a term is a field term"""
+    return FIELD_SEPARATOR in term
 
 
-class SearchIndex(Model):
-    """SearchIndex Model"""
+def parse_query(query):
+    """Parse a query string
+
+    The query is made of words, of field filters ("creator=smith",
+    'title="annual report"') and optionally of one of the AND and OR
+    operators. Return the list of terms (field filters included) and the
+    operator used between the words ("or" if none is given). Field filters
+    always have to match.
+    """
+    if isinstance(query, unicode):
+        query = query.encode('utf8')
+    try:
+        tokens = shlex.split(query)
+    except ValueError:
+        # Unbalanced quotes
+        tokens = query.split()
+    operator = "or"
+    terms = []
+    for token in tokens:
+        token = token.decode('utf8')
+        if token in ("AND", "OR"):
+            operator = token.lower()
+        elif FIELD_SEPARATOR in token:
+            field, value = token.split(FIELD_SEPARATOR, 1)
+            if field.strip() and value.strip():
+                terms.append(field_term(field, value))
+        else:
+            terms.extend(SearchIndex.clean(token))
+    return terms, operator
+
+
+def group_mask(group_id):
+    """Return the bits set for a group in the Bloom filter of an ACL"""
+    h1, h2 = struct.unpack('!QQ', hashlib.md5(group_id.encode('utf8')).digest())
+    return (1 << (h1 % ACL_BITS)) | (1 << (h2 % ACL_BITS))
+
+
+def acl_mask(read_access):
+    """Return the Bloom filter of the groups allowed to read an object, 0
+    if access is not restricted"""
+    mask = 0
+    for group_id in read_access or []:
+        mask |= group_mask(group_id)
+    return mask
+
+
+def user_masks(user):
+    """Return the list of the group masks of a user, None if the user can
+    read everything"""
+    if user is None or user.administrator:
+        return None
+    return [group_mask(g) for g in user.groups]
+
+
+def acl_allows(mask, masks):
+    """Check if an object with the ACL Bloom filter `mask` may be readable
+    by a user with the group masks `masks`"""
+    if not mask or masks is None:
+        return True
+    return any(m & mask == m for m in masks)
+
+
+def intersect_postings(postings_lists):
+    """Intersect posting lists sorted by object id.
+
+    A posting is an (object_id, object_type, frequency, acl) tuple, the
+    frequencies of an object present in every list are summed.
+    """
+    if not postings_lists:
+        return []
+    # Start with the shortest lists so the intermediate results stay small
+    postings_lists = sorted(postings_lists, key=len)
+    result = postings_lists[0]
+    for postings in postings_lists[1:]:
+        merged = []
+        i = j = 0
+        while i < len(result) and j < len(postings):
+            left, right = result[i], postings[j]
+            if left[0] == right[0]:
+                merged.append((left[0], left[1], left[2] + right[2]) + left[3:])
+                i += 1
+                j += 1
+            elif left[0] < right[0]:
+                i += 1
+            else:
+                j += 1
+        result = merged
+        if not result:
+            break
+    return result
+
+
+def union_postings(postings_lists):
+    """Merge posting lists sorted by object id, the frequencies of an
+    object present in several lists are summed."""
+    result = []
+    for posting in heapq.merge(*postings_lists):
+        if result and result[-1][0] == posting[0]:
+            last = result[-1]
+            result[-1] = (last[0], last[1], last[2] + posting[2]) + last[3:]
+        else:
+            result.append(posting)
+    return result
+
+
+class SearchTerm(Model):
+    """Inverted index
+
+    There's one partition per term, clustered by the id of the objects
+    which contain the term, so a posting list is read with a single
+    partition read and comes back sorted by object id.
+    """
+    term = columns.Text(partition_key=True)
+    object_id = columns.Text(primary_key=True)
+    object_type = columns.Text(required=True)
+    frequency = columns.Integer(default=1)
+    acl = columns.BigInt(default=0)
+
+    @classmethod
+    def postings(cls, term):
+        """Return the posting list of a term as a list of
+        (object_id, object_type, frequency, acl) sorted by object id"""
+        return [(p.object_id, p.object_type, p.frequency, p.acl or 0)
+                for p in cls.objects.filter(term=term).limit(None)]
+
+    def __unicode__(self):
+        return unicode(u"{} {}".format(self.term, self.object_id))
+
+
+class SearchGram(Model):
+    """Gram index
+
+    There's one partition per gram, clustered by object id and by the
+    indexed term which contains the gram, used to answer prefix and
+    substring matches.
+    """
+    gram = columns.Text(partition_key=True)
+    object_id = columns.Text(primary_key=True)
+    term = columns.Text(primary_key=True)
+    object_type = columns.Text(required=True)
+    frequency = columns.Integer(default=1)
+    acl = columns.BigInt(default=0)
+
+    @classmethod
+    def scan(cls, gram, limit=None):
+        """Return the {(object_id, term): (object_type, frequency, acl)}
+        postings of a gram, at most `limit` of them"""
+        return dict(((r.object_id, r.term), (r.object_type, r.frequency, r.acl or 0))
+                    for r in cls.objects.filter(gram=gram).limit(limit))
+
+    @classmethod
+    def lookup(cls, gram, object_ids):
+        """Return the (object_id, term) of the postings of a gram for some
+        objects"""
+        object_ids = sorted(object_ids)
+        found = set()
+        for i in xrange(0, len(object_ids), GRAM_LOOKUP_CHUNK):
+            rows = cls.objects.filter(gram=gram,
+                                      object_id__in=object_ids[i:i + GRAM_LOOKUP_CHUNK])
+            found.update((r.object_id, r.term) for r in rows.limit(None))
+        return found
+
+    @classmethod
+    def candidates(cls, grams):
+        """Return the postings of the (object_id, term) which have all the
+        grams.
+
+        The partitions are read up to GRAM_SCAN_LIMIT postings. The
+        smallest one read in full is the base of the intersection, if
+        there's none the first one is read in full; the other grams are
+        then looked up for the objects of the base, their partitions aren't
+        read in full. A single gram is only read up to the limit, the
+        postings after it are left out."""
+        grams = sorted(grams)
+        scans = [(gram, cls.scan(gram, GRAM_SCAN_LIMIT + 1)) for gram in grams]
+        if len(scans) == 1:
+            gram, found = scans[0]
+            if len(found) > GRAM_SCAN_LIMIT:
+                logger.warning(u'Gram "{}" has more than {} postings, only the first '
+                               u'ones are searched'.format(gram, GRAM_SCAN_LIMIT))
+                found = dict(itertools.islice(sorted(found.iteritems()), GRAM_SCAN_LIMIT))
+            return found
+        complete = [(len(found), gram, found) for gram, found in scans
+                    if len(found) <= GRAM_SCAN_LIMIT]
+        if complete:
+            _, base_gram, candidates = min(complete)
+        else:
+            base_gram = grams[0]
+            candidates = cls.scan(base_gram)
+        for gram, found in sorted(scans, key=lambda scan: len(scan[1])):
+            if not candidates:
+                break
+            if gram == base_gram:
+                continue
+            if len(found) > GRAM_SCAN_LIMIT:
+                found = cls.lookup(gram, set(object_id for object_id, _ in candidates))
+            candidates = dict((k, v) for k, v in candidates.iteritems() if k in found)
+        return candidates
+
+    @classmethod
+    def postings(cls, query, match="prefix"):
+        """Return the posting list of the objects with a term which starts
+        with (prefix) or contains (substring) the query, as a list of
+        (object_id, object_type, frequency, acl) sorted by object id"""
+        candidates = cls.candidates(query_grams(query, match))
+        if not candidates:
+            return []
+
+        # The grams only select candidate terms, check them
+        if match == "substring" and len(query) >= GRAM_SIZE:
+            matches = lambda term: query in term
+        else:
+            matches = lambda term: term.startswith(query)
+        postings = {}
+        for (object_id, term), (object_type, frequency, acl) in candidates.iteritems():
+            if not matches(term):
+                continue
+            total = postings[object_id][2] if object_id in postings else 0
+            postings[object_id] = (object_id, object_type, total + frequency, acl)
+        return sorted(postings.values())
+
+    def __unicode__(self):
+        return unicode(u"{} {} {}".format(self.gram, self.term, self.object_id))
+
+
+class SearchFacet(Model):
+    """Values indexed for a field, one partition per field"""
+    field = columns.Text(partition_key=True)
+    value = columns.Text(primary_key=True)
+
+    def __unicode__(self):
+        return field_term(self.field, self.value)
+
+
+class SearchObjectTerm(Model):
+    """Reverse index, one partition per object with the terms indexed for
+    the object"""
+    object_id = columns.Text(partition_key=True)
+    term = columns.Text(primary_key=True)
+
+    def __unicode__(self):
+        return unicode(u"{} {}".format(self.object_id, self.term))
+
+
+class LegacySearchIndex(Model):
+    """Search index rows created before the SearchTerm table, they are
+    only read to be migrated"""
+    __table_name__ = 'search_index'
     id = columns.Text(primary_key=True, default=default_uuid)
     term = columns.Text(required=True, index=True)
     object_type = columns.Text(required=True)
     object_id = columns.Text(required=True, index=True)
 
+    def __unicode__(self):
+        return unicode(u"{} {}".format(self.term, self.object_type))
+
+
+class SearchIndex(object):
+    """Access to the search index of the resources and collections"""
+
+    @classmethod
+    def find(cls, termstrings, user, limit=SEARCH_LIMIT, offset=0,
+             operator="or", match="exact"):
+        """Search for terms in the archive, return the `limit` best ranked
+        objects the user is allowed to read after the first `offset` ones.
+        See find_page."""
+        results, _ = cls.find_page(termstrings, user, limit, offset=offset,
+                                   operator=operator, match=match)
+        return results
+
     @classmethod
-    def find(cls, termstrings, user):
-        """Search for terms in the archive"""
+    def find_page(cls, termstrings, user, limit=SEARCH_LIMIT, offset=0,
+                  cursor=None, operator="or", match="exact"):
+        """Search for a page of results in the archive
+
+        Each term is a single partition read of its posting list. With the
+        "and" operator only the objects which contain every term are
+        returned, with "or" the objects which contain any of them.
+
+        `match` is "exact", "prefix" (an indexed term starts with the
+        search term) or "substring" (an indexed term contains it).
+
+        Objects are ranked on the frequency of the matching terms, and
+        are only loaded until `limit` objects the user is allowed to read
+        have been found, so the cost of a page depends on its size rather
+        than on the number of matches. The objects whose postings show the
+        user can't read them are not loaded at all.
+
+        Field terms ("creator=smith", see parse_query) are filters, an
+        object must match all of them, whatever the operator.
+
+        The page starts after the first `offset` readable objects, or at
+        `cursor`, the opaque value returned with the previous page which
+        avoids checking the objects of the previous pages again.
+
+        Return the list of results and the cursor of the next page, None
+        if this is the last one.
+        """
+        postings = cls.match(termstrings, operator, match)
+        # Discard the objects the user can't read before loading anything
+        masks = user_masks(user)
+        postings = [p for p in postings if acl_allows(p[3], masks)]
+        start = int(cursor) if cursor else 0
+        candidates = itertools.islice(ranked(postings), start, None)
+        results, consumed = hydrate(candidates, user, limit, skip=offset)
+        if consumed is None:
+            return results, None
+        return results, str(start + consumed)
+
+    @classmethod
+    def search(cls, query, user, limit=SEARCH_LIMIT, offset=0, cursor=None,
+               match="exact"):
+        """Search with a query string (see parse_query), return a page of
+        results like find_page"""
+        terms, operator = parse_query(query)
+        return cls.find_page(terms, user, limit, offset=offset, cursor=cursor,
+                             operator=operator, match=match)
+
+    @classmethod
+    def match(cls, termstrings, operator="or", match="exact"):
+        """Return the posting list of the objects matching the terms"""
         # termstrings should have been lower cased and cleaned
-        from drastic.models.collection import Collection
-        from drastic.models.resource import Resource
-
-        def get_object(obj, user):
-            """Return the object corresponding to the SearchIndex object"""
-            if obj.object_type == 'Collection':
-                result_obj = Collection.find_by_id(obj.object_id)
-                if not result_obj.user_can(user, "read"):
-                    return None
-
-                result_obj = result_obj.to_dict(user)
-                result_obj['result_type'] = 'Collection'
-                return result_obj
-            elif obj.object_type == 'Resource':
-                result_obj = Resource.find_by_id(obj.object_id)
-                # Check the resource's collection for read permission
-                if not result_obj.user_can(user, "read"):
-                    return None
-
-                result_obj = result_obj.to_dict(user)
-                result_obj['result_type'] = 'Resource'
-                return result_obj
-
-            return None
-
-        # terms = [t for t in termstrings if not cls.is_stop_word(t)]
-
-        result_objects = []
-        for t in termstrings:
-            if cls.is_stop_word(t):
-                continue
-            result_objects.extend(cls.objects.filter(term=t).all())
+        terms = set(t for t in termstrings if not cls.is_stop_word(t))
+        filters = [SearchTerm.postings(t) for t in terms if is_field_term(t)]
+        postings_lists = [cls.postings(t, match) for t in terms
+                          if not is_field_term(t)]
+        if not postings_lists:
+            return intersect_postings(filters)
+        if operator.lower() == "and":
+            postings = intersect_postings(postings_lists)
+        else:
+            postings = union_postings(postings_lists)
+        if filters:
+            postings = intersect_postings([postings] + filters)
+        return postings
 
-        results = []
-        for result in result_objects:
-            results.append(get_object(result, user))
-        # results = filter(lambda x: x, results)
-        results = [x for x in results if x]
+    @classmethod
+    def facets(cls, field, termstrings=None, operator="or", match="exact",
+               user=None):
+        """Return the values of a field with the number of objects which
+        have each value, most frequent first.
+
+        The counts are the sizes of the posting lists of the field terms,
+        restricted to the objects matching the terms if some are given,
+        and to the objects the ACL of the postings let the user read if a
+        user is given. Objects are not loaded.
+        """
+        field = field.strip().lower()
+        values = [f.value for f in
+                  SearchFacet.objects.filter(field=field).limit(None)]
+        masks = user_masks(user)
+        if termstrings or masks is not None:
+            matching = None
+            if termstrings:
+                matching = set(p[0] for p in cls.match(termstrings, operator, match))
 
-        # Do some sane ordering here to group together by ID and
-        # order by frequency. Add the hit_count to the object dictionary
-        # and then we can order on that
-        keys = set(r['id'] for r in results)
+            def count(value):
+                postings = SearchTerm.postings(field_term(field, value))
+                return len([p for p in postings
+                            if (matching is None or p[0] in matching) and
+                            acl_allows(p[3], masks)])
+        else:
+            def count(value):
+                return SearchTerm.objects.filter(
+                    term=field_term(field, value)).limit(None).count()
 
-        result_list = []
-        for k in keys:
-            # get each element with this key, count them, store the hit
-            # count and only add one to results
-            matches = [x for x in results if x['id'] == k]
-            match = matches[0]
-            match['hit_count'] = len(matches)
-            result_list.append(match)
+        counts = zip(values, get_lookup_pool().map(count, values))
+        return sorted([(v, c) for v, c in counts if c],
+                      key=lambda vc: (-vc[1], vc[0]))
 
-        return sorted(result_list,
-                      key=lambda res: res.get('hit_count', 0),
-                      reverse=True)
+    @classmethod
+    def postings(cls, term, match="exact"):
+        """Return the posting list of a search term"""
+        if match == "exact":
+            return SearchTerm.postings(term)
+        return SearchGram.postings(term, match)
 
     @classmethod
     def is_stop_word(cls, term):
@@ -97,43 +599,161 @@ class SearchIndex(Model):
 
     @classmethod
     def reset(cls, id):
-        """Delete objects from the SearchIndex"""
-        # Have to delete one at a time without a partition index.
-        for obj in cls.objects.filter(object_id=id).all():
-            obj.delete()
+        """Delete the postings of an object from the SearchIndex
+
+        The terms of the object are read from its SearchObjectTerm
+        partition and all the postings are deleted in a single batch.
+        """
+        terms = [r.term for r in
+                 SearchObjectTerm.objects.filter(object_id=id).limit(None)]
+        if not terms:
+            return
+        b = BatchQuery(batch_type=BatchType.Unlogged)
+        for term in terms:
+            SearchTerm.objects.filter(term=term, object_id=id).batch(b).delete()
+            if is_field_term(term):
+                continue
+            for gram in term_grams(term):
+                SearchGram.objects.filter(gram=gram, object_id=id,
+                                          term=term).batch(b).delete()
+        SearchObjectTerm.objects.filter(object_id=id).batch(b).delete()
+        b.execute()
 
     @classmethod
-    def index(cls, object, fields=['name']):
-        """Index"""
-        result_count = 0
+    def update_acl(cls, object):
+        """Update the ACL of the postings of an object, after its
+        read_access changed"""
+        id = object.id
+        acl = acl_mask(object.read_access)
+        terms = [r.term for r in
+                 SearchObjectTerm.objects.filter(object_id=id).limit(None)]
+        if not terms:
+            return
+        b = BatchQuery(batch_type=BatchType.Unlogged)
+        for term in terms:
+            SearchTerm.objects.filter(term=term, object_id=id).batch(b).update(acl=acl)
+            if is_field_term(term):
+                continue
+            for gram in term_grams(term):
+                SearchGram.objects.filter(gram=gram, object_id=id,
+                                          term=term).batch(b).update(acl=acl)
+        b.execute()
 
-        def clean(t):
-            """Clean a term"""
-            return t.lower().replace('.', ' ').replace('_', ' ').split(' ')
+    @classmethod
+    def clean(cls, t):
+        """Split a string in lower cased words"""
+        return [w for w in t.lower().replace('.', ' ').replace('_', ' ')
+                .replace(FIELD_SEPARATOR, ' ').split(' ') if w]
 
+    @classmethod
+    def terms(cls, object, fields=['name']):
+        """Return the list of the terms to index for the fields of an
+        object, a term appears once for each of its occurrences"""
         terms = []
         for f in fields:
             attr = getattr(object, f)
             if isinstance(attr, dict):
                 for k, v in attr.iteritems():
-                    terms.extend(clean(v.strip()))
+                    for value in metadata_values(v):
+                        terms.extend(cls.clean(value.strip()))
             else:
-                terms.extend(clean(attr))
+                terms.extend(cls.clean(attr))
 
-        object_type = object.__class__.__name__
+        return [t for t in terms
+                if len(t) >= 2 and not cls.is_stop_word(t)]
 
-        for term in terms:
-            if cls.is_stop_word(term):
-                continue
-            if len(term) < 2:
+    @classmethod
+    def field_terms(cls, object, fields=['name']):
+        """Return the field terms of an object: its metadata, if the
+        metadata is indexed, and its type/mimetype columns"""
+        terms = []
+        if 'metadata' in fields:
+            for k, v in object.metadata.iteritems():
+                terms.extend(field_term(k, value) for value in metadata_values(v)
+                             if value.strip())
+        for column in FIELD_COLUMNS:
+            value = getattr(object, column, None)
+            if value:
+                terms.append(field_term(column, value))
+        return terms
+
+    @classmethod
+    def postings(cls, object, fields=['name']):
+        """Return the terms and field terms to index for the fields of an
+        object, with their number of occurrences"""
+        frequencies = Counter(cls.terms(object, fields))
+        frequencies.update(cls.field_terms(object, fields))
+        return frequencies
+
+    @classmethod
+    def posting_rows(cls, frequencies):
+        """Return the number of rows write_postings writes for these
+        terms"""
+        rows = 0
+        for term in frequencies:
+            # The SearchTerm and SearchObjectTerm rows, then the facet of a
+            # field term or the grams of a word
+            rows += 3 if is_field_term(term) else 2 + len(term_grams(term))
+        return rows
+
+    @classmethod
+    def index(cls, object, fields=['name']):
+        """Index the fields of an object, return the number of indexed
+        terms"""
+        frequencies = cls.postings(object, fields)
+        cls.write_postings(object.id, object.__class__.__name__, frequencies,
+                           acl_mask(object.read_access))
+        return sum(frequencies.values())
+
+    @classmethod
+    def write_postings(cls, object_id, object_type, frequencies, acl=0):
+        """Write the term and gram postings of an object, `frequencies`
+        maps each term of the object to its number of occurrences and
+        `acl` is the Bloom filter of its read_access"""
+        b = BatchQuery(batch_type=BatchType.Unlogged)
+        for term, frequency in frequencies.iteritems():
+            SearchTerm.batch(b).create(term=term,
+                                       object_id=object_id,
+                                       object_type=object_type,
+                                       frequency=frequency,
+                                       acl=acl)
+            SearchObjectTerm.batch(b).create(object_id=object_id, term=term)
+            if is_field_term(term):
+                field, value = term.split(FIELD_SEPARATOR, 1)
+                SearchFacet.batch(b).create(field=field, value=value)
                 continue
+            for gram in term_grams(term):
+                SearchGram.batch(b).create(gram=gram,
+                                           object_id=object_id,
+                                           term=term,
+                                           object_type=object_type,
+                                           frequency=frequency,
+                                           acl=acl)
+        b.execute()
 
-            SearchIndex.create(term=term,
-                               object_type=object_type,
-                               object_id=object.id)
-            result_count += 1
+    @classmethod
+    def migrate(cls):
+        """Convert the rows of the legacy search index to postings of the
+        SearchTerm table, return the number of migrated objects.
 
-        return result_count
+        The legacy rows of an object are deleted once its postings have
+        been written so the migration can be restarted. The rows of the
+        objects which don't exist anymore are dropped.
+        """
+        migrated = set()
+        for row in LegacySearchIndex.objects.all().limit(None):
+            if row.object_id in migrated:
+                continue
+            rows = list(LegacySearchIndex.objects.filter(
+                object_id=row.object_id).limit(None))
+            # The object is needed for the ACL of its postings
+            obj = load_object((row.object_id, row.object_type, 0))
+            if obj is not None:
+                frequencies = Counter(r.term for r in rows)
+                cls.write_postings(row.object_id, row.object_type, frequencies,
+                                   acl_mask(obj.read_access))
 
-    def __unicode__(self):
-        return unicode("".format(self.term, self.object_type))
+            for r in rows:
+                r.delete()
+            migrated.add(row.object_id)
+        return len(migrated)
@@ -0,0 +1,111 @@
+"""Reindex script
+
+Rebuilds the search index of the collections and resources below a path.
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+import sys
+import threading
+import time
+from Queue import Queue
+from threading import Thread
+
+from drastic.models.collection import Collection
+from drastic.models.resource import Resource
+from drastic.models.search import FIELDS, SearchIndex
+import log
+
+logger = log.init_log('reindex')
+
+# Seconds between two progress reports
+PROGRESS_INTERVAL = 10
+
+
+# noinspection PyUnusedLocal
+def do_reindex(cfg, args):
+    path = args.command[1] if len(args.command) > 1 else '/'
+    collection = Collection.find_by_path(path)
+    resource = None if collection else Resource.find_by_path(path)
+    if not collection and not resource:
+        msg = u"Could not find a collection or a resource at {}".format(path)
+        logger.error(msg)
+        print msg
+        sys.exit(1)
+
+    reindexer = Reindexer(args.workers or 8)
+    if collection:
+        reindexer.start(collection)
+    else:
+        reindexer.start_resource(resource)
+
+
+class Reindexer(object):
+    """Reindex a subtree with a bounded number of worker threads"""
+
+    def __init__(self, workers=8):
+        self.workers = workers
+        # Bounded, so the walk doesn't get too far ahead of the workers
+        self.queue = Queue(maxsize=workers * 100)
+        self.lock = threading.Lock()
+        self.count = 0
+        self.errors = 0
+        self.t0 = None
+        self.last_report = None
+
+    def start(self, collection):
+        """Reindex a collection, its resources and its sub-collections"""
+        self.start_workers()
+        stack = [collection]
+        while stack:
+            coll = stack.pop()
+            self.queue.put(coll)
+            for resource in coll.get_child_resources().limit(None):
+                self.queue.put(resource)
+            stack.extend(coll.get_child_collections().limit(None))
+        self.queue.join()
+        self.report(final=True)
+
+    def start_resource(self, resource):
+        """Reindex a single resource"""
+        self.start_workers()
+        self.queue.put(resource)
+        self.queue.join()
+        self.report(final=True)
+
+    def start_workers(self):
+        self.t0 = self.last_report = time.time()
+        for _ in range(self.workers):
+            t = Thread(target=self.run)
+            t.setDaemon(True)
+            t.start()
+
+    def run(self):
+        while True:
+            obj = self.queue.get()
+            try:
+                SearchIndex.reset(obj.id)
+                SearchIndex.index(obj, FIELDS)
+                failed = 0
+            except Exception as e:
+                logger.error(u"Problem reindexing {}: {}".format(obj.path(), e))
+                failed = 1
+            with self.lock:
+                self.count += 1
+                self.errors += failed
+            self.report()
+            self.queue.task_done()
+
+    def report(self, final=False):
+        """Print the progress, at most every PROGRESS_INTERVAL seconds"""
+        with self.lock:
+            now = time.time()
+            if not final and now - self.last_report < PROGRESS_INTERVAL:
+                return
+            self.last_report = now
+            elapsed = now - self.t0
+            msg = u"Reindexed {} objects in {:.0f} seconds ({:.1f}/s), {} errors".format(
+                self.count, elapsed, self.count / elapsed if elapsed else 0.0, self.errors)
+        logger.info(msg)
+        print msg
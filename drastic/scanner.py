@@ -0,0 +1,98 @@
+"""Directory scanning for the ingester
+
+Lists directories with scandir (the scandir package on Python 2, os.scandir
+when available) so that the type of an entry comes from the directory
+listing instead of a stat call, and walks a tree one level at a time
+with a pool of threads, which matters on network filesystems where each
+call is a round trip. Falls back to os.listdir and os.stat when scandir
+isn't installed.
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+from multiprocessing.pool import ThreadPool
+import os
+import stat
+import sys
+
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = getattr(os, 'scandir', None)
+
+from drastic.log import init_log
+
+logger = init_log('scanner')
+
+
+def list_dir(dirpath, with_files=True):
+    """Return the (subdirectories, files) of a directory, hidden entries
+    excluded. The files are (name, stat result) of the regular files, only
+    listed if with_files is True. Symbolic links are followed"""
+    dirs = []
+    files = []
+    try:
+        if scandir is not None:
+            for entry in scandir(dirpath):
+                if entry.name.startswith('.'):
+                    continue
+                try:
+                    if entry.is_dir():
+                        dirs.append(entry.name)
+                    elif with_files and entry.is_file():
+                        files.append((entry.name, entry.stat()))
+                except OSError:
+                    continue
+        else:
+            for name in os.listdir(dirpath):
+                if name.startswith('.'):
+                    continue
+                try:
+                    st = os.stat(os.path.join(dirpath, name))
+                except OSError:
+                    continue
+                if stat.S_ISDIR(st.st_mode):
+                    dirs.append(name)
+                elif with_files and stat.S_ISREG(st.st_mode):
+                    files.append((name, st))
+    except OSError as e:
+        logger.error("Unable to list {}: {}".format(dirpath, e))
+    dirs.sort()
+    files.sort()
+    return dirs, files
+
+
+def walk_levels(folder, threads=8, max_depth=None):
+    """Walk the subdirectories of a folder breadth first, the directories
+    of a level are listed in parallel. Yield the list of the directory
+    paths of each level, starting with the children of the folder, at
+    most max_depth levels"""
+    pool = ThreadPool(threads)
+    try:
+        frontier = [folder]
+        depth = 0
+        while frontier and (max_depth is None or depth < max_depth):
+            depth += 1
+            listings = pool.map(lambda d: list_dir(d, with_files=False), frontier)
+            level = []
+            for dirpath, (dirs, _) in zip(frontier, listings):
+                level.extend(os.path.join(dirpath, name) for name in dirs)
+            if level:
+                yield level
+            frontier = level
+    finally:
+        pool.close()
+
+
+def read_filelist(path):
+    """Read a list of files, one per line or separated by NUL characters
+    (find -print0), from a file or from the standard input if path is
+    "-" """
+    if path == '-':
+        data = sys.stdin.read()
+    else:
+        with open(path, 'rb') as f:
+            data = f.read()
+    separator = '\0' if '\0' in data else '\n'
+    return [p for p in data.split(separator) if p.strip()]
@@ -0,0 +1,98 @@
+"""Script runner
+
+Runs a listener script once for each event it receives, so that a worker
+(a process or a container) serves many events. The events come on stdin
+and the results go back on stdout, as frames: a 4-byte big-endian length
+followed by a JSON document.
+
+    request:  {"topic": ..., "payload": base64 of the payload}
+    response: {"ok": true|false, "error": ..., "rss": bytes}
+
+The script sees the same thing as when it had a process of its own: the
+topic and the payload as arguments and the payload on stdin. Its output
+goes to stderr.
+
+This module only uses the standard library, it's copied in the sandbox
+and run as
+
+    python -u script_runner.py SCRIPT
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+import base64
+import json
+import os
+import resource
+import runpy
+import struct
+import sys
+import traceback
+from StringIO import StringIO
+
+HEADER = struct.Struct('!I')
+
+
+def read_frame(f):
+    """Return the next document of a stream, None at the end"""
+    header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+    length, = HEADER.unpack(header)
+    data = f.read(length)
+    if len(data) < length:
+        return None
+    return json.loads(data)
+
+
+def write_frame(f, obj):
+    data = json.dumps(obj)
+    f.write(HEADER.pack(len(data)) + data)
+    f.flush()
+
+
+def set_path(script):
+    """Import the modules of the script from its directory, like a script
+    run by itself, and not from the directory of the runner"""
+    runner_directory = os.path.dirname(os.path.abspath(__file__))
+    sys.path[:] = [p for p in sys.path if os.path.abspath(p) != runner_directory]
+    sys.path.insert(0, os.path.dirname(os.path.abspath(script)))
+
+
+def run(script, topic, payload):
+    """Run the script for an event, return the response"""
+    sys.argv = [script, topic, payload]
+    sys.stdin = StringIO(payload)
+    try:
+        runpy.run_path(script, run_name='__main__')
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            return {'ok': False, 'error': 'Exit status {}'.format(e.code)}
+    except Exception:
+        return {'ok': False, 'error': traceback.format_exc().decode('utf8', 'replace')}
+    return {'ok': True}
+
+
+def main(script):
+    set_path(script)
+    # The frames keep the real stdin and stdout, the script gets neither
+    requests = os.fdopen(os.dup(0), 'rb')
+    responses = os.fdopen(os.dup(1), 'wb')
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+    while True:
+        request = read_frame(requests)
+        if request is None:
+            break
+        response = run(script, request['topic'].encode('utf8'), base64.b64decode(request['payload']))
+        # Peak resident memory of the worker, in bytes (kB on Linux)
+        response['rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        sys.stderr.flush()
+        write_frame(responses, response)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1])
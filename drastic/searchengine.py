@@ -0,0 +1,463 @@
+"""Local search engine
+
+An in-process search index for the web tier. It is built from the names
+and metadata of the collections and resources, kept current by the
+create/update/delete messages the models publish on MQTT and saved to
+disk as a snapshot so a restart doesn't have to rebuild it. Cassandra
+remains the source of truth, but queries never touch it.
+
+The posting list of a term is stored as two arrays of unsigned integers
+(document numbers, sorted, and term frequencies). In a snapshot the arrays
+are written one after the other and the file is memory-mapped when it is
+loaded, so a posting list is only read when a query needs it. Changes
+received after the snapshot was loaded are kept in a small in-memory
+delta: an updated document is given a new document number and its old
+number is marked as deleted. Saving a snapshot merges the delta back; the
+snapshot is written from a copy of the index, searches and updates go on
+while it's written.
+
+Results are ranked with BM25.
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+from array import array
+from collections import Counter, defaultdict
+import heapq
+import json
+import math
+import mmap
+import os
+import struct
+import threading
+
+from drastic.log import init_log
+from drastic.models.search import FIELDS, SearchIndex
+from drastic.util import merge
+
+logger = init_log('searchengine')
+
+SNAPSHOT_MAGIC = 'DRSE0001'
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+
+class Document(object):
+    """The indexed fields of a collection or a resource, as received in
+    an event payload"""
+
+    def __init__(self, name, metadata):
+        self.name = name
+        self.metadata = metadata
+
+
+def posting_array(values=()):
+    """Return a compact array of unsigned 32 bits integers"""
+    a = array('I', values)
+    if a.itemsize != 4:
+        a = array('L', values)
+    return a
+
+
+class SearchEngine(object):
+    """In-memory inverted index of the collections and resources"""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        # Held while a snapshot is written or loaded
+        self.save_lock = threading.RLock()
+        # Document table, indexed by document number
+        self.doc_ids = []
+        self.doc_types = []
+        self.doc_paths = []
+        self.doc_lengths = posting_array()
+        self.doc_acls = []
+        self.docnos = {}
+        self.deleted = set()
+        self.total_length = 0
+        # Postings of the snapshot: term -> (offset, count) in buffer
+        self.buffer = None
+        self.snapshot_file = None
+        self.base_terms = {}
+        # Postings added since the snapshot: term -> {docno: frequency}
+        self.delta = defaultdict(dict)
+        # Ids of the objects changed by events while the index is built,
+        # None when it isn't
+        self.touched = None
+
+    def __len__(self):
+        return len(self.docnos)
+
+    def add(self, object_id, object_type, path, terms, read_access=()):
+        """Add or replace a document"""
+        frequencies = Counter(terms)
+        with self.lock:
+            self.remove(object_id)
+            docno = len(self.doc_ids)
+            self.doc_ids.append(object_id)
+            self.doc_types.append(object_type)
+            self.doc_paths.append(path)
+            self.doc_lengths.append(len(terms))
+            self.doc_acls.append(tuple(read_access or ()))
+            self.docnos[object_id] = docno
+            self.total_length += len(terms)
+            for term, frequency in frequencies.iteritems():
+                self.delta[term][docno] = frequency
+
+    def add_object(self, obj):
+        """Add or replace a Collection or a Resource"""
+        self.add(obj.id, obj.__class__.__name__, obj.path(),
+                 SearchIndex.terms(obj, FIELDS), obj.read_access)
+
+    def remove(self, object_id):
+        """Remove a document, if it's indexed"""
+        with self.lock:
+            docno = self.docnos.pop(object_id, None)
+            if docno is not None:
+                self.deleted.add(docno)
+                self.total_length -= self.doc_lengths[docno]
+
+    def build(self):
+        """Index all the collections and resources of the database"""
+        from drastic.models.collection import Collection
+        from drastic.models.resource import Resource
+        with self.lock:
+            self.touched = set()
+        try:
+            for model in (Collection, Resource):
+                for obj in model.objects.all().limit(None):
+                    self.add_built(obj)
+        finally:
+            with self.lock:
+                self.touched = None
+        logger.info('Indexed {} objects'.format(len(self)))
+
+    def add_built(self, obj):
+        """Add an object read by build, unless an event changed it since
+        the build started: the row read may be older than the event"""
+        with self.lock:
+            if self.touched is not None and obj.id in self.touched:
+                return
+            self.add_object(obj)
+
+    def touch(self, object_id):
+        """Record that an event changed an object"""
+        with self.lock:
+            if self.touched is not None:
+                self.touched.add(object_id)
+
+    def apply_event(self, topic, payload):
+        """Update the index with a message published by Collection or
+        Resource.mqtt_publish"""
+        path = topic.split('/')
+        if path[0] == 'bulk':
+            return self.apply_bulk_event(path, payload)
+        if len(path) < 2 or path[1] not in ('collection', 'resource'):
+            return
+        operation = path[0]
+        object_type = path[1].capitalize()
+        if isinstance(payload, basestring):
+            payload = json.loads(payload)
+        if operation == 'delete':
+            with self.lock:
+                self.touch(payload['id'])
+                self.remove(payload['id'])
+        elif operation in ('create', 'update'):
+            doc = Document(payload.get('name', ''),
+                           payload.get('metadata') or {})
+            terms = SearchIndex.terms(doc, FIELDS)
+            with self.lock:
+                self.touch(payload['id'])
+                self.add(payload['id'], object_type,
+                         merge(payload['container'], payload['name']),
+                         terms, payload.get('read_access'))
+
+    def apply_bulk_event(self, path, payload):
+        """Update the index with a summary event of a bulk operation, the
+        summary only has the ids so the objects are loaded from the
+        database"""
+        from drastic.models.collection import Collection
+        from drastic.models.resource import Resource
+        if len(path) < 3 or path[2] not in ('collection', 'resource'):
+            return
+        operation = path[1]
+        model = Collection if path[2] == 'collection' else Resource
+        if isinstance(payload, basestring):
+            payload = json.loads(payload)
+        if 'manifest' in payload:
+            with open(payload['manifest']) as f:
+                ids = [entry['id'] for entry in json.load(f)]
+        else:
+            ids = payload['ids']
+        for object_id in ids:
+            obj = None if operation == 'delete' else model.find_by_id(object_id)
+            with self.lock:
+                self.touch(object_id)
+                if obj is None:
+                    self.remove(object_id)
+                else:
+                    self.add_object(obj)
+
+    def listen(self, host='localhost', port=1883):
+        """Follow the collection and resource events published on the MQTT
+        broker, in a background thread. Return the MQTT client"""
+        import paho.mqtt.client as mqtt
+
+        def on_connect(client, userdata, flags, rc):
+            client.subscribe([('+/collection/#', 0), ('+/resource/#', 0), ('bulk/#', 0)])
+
+        def on_message(client, userdata, msg):
+            try:
+                self.apply_event(msg.topic, msg.payload)
+            except (ValueError, KeyError, IOError) as e:
+                logger.warning(u'Ignoring event on "{}": {}'.format(msg.topic, e))
+
+        client = mqtt.Client()
+        client.on_connect = on_connect
+        client.on_message = on_message
+        client.connect(host, port, 60)
+        client.loop_start()
+        return client
+
+    def _base_postings(self, term):
+        """Return the (docnos, frequencies) arrays of the snapshot for a
+        term"""
+        entry = self.base_terms.get(term)
+        if entry is None:
+            return posting_array(), posting_array()
+        offset, count = entry
+        size = count * 4
+        docnos = posting_array()
+        docnos.fromstring(self.buffer[offset:offset + size])
+        frequencies = posting_array()
+        frequencies.fromstring(self.buffer[offset + size:offset + 2 * size])
+        return docnos, frequencies
+
+    def postings(self, term):
+        """Return the live postings of a term as a list of
+        (docno, frequency) sorted by docno"""
+        docnos, frequencies = self._base_postings(term)
+        result = [(d, f) for d, f in zip(docnos, frequencies)
+                  if d not in self.deleted]
+        # Documents in the delta always have a bigger number than the
+        # documents of the snapshot
+        delta = self.delta.get(term)
+        if delta:
+            result.extend((d, f) for d, f in sorted(delta.iteritems())
+                          if d not in self.deleted)
+        return result
+
+    def readable(self, docno, user):
+        """Check if a user can read a document"""
+        acl = self.doc_acls[docno]
+        if user is None or user.administrator or not acl:
+            return True
+        return bool(set(acl) & set(user.groups))
+
+    def search(self, termstrings, user=None, limit=20, operator="or"):
+        """Return the `limit` best documents for the terms, as a list of
+        dictionaries. With the "and" operator a document must contain
+        every term"""
+        terms = set(t for t in termstrings if not SearchIndex.is_stop_word(t))
+        with self.lock:
+            n = len(self.docnos)
+            if not n or not terms:
+                return []
+            avgdl = float(self.total_length) / n or 1.0
+            scores = defaultdict(float)
+            matches = Counter()
+            for term in terms:
+                postings = self.postings(term)
+                if not postings:
+                    continue
+                df = len(postings)
+                idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+                for docno, f in postings:
+                    dl = self.doc_lengths[docno]
+                    scores[docno] += idf * f * (K1 + 1) / (f + K1 * (1 - B + B * dl / avgdl))
+                    matches[docno] += 1
+            if operator.lower() == "and":
+                candidates = ((s, d) for d, s in scores.iteritems()
+                              if matches[d] == len(terms))
+            else:
+                candidates = ((s, d) for d, s in scores.iteritems())
+            candidates = ((s, d) for s, d in candidates if self.readable(d, user))
+            best = heapq.nlargest(limit, candidates)
+            return [{'id': self.doc_ids[d],
+                     'result_type': self.doc_types[d],
+                     'path': self.doc_paths[d],
+                     'score': s}
+                    for s, d in best]
+
+    def save(self, path):
+        """Write a snapshot of the index, the file is replaced atomically.
+        The snapshot is written from a copy of the index, without holding
+        the lock, and then loaded; the changes received in the meantime are
+        kept in the delta"""
+        with self.save_lock:
+            frozen = self.freeze()
+            renumber = frozen.write_snapshot(path)
+            self.rebase(path, len(frozen.doc_ids), renumber)
+            logger.info('Saved a snapshot of {} objects in {}'.format(len(renumber), path))
+
+    def freeze(self):
+        """Return a copy of the index, which shares the snapshot"""
+        with self.lock:
+            frozen = SearchEngine()
+            frozen.doc_ids = list(self.doc_ids)
+            frozen.doc_types = list(self.doc_types)
+            frozen.doc_paths = list(self.doc_paths)
+            frozen.doc_lengths = posting_array(self.doc_lengths)
+            frozen.doc_acls = list(self.doc_acls)
+            frozen.docnos = dict(self.docnos)
+            frozen.deleted = set(self.deleted)
+            frozen.total_length = self.total_length
+            frozen.buffer = self.buffer
+            frozen.base_terms = self.base_terms
+            frozen.delta = defaultdict(dict, ((term, dict(postings))
+                                              for term, postings in self.delta.iteritems()))
+            return frozen
+
+    def write_snapshot(self, path):
+        """Write the index in a snapshot, return the {docno: docno in the
+        snapshot} of the live documents"""
+        live = sorted(self.docnos.values())
+        renumber = dict((old, new) for new, old in enumerate(live))
+        terms = set(self.base_terms) | set(self.delta)
+        header_terms = {}
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(' ' * (len(SNAPSHOT_MAGIC) + 8))
+            offset = f.tell()
+            for term in sorted(terms):
+                postings = self.postings(term)
+                if not postings:
+                    continue
+                docnos = posting_array(renumber[d] for d, _ in postings)
+                frequencies = posting_array(fr for _, fr in postings)
+                f.write(docnos.tostring())
+                f.write(frequencies.tostring())
+                header_terms[term] = (offset, len(postings))
+                offset += 8 * len(postings)
+            header = json.dumps({
+                'docs': [(self.doc_ids[d], self.doc_types[d],
+                          self.doc_paths[d], self.doc_lengths[d],
+                          self.doc_acls[d]) for d in live],
+                'terms': header_terms
+            })
+            f.write(header)
+            f.seek(0)
+            f.write(SNAPSHOT_MAGIC + struct.pack('!Q', offset))
+        os.rename(tmp_path, path)
+        return renumber
+
+    def rebase(self, path, frozen_count, renumber):
+        """Load the snapshot written from the first `frozen_count`
+        documents, and add back the documents added and removed since"""
+        with self.lock:
+            # The documents added since the copy follow those of the
+            # snapshot
+            mapping = dict(renumber)
+            added = range(frozen_count, len(self.doc_ids))
+            for i, docno in enumerate(added):
+                mapping[docno] = len(renumber) + i
+            rows = [(self.doc_ids[d], self.doc_types[d], self.doc_paths[d],
+                     self.doc_lengths[d], self.doc_acls[d]) for d in added]
+            delta = defaultdict(dict)
+            for term, postings in self.delta.iteritems():
+                for docno, frequency in postings.iteritems():
+                    if docno >= frozen_count:
+                        delta[term][mapping[docno]] = frequency
+            deleted = set(mapping[d] for d in self.deleted if d in mapping)
+            docnos = dict((object_id, mapping[d]) for object_id, d in self.docnos.iteritems())
+            total_length = self.total_length
+
+            self.load(path)
+            for object_id, object_type, doc_path, length, acl in rows:
+                self.doc_ids.append(object_id)
+                self.doc_types.append(object_type)
+                self.doc_paths.append(doc_path)
+                self.doc_lengths.append(length)
+                self.doc_acls.append(acl)
+            self.delta = delta
+            self.deleted = deleted
+            self.docnos = docnos
+            self.total_length = total_length
+
+    def load(self, path):
+        """Load a snapshot written by save, the postings are memory-mapped"""
+        with self.save_lock, self.lock:
+            f = open(path, 'rb')
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if buf[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+                buf.close()
+                f.close()
+                raise ValueError(u"{} is not a search index snapshot".format(path))
+            start = len(SNAPSHOT_MAGIC)
+            header_offset, = struct.unpack('!Q', buf[start:start + 8])
+            header = json.loads(buf[header_offset:])
+
+            self.close()
+            self.buffer = buf
+            self.snapshot_file = f
+            self.base_terms = dict((term, tuple(entry))
+                                   for term, entry in header['terms'].iteritems())
+            self.delta = defaultdict(dict)
+            self.deleted = set()
+            self.doc_ids = []
+            self.doc_types = []
+            self.doc_paths = []
+            self.doc_lengths = posting_array()
+            self.doc_acls = []
+            for object_id, object_type, doc_path, length, acl in header['docs']:
+                self.doc_ids.append(object_id)
+                self.doc_types.append(object_type)
+                self.doc_paths.append(doc_path)
+                self.doc_lengths.append(length)
+                self.doc_acls.append(tuple(acl))
+            self.docnos = dict((object_id, docno)
+                               for docno, object_id in enumerate(self.doc_ids))
+            self.total_length = sum(self.doc_lengths)
+
+    def close(self):
+        """Release the memory-mapped snapshot"""
+        with self.lock:
+            if self.buffer is not None:
+                self.buffer.close()
+                self.snapshot_file.close()
+            self.buffer = None
+            self.snapshot_file = None
+            self.base_terms = {}
+
+    def autosave(self, path, interval=300):
+        """Save a snapshot every `interval` seconds, in a background
+        thread"""
+        def run():
+            try:
+                self.save(path)
+            except (IOError, OSError) as e:
+                logger.error(u'Unable to save the search index in {}: {}'.format(path, e))
+            self.autosave(path, interval)
+
+        timer = threading.Timer(interval, run)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+
+def load_engine(snapshot_path=None, listen=True):
+    """Return a search engine loaded from a snapshot if there's one, or
+    built from the database otherwise, and following the MQTT events"""
+    engine = SearchEngine()
+    if snapshot_path and os.path.exists(snapshot_path):
+        engine.load(snapshot_path)
+    if listen:
+        # Subscribe before building the index so that no change is missed
+        engine.listen()
+    if not len(engine):
+        engine.build()
+        if snapshot_path:
+            engine.save(snapshot_path)
+    return engine
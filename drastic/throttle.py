@@ -0,0 +1,207 @@
+"""Ingest throttling
+
+Limits the rate at which the ingester writes to Cassandra so that it can
+run alongside the production traffic: token buckets cap the bytes and the
+rows written per second, and the rates are lowered when the write latency
+goes above a target or writes fail (and raised back slowly once it's
+below again).
+
+The limits can be changed while an ingest is running by editing the
+control file, a JSON document such as
+
+    {"bytes_per_second": 10000000, "rows_per_second": 500}
+
+which is read again when it's modified or when the process receives
+SIGHUP. A rate of 0 or null means no limit.
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+import json
+import os
+import threading
+import time
+
+from drastic.log import init_log
+
+logger = init_log('throttle')
+
+# Seconds between two checks of the control file
+CONTROL_INTERVAL = 5.0
+# Seconds of writes over which the latency is averaged
+WINDOW = 1.0
+# The rates are never lowered below this fraction of the limits
+MIN_FACTOR = 0.05
+# Fraction of the limits added back after each window without trouble
+RECOVERY_STEP = 0.05
+
+
+class TokenBucket(object):
+    """Token bucket, consume blocks until enough tokens are available"""
+
+    def __init__(self, rate=None, burst=None):
+        self.lock = threading.Lock()
+        self.tokens = 0.0
+        self.last = time.time()
+        self.rate = None
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        """Change the rate (per second, None or 0 for no limit) and the
+        burst (one second of the rate by default)"""
+        with self.lock:
+            unlimited = self.rate is None
+            self.rate = float(rate) if rate else None
+            self.burst = float(burst) if burst else self.rate
+            if self.rate is not None:
+                # A new limit starts with a full bucket
+                self.tokens = self.burst if unlimited else min(self.tokens, self.burst)
+
+    def consume(self, n=1):
+        """Take n tokens, waiting until the bucket has made up for them if
+        there aren't enough. A request bigger than the burst is allowed, it
+        waits longer"""
+        with self.lock:
+            if self.rate is None:
+                return 0.0
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= n
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class Throttle(object):
+    """Limits of an ingest: bytes and rows per second, lowered when
+    Cassandra slows down"""
+
+    def __init__(self, bytes_per_second=None, rows_per_second=None,
+                 latency_target=0.1, control_file=None, share=1.0):
+        self.limits = {'bytes_per_second': bytes_per_second,
+                       'rows_per_second': rows_per_second}
+        self.latency_target = latency_target
+        # Share of the limits for this process, when several processes
+        # ingest together
+        self.share = share
+        self.control_file = control_file
+        self.control_mtime = None
+        self.next_control_check = 0.0
+        self.bytes = TokenBucket()
+        self.rows = TokenBucket()
+        self.lock = threading.Lock()
+        # Fraction of the limits in use
+        self.factor = 1.0
+        self.window_start = time.time()
+        self.window_latency = 0.0
+        self.window_count = 0
+        self.window_failures = 0
+        # Average latency of the last window
+        self.latency = 0.0
+        self.waited = 0.0
+        self.apply()
+
+    def settings(self, share=None):
+        """Return the arguments to create the same throttle in another
+        process, with its share of the limits"""
+        return {'bytes_per_second': self.limits['bytes_per_second'],
+                'rows_per_second': self.limits['rows_per_second'],
+                'latency_target': self.latency_target,
+                'control_file': self.control_file,
+                'share': self.share if share is None else share}
+
+    def apply(self):
+        """Apply the limits and the factor to the buckets"""
+        for bucket, key in ((self.bytes, 'bytes_per_second'), (self.rows, 'rows_per_second')):
+            limit = self.limits[key]
+            if limit:
+                limit *= self.share
+            bucket.set_rate(limit * self.factor if limit else None,
+                            limit if limit else None)
+
+    def set_limits(self, bytes_per_second=None, rows_per_second=None):
+        with self.lock:
+            self.limits = {'bytes_per_second': bytes_per_second,
+                           'rows_per_second': rows_per_second}
+            self.apply()
+        logger.info(u"Ingest limits: {} bytes/s, {} rows/s".format(
+            bytes_per_second or 'unlimited', rows_per_second or 'unlimited'))
+
+    def reload(self, force=False):
+        """Read the control file again if it has been modified"""
+        if not self.control_file:
+            return
+        try:
+            mtime = os.path.getmtime(self.control_file)
+            if not force and mtime == self.control_mtime:
+                return
+            with open(self.control_file) as f:
+                limits = json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            logger.warning(u"Unable to read the control file {}: {}".format(self.control_file, e))
+            return
+        self.control_mtime = mtime
+        self.set_limits(limits.get('bytes_per_second'), limits.get('rows_per_second'))
+
+    def check_control(self):
+        now = time.time()
+        if self.control_file and now >= self.next_control_check:
+            self.next_control_check = now + CONTROL_INTERVAL
+            self.reload()
+
+    def wait_bytes(self, n):
+        """Wait before writing n bytes"""
+        self.check_control()
+        self.add_wait(self.bytes.consume(n))
+
+    def wait_rows(self, n=1):
+        """Wait before writing n rows. Without a rows limit, the adaptive
+        backoff still spaces the writes out when the factor is lowered"""
+        self.check_control()
+        wait = self.rows.consume(n)
+        if not self.limits['rows_per_second'] and self.factor < 1.0:
+            wait = self.latency * (1.0 / self.factor - 1.0)
+            time.sleep(wait)
+        self.add_wait(wait)
+
+    def add_wait(self, wait):
+        if wait:
+            with self.lock:
+                self.waited += wait
+
+    def observe(self, latency, failed=False):
+        """Record the latency of a write, adapt the factor at the end of
+        each window"""
+        with self.lock:
+            self.window_latency += latency
+            self.window_count += 1
+            self.window_failures += 1 if failed else 0
+            now = time.time()
+            if now - self.window_start < WINDOW:
+                return
+            self.latency = self.window_latency / self.window_count
+            previous = self.factor
+            if self.window_failures or self.latency > self.latency_target:
+                self.factor = max(MIN_FACTOR, self.factor / 2)
+            else:
+                self.factor = min(1.0, self.factor + RECOVERY_STEP)
+            self.window_start = now
+            self.window_latency = 0.0
+            self.window_count = 0
+            self.window_failures = 0
+            if self.factor != previous:
+                self.apply()
+                if self.factor < previous:
+                    logger.info(u"Write latency {:.3f}s, slowing down to {:.0%} of the limits".format(
+                        self.latency, self.factor))
+
+    def metrics(self):
+        with self.lock:
+            return {'factor': self.factor,
+                    'latency': self.latency,
+                    'waited': self.waited,
+                    'bytes_per_second': self.limits['bytes_per_second'],
+                    'rows_per_second': self.limits['rows_per_second']}
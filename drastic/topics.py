@@ -0,0 +1,121 @@
+"""MQTT topic matching
+
+A trie of topic filters, with the + (one level) and # (any number of
+levels, including none) wildcards, which finds the filters matching a
+topic in time proportional to the depth of the topic instead of the
+number of filters.
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+class TopicNode(object):
+    """Level of the trie, values holds the values of the filters which
+    end here"""
+
+    __slots__ = ('children', 'values')
+
+    def __init__(self):
+        self.children = {}
+        self.values = set()
+
+
+class TopicTrie(object):
+    """Topic filters and the values (script names, ...) registered for
+    them"""
+
+    def __init__(self):
+        self.root = TopicNode()
+        # filter -> values
+        self.filters = {}
+
+    def __len__(self):
+        return len(self.filters)
+
+    def add(self, topic_filter, value):
+        node = self.root
+        for word in topic_filter.split('/'):
+            node = node.children.setdefault(word, TopicNode())
+        node.values.add(value)
+        self.filters.setdefault(topic_filter, set()).add(value)
+
+    def remove(self, topic_filter, value):
+        """Remove a value of a filter, the branches left empty are pruned"""
+        path = [self.root]
+        words = topic_filter.split('/')
+        for word in words:
+            node = path[-1].children.get(word)
+            if node is None:
+                return
+            path.append(node)
+        path[-1].values.discard(value)
+        values = self.filters.get(topic_filter)
+        if values is not None:
+            values.discard(value)
+            if not values:
+                del self.filters[topic_filter]
+        for depth in range(len(words), 0, -1):
+            node = path[depth]
+            if node.values or node.children:
+                break
+            del path[depth - 1].children[words[depth - 1]]
+
+    def match(self, topic):
+        """Return the set of the values of the filters matching a topic"""
+        matched = set()
+        words = topic.split('/')
+        nodes = [self.root]
+        for i, word in enumerate(words):
+            next_nodes = []
+            for node in nodes:
+                # Topics starting with $ aren't matched by a wildcard at
+                # the first level
+                wildcards = not (i == 0 and word.startswith('$'))
+                multi = node.children.get('#')
+                if multi is not None and wildcards:
+                    matched.update(multi.values)
+                child = node.children.get(word)
+                if child is not None:
+                    next_nodes.append(child)
+                single = node.children.get('+')
+                if single is not None and wildcards:
+                    next_nodes.append(single)
+            nodes = next_nodes
+            if not nodes:
+                return matched
+        for node in nodes:
+            matched.update(node.values)
+            # "a/#" matches "a" too
+            multi = node.children.get('#')
+            if multi is not None:
+                matched.update(multi.values)
+        return matched
+
+
+def covers(topic_filter, other):
+    """Check if every topic matched by other is matched by topic_filter"""
+    words = topic_filter.split('/')
+    other_words = other.split('/')
+    # Like in match, a wildcard at the first level doesn't match the
+    # topics starting with $
+    if words[0] in ('#', '+') and other.startswith('$'):
+        return False
+    for i, word in enumerate(words):
+        if word == '#':
+            return True
+        if i >= len(other_words):
+            return False
+        if word == '+':
+            if other_words[i] == '#':
+                return False
+        elif word != other_words[i]:
+            return False
+    return len(words) == len(other_words)
+
+
+def reduce_filters(topic_filters):
+    """Return the filters which aren't covered by another one, so that a
+    subscription to them gets each message once"""
+    unique = sorted(set(topic_filters))
+    return [f for f in unique
+            if not any(o != f and covers(o, f) for o in unique)]
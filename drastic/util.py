@@ -12,6 +12,8 @@ import struct
 import base64
 import os.path
 import json
+import random
+import time
 from datetime import datetime
 
 IDENT_PEN = 42223
@@ -123,6 +125,29 @@ def default_uuid():
     return unicode(uuid.uuid4())
 
 
+def derived_uuid(base, *parts):
+    """Return a UUID which always is the same for the same base and parts"""
+    name = u':'.join([unicode(base)] + [unicode(p) for p in parts])
+    return unicode(uuid.uuid5(uuid.NAMESPACE_URL, name.encode('utf8')))
+
+
+def with_retries(fn, attempts=5, base_delay=0.1, max_delay=10.0, on_retry=None):
+    """Call fn until it succeeds, at most `attempts` times. Between two
+    attempts, sleep for a random delay of up to base_delay * 2 ** attempt
+    seconds (capped at max_delay). on_retry is called with the attempt
+    number and the exception before sleeping. The last exception is
+    raised again"""
+    for attempt in xrange(attempts):
+        try:
+            return fn()
+        except Exception as e:
+            if attempt == attempts - 1:
+                raise
+            if on_retry:
+                on_retry(attempt + 1, e)
+            time.sleep(random.uniform(0, min(max_delay, base_delay * 2 ** attempt)))
+
+
 class memoized(object):
     """"Decorator. Caches a function's return value each time it is called.
     If called later with the same arguments, the cached value is returned
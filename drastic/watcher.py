@@ -0,0 +1,182 @@
+"""Filesystem change notifications for the ingester
+
+Watches a folder and its subdirectories with inotify (Linux only, through
+ctypes) and turns the events into the files to ingest, the directories
+which appeared and the paths which disappeared. A file is only reported
+once it has been closed for writing (or moved in) and left alone for a
+short while, so a file which is written in several goes is ingested
+once, complete.
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+
+from drastic.log import init_log
+from drastic.scanner import walk_levels
+
+logger = init_log('watcher')
+
+# Events of inotify(7)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR)
+EVENT_HEADER = struct.Struct('iIII')
+
+# Seconds a closed file must be left alone before it's ingested
+DEBOUNCE = 2.0
+# Seconds after which a file which hasn't been closed is ingested anyway,
+# if it hasn't been modified in the meantime
+OPEN_TIMEOUT = 60.0
+
+
+class WatchError(Exception):
+    """The folder can't be watched"""
+    pass
+
+
+def load_libc():
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    if not hasattr(libc, 'inotify_init1'):
+        raise WatchError("inotify isn't available on this system")
+    return libc
+
+
+class Watcher(object):
+    """inotify watches on a folder and all its subdirectories, hidden
+    directories excluded"""
+
+    def __init__(self, folder, threads=8):
+        self.folder = folder
+        self.threads = threads
+        self.libc = load_libc()
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise WatchError(os.strerror(ctypes.get_errno()))
+        # Watch descriptor -> path of the directory
+        self.wds = {}
+        self.add_tree(folder)
+
+    def add_watch(self, dirpath):
+        wd = self.libc.inotify_add_watch(self.fd, dirpath, WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                raise WatchError("Too many directories to watch, raise "
+                                 "fs.inotify.max_user_watches")
+            # The directory has gone in the meantime
+            logger.warning(u"Unable to watch {}: {}".format(dirpath, os.strerror(err)))
+            return
+        self.wds[wd] = dirpath
+
+    def add_tree(self, dirpath):
+        """Watch a directory and its subdirectories, return the paths of the
+        subdirectories"""
+        self.add_watch(dirpath)
+        subdirs = []
+        for level in walk_levels(dirpath, self.threads):
+            for d in level:
+                self.add_watch(d)
+            subdirs.extend(level)
+        return subdirs
+
+    def read(self, timeout=None):
+        """Return the (path, mask, cookie) of the events received within
+        timeout seconds"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                events.append((None, mask, cookie))
+                continue
+            dirpath = self.wds.get(wd)
+            if mask & IN_IGNORED:
+                self.wds.pop(wd, None)
+                continue
+            if dirpath is None:
+                continue
+            events.append((os.path.join(dirpath, name) if name else dirpath, mask, cookie))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Debouncer(object):
+    """Turns the events into the changes to ingest once they have settled"""
+
+    def __init__(self, delay=DEBOUNCE, open_timeout=OPEN_TIMEOUT):
+        self.delay = delay
+        self.open_timeout = open_timeout
+        # path -> (time of the last event, closed)
+        self.files = {}
+        self.dirs = set()
+        self.deleted = set()
+        self.overflow = False
+
+    def add(self, path, mask, now=None):
+        """Record an event"""
+        now = time.time() if now is None else now
+        if path is None:
+            # Events were lost, the folder has to be walked again
+            self.overflow = True
+            return
+        if os.path.basename(path).startswith('.'):
+            return
+        if mask & (IN_DELETE | IN_MOVED_FROM | IN_DELETE_SELF):
+            self.files.pop(path, None)
+            self.dirs.discard(path)
+            self.deleted.add(path)
+        elif mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self.deleted.discard(path)
+                self.dirs.add(path)
+        elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+            self.deleted.discard(path)
+            self.files[path] = (now, True)
+        elif mask & (IN_CREATE | IN_MODIFY):
+            self.deleted.discard(path)
+            self.files[path] = (now, False)
+
+    def ready(self, now=None):
+        """Return the (files, directories, deleted paths) which have
+        settled, and forget them"""
+        now = time.time() if now is None else now
+        files = []
+        for path, (last, closed) in self.files.items():
+            if now - last >= (self.delay if closed else self.open_timeout):
+                files.append(path)
+                del self.files[path]
+        dirs, self.dirs = sorted(self.dirs), set()
+        deleted, self.deleted = sorted(self.deleted), set()
+        return sorted(files), dirs, deleted
+
+    def pending(self):
+        return len(self.files)
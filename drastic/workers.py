@@ -0,0 +1,197 @@
+"""Worker pools for the listener scripts
+
+Instead of starting a container for each event, each script has a pool of
+long-lived workers running drastic/script_runner.py, fed the events over
+their stdin and stdout. A worker is replaced after a number of events,
+when its memory goes above a limit, when an event takes too long or when
+it dies.
+
+How a worker is started is up to a backend: SubprocessBackend runs it as
+a plain process, DockerBackend in a container of the sandbox image.
+"""
+__copyright__ = "Copyright (C) 2016 University of Maryland"
+__license__ = "GNU AFFERO GENERAL PUBLIC LICENSE, Version 3"
+
+
+import base64
+import os
+import subprocess
+import sys
+import threading
+import uuid
+from Queue import Queue
+
+from drastic.log import init_log
+from drastic.script_runner import read_frame, write_frame
+
+logger = init_log('workers')
+
+RUNNER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'script_runner.py')
+# Seconds an event may take before its worker is killed
+TIMEOUT = 12
+# Events a worker serves before it's replaced
+MAX_EVENTS = 100
+
+
+class SubprocessBackend(object):
+    """Runs the workers as processes of the listener's host"""
+
+    def __init__(self, python=None):
+        self.python = python or sys.executable
+
+    def command(self, script, name):
+        return [self.python, '-u', RUNNER, os.path.abspath(script)]
+
+    def kill(self, proc, name):
+        proc.kill()
+
+
+class DockerBackend(object):
+    """Runs the workers in containers of the sandbox image, the directory
+    of the script and the runner are mounted read-only. The containers are
+    named after their worker, killing the docker client wouldn't stop them"""
+
+    def __init__(self, image='alloy_python', memory=None):
+        self.image = image
+        # Memory limit of a container, such as "256m"
+        self.memory = memory
+
+    def command(self, script, name):
+        absolute_path = os.path.abspath(script)
+        cmd = ['docker', 'run', '--rm', '-i', '--name', name,
+               '-v', '{0}:/scripts:ro'.format(os.path.dirname(absolute_path)),
+               '-v', '{0}:/runner:ro'.format(os.path.dirname(RUNNER)),
+               '--entrypoint', 'python']
+        if self.memory:
+            cmd.extend(('--memory', self.memory))
+        cmd.extend((self.image, '-u', '/runner/script_runner.py',
+                    '/scripts/' + os.path.basename(absolute_path)))
+        return cmd
+
+    def kill(self, proc, name):
+        with open(os.devnull, 'w') as devnull:
+            subprocess.call(['docker', 'kill', name], stdout=devnull, stderr=devnull)
+        proc.kill()
+
+
+BACKENDS = {
+    'docker': DockerBackend,
+    'subprocess': SubprocessBackend,
+}
+
+
+class Worker(object):
+    """A process running a script for each event it's sent"""
+
+    def __init__(self, backend, script, stderr=None):
+        self.backend = backend
+        self.script = script
+        self.name = 'drastic-worker-{0}'.format(uuid.uuid4().hex)
+        self.proc = subprocess.Popen(backend.command(script, self.name), shell=False,
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                     stderr=stderr)
+        self.events = 0
+        self.rss = 0
+
+    @property
+    def pid(self):
+        return self.proc.pid
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    def run(self, topic, payload, timeout=TIMEOUT):
+        """Send an event, return the response of the worker. The worker is
+        killed if it takes longer than timeout seconds"""
+        timer = threading.Timer(timeout, self.kill)
+        timer.start()
+        try:
+            write_frame(self.proc.stdin, {'topic': topic, 'payload': base64.b64encode(payload)})
+            response = read_frame(self.proc.stdout)
+        except (IOError, OSError, ValueError) as e:
+            response = None
+            logger.warning('Worker {0} of "{1}" failed: {2}'.format(self.pid, self.script, e))
+        finally:
+            timer.cancel()
+        self.events += 1
+        if response is None:
+            return {'ok': False, 'error': 'The worker died or timed out'}
+        self.rss = response.get('rss', 0)
+        return response
+
+    def kill(self):
+        try:
+            self.backend.kill(self.proc, self.name)
+        except OSError:
+            pass
+
+    def stop(self):
+        """Let the worker finish, it stops at the end of its stdin"""
+        try:
+            self.proc.stdin.close()
+        except IOError:
+            pass
+        timer = threading.Timer(TIMEOUT, self.kill)
+        timer.start()
+        self.proc.wait()
+        timer.cancel()
+
+
+class WorkerPool(object):
+    """Workers of a script, at most `size` events are processed at once"""
+
+    def __init__(self, backend, script, size=2, max_events=MAX_EVENTS, max_memory=None,
+                 timeout=TIMEOUT, stderr=None):
+        self.backend = backend
+        self.script = script
+        self.timeout = timeout
+        self.max_events = max_events
+        # Peak memory of a worker, in bytes, above which it's replaced
+        self.max_memory = max_memory
+        self.stderr = stderr
+        # Each slot holds an idle worker, or None if it's to be started
+        self.idle = Queue()
+        for _ in range(size):
+            self.idle.put(None)
+        self.closed = False
+
+    def submit(self, topic, payload):
+        """Run the script for an event, waiting for a free worker. Return
+        the response"""
+        worker = self.idle.get()
+        try:
+            if worker is None or not worker.alive():
+                worker = Worker(self.backend, self.script, self.stderr)
+            response = worker.run(topic, payload, self.timeout)
+            if not response['ok']:
+                logger.warning('Script "{0}" failed for topic "{1}": {2}'.format(
+                    self.script, topic, response.get('error')))
+            if self.expired(worker):
+                worker.stop()
+                worker = None
+            return response
+        except OSError as e:
+            logger.error('Unable to start a worker for "{0}": {1}'.format(self.script, e))
+            worker = None
+            return {'ok': False, 'error': str(e)}
+        finally:
+            if self.closed and worker is not None:
+                worker.stop()
+                worker = None
+            self.idle.put(worker)
+
+    def expired(self, worker):
+        """Check if a worker has to be replaced"""
+        if not worker.alive():
+            return True
+        if self.max_events and worker.events >= self.max_events:
+            return True
+        return bool(self.max_memory and worker.rss > self.max_memory)
+
+    def close(self):
+        """Stop the idle workers, the busy ones stop when they are done"""
+        self.closed = True
+        while not self.idle.empty():
+            worker = self.idle.get()
+            if worker is not None:
+                worker.stop()
@@ -15,7 +15,10 @@ setup(
     name='drastic',
     version="1.0",
     description='Drastic core library',
-    extras_require={},
+    extras_require={
+        # Faster directory scanning for the ingester
+        "scandir": ["scandir==1.3"]
+    },
     long_description="Core library for Drastic development",
     author='Archive Analytics',
     maintainer_email='jansen@umd.edu',
@@ -0,0 +1,91 @@
+import hashlib
+import os
+import tempfile
+import unittest
+
+from drastic.checksum import HashPool, check_algorithm, file_digests, part_hash, tree_hash
+from drastic.models.blob import Blob, BlobPart
+
+
+class ChecksumTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def setUp(self):
+        self.data = os.urandom(3 * 1024 * 1024 + 17)
+        fd, self.path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_file_digests(self):
+        digests = file_digests(self.path, ['md5', 'sha256'])
+        assert digests['md5'] == hashlib.md5(self.data).hexdigest()
+        assert digests['sha256'] == hashlib.sha256(self.data).hexdigest()
+
+    def test_pool(self):
+        pool = HashPool('md5', threads=2)
+        try:
+            digests = pool.file(self.path).get()
+            assert digests['md5'] == hashlib.md5(self.data).hexdigest()
+            # The hash of the blob is always computed
+            assert digests['sha256'] == hashlib.sha256(self.data).hexdigest()
+
+            streams = [pool.stream() for _ in range(4)]
+            for i in range(0, len(self.data), 1024 * 1024):
+                for stream in streams:
+                    stream.update(self.data[i:i + 1024 * 1024])
+            for stream in streams:
+                assert stream.hexdigest() == hashlib.sha256(self.data).hexdigest()
+                assert stream.hexdigests()['md5'] == hashlib.md5(self.data).hexdigest()
+        finally:
+            pool.close()
+
+    def test_streams_share_threads(self):
+        # More uploads than threads, each with more chunks than the queue
+        # of a stream holds
+        pool = HashPool(threads=1)
+        try:
+            streams = [pool.stream() for _ in range(8)]
+            chunks = [os.urandom(1000) for _ in range(10)]
+            for chunk in chunks:
+                for stream in streams:
+                    stream.update(chunk)
+            for stream in streams:
+                assert stream.hexdigest() == hashlib.sha256(''.join(chunks)).hexdigest()
+        finally:
+            pool.close()
+
+    def test_unknown_algorithm(self):
+        self.assertRaises(ValueError, check_algorithm, 'nope')
+
+    def test_tree_hash(self):
+        hashes = [part_hash(c) for c in ("a", "b", "c")]
+        leaves = [hashlib.sha256("\x00" + h.decode('hex')).digest() for h in hashes]
+        assert tree_hash(hashes[:1]) == leaves[0].encode('hex')
+        ab = hashlib.sha256("\x01" + leaves[0] + leaves[1]).digest()
+        root = hashlib.sha256("\x01" + ab + leaves[2]).hexdigest()
+        assert tree_hash(hashes) == root
+
+    def test_blob(self):
+        pool = HashPool(threads=2)
+        sizes = []
+        try:
+            with open(self.path, 'rb') as f:
+                blob = Blob.create_from_file(f, len(self.data), hashes=pool,
+                                             wait_bytes=sizes.append)
+        finally:
+            pool.close()
+        assert blob.hash == hashlib.sha256(self.data).hexdigest()
+        assert len(blob.parts) == 4
+        # The upload is throttled part by part
+        assert len(sizes) == 4
+        assert sum(sizes) == len(self.data)
+        assert blob.verify_parts() == []
+        assert blob.verify_tree()
+
+        part = BlobPart.find(blob.parts[2])
+        part.update(content="corrupted")
+        assert blob.verify_parts(2, 3) == [2]
+        assert blob.verify_parts(0, 1) == []
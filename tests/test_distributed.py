@@ -0,0 +1,58 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from drastic.distributed import local_address, split_files, split_plan
+from drastic.ingest import CollectionPlan
+from drastic.models.ingest_job import IngestJob, WorkUnit, DONE
+
+
+class SplitTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        for d in ("a", "a/b", "a/b/c", "a/e", "d"):
+            os.mkdir(os.path.join(self.folder, d))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_split_plan(self):
+        plan = CollectionPlan(self.folder).build(max_depth=2)
+        assert len(plan.levels) == 2
+        units = split_plan(plan, split_depth=2, unit_size=2)
+        assert ('tree', [u"/a/b"]) in units
+        assert ('tree', [u"/a/e"]) in units
+        dirs = [paths for kind, paths in units if kind == 'dirs']
+        assert dirs == [[u"/", u"/a"], [u"/d"]]
+
+    def test_split_files(self):
+        units = split_files(["a/1", "a/2", "d/3"], unit_size=2)
+        assert units == [('files', [u"a/1", u"a/2"]), ('files', [u"d/3"])]
+
+    def test_local_address(self):
+        assert local_address(["127.0.0.1"]) == "127.0.0.1"
+        assert local_address([]) is None
+
+
+class LeaseTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def test_lease(self):
+        job = IngestJob.create(folder=u"/data", user=u"user", group=u"group", units=1)
+        WorkUnit.create(job=job.id, id=u"000000", kind='tree', paths=[u"/a"])
+        unit = list(job.get_units())[0]
+        stale = list(job.get_units())[0]
+        assert unit.claimable()
+        assert unit.claim(u"worker1", 60)
+        # The lease version moved on, the stale copy can't claim the unit
+        assert not stale.claim(u"worker2", 60)
+        assert not list(job.get_units())[0].claimable()
+        assert unit.renew(u"worker1", 60)
+        assert not unit.renew(u"worker2", 60)
+        assert unit.finish(u"worker1", DONE, files=3)
+        unit = list(job.get_units())[0]
+        assert unit.state == DONE
+        assert unit.files == 3
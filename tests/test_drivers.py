@@ -1,7 +1,8 @@
 import unittest
 
-from drastic.drivers import get_driver, NoSuchDriverException
+from drastic.drivers import get_driver, NoSuchDriverError
 from drastic.models.blob import Blob, BlobPart
+from drastic.models.resource import Resource
 
 from nose.tools import raises
 
@@ -18,7 +19,7 @@ class DriverTest(unittest.TestCase):
         assert d is not None
         assert d.url == "path/to/content.csv"
 
-    @raises(NoSuchDriverException)
+    @raises(NoSuchDriverError)
     def test_get_driver_fail(self):
         d = get_driver("fake://doesntexist")
         assert d is None
@@ -33,4 +34,14 @@ class DriverTest(unittest.TestCase):
         assert d
 
         result = ''.join(chunk for chunk in d.chunk_content())
-        assert result == content
\ No newline at end of file
+        assert result == content
+
+    def test_inline_driver(self):
+        d = get_driver("inline://1234567890")
+        assert d.url == "1234567890"
+
+        content = "Testing inline content"
+        resource = Resource(id="1234567890", container="/", name="inline.txt",
+                            url="inline://1234567890", content=content)
+        d = get_driver(resource.url, resource)
+        assert ''.join(d.chunk_content()) == content
@@ -0,0 +1,156 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from drastic import events
+from drastic.events import EventPublisher
+
+
+class EventPublisherTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_drop(self):
+        publisher = EventPublisher(maxsize=2, policy="drop")
+        assert publisher.publish("create/resource/a", "{}")
+        assert publisher.publish("create/resource/b", "{}")
+        assert not publisher.publish("create/resource/c", "{}")
+        metrics = publisher.metrics()
+        assert metrics["depth"] == 2
+        assert metrics["dropped"] == 1
+        assert metrics["max_depth"] == 2
+
+    def test_block_timeout(self):
+        publisher = EventPublisher(maxsize=1, policy="block", block_timeout=0.1)
+        assert publisher.publish("create/resource/a", "{}")
+        assert not publisher.publish("create/resource/b", "{}")
+        assert publisher.metrics()["dropped"] == 1
+
+    def test_spool(self):
+        path = os.path.join(self.tmpdir, "events.spool")
+        publisher = EventPublisher(maxsize=1, policy="spool", spool_path=path)
+        assert publisher.publish("create/resource/a", "{}")
+        assert publisher.publish("create/resource/b", '{"id": "b"}')
+        assert publisher.metrics()["spooled"] == 1
+        with open(path) as f:
+            events = [json.loads(line) for line in f]
+        assert events == [{"topic": "create/resource/b", "payload": '{"id": "b"}'}]
+
+    def test_block_then_spool(self):
+        path = os.path.join(self.tmpdir, "events.spool")
+        publisher = EventPublisher(maxsize=1, policy="block", block_timeout=0.1, spool_path=path)
+        assert publisher.publish("create/resource/a", "{}")
+        assert publisher.publish("create/resource/b", "{}")
+        metrics = publisher.metrics()
+        assert metrics["spooled"] == 1
+        assert metrics["dropped"] == 0
+
+    def test_resume_sending(self):
+        path = os.path.join(self.tmpdir, "events.spool")
+        publisher = EventPublisher(policy="spool", spool_path=path)
+        assert not publisher.has_spool()
+        # Left by a sending which didn't finish
+        with open(path + ".sending", "w") as f:
+            f.write(json.dumps({"topic": "create/resource/a", "payload": "{}"}) + "\n")
+        publisher.spool("create/resource/b", "{}")
+        assert publisher.has_spool()
+        sent = []
+        publisher.send = lambda topic, payload: sent.append(topic) or True
+        publisher.send_spool()
+        assert sent == ["create/resource/a"]
+        publisher.send_spool()
+        assert sent == ["create/resource/a", "create/resource/b"]
+        assert not publisher.has_spool()
+
+    def test_batch(self):
+        publisher = EventPublisher(batch_size=2)
+        for name in "abc":
+            publisher.publish("create/resource/" + name, "{}")
+        batch = publisher.take()
+        assert [topic for topic, _ in batch] == ["create/resource/a", "create/resource/b"]
+        assert publisher.metrics()["depth"] == 1
+
+    def test_bad_policy(self):
+        self.assertRaises(ValueError, EventPublisher, policy="explode")
+        self.assertRaises(ValueError, EventPublisher, policy="spool")
+
+
+class BulkEventsTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def setUp(self):
+        self.published = []
+        self.publish = events.publish
+        events.publish = lambda topic, payload: self.published.append((topic, json.loads(payload)))
+
+    def tearDown(self):
+        events.publish = self.publish
+
+    def payload(self, name, container="/data"):
+        return {"id": "id-" + name, "name": name, "container": container}
+
+    def test_summary(self):
+        with events.bulk("summary", batch_size=2) as bulk:
+            for name in "abc":
+                assert events.collect("create", "resource", self.payload(name))
+            events.collect("create", "collection", self.payload("sub"))
+            # The first batch is full
+            assert [t for t, _ in self.published] == ["bulk/create/resource/data"]
+        assert not events.collect("create", "resource", self.payload("d"))
+        topics = [t for t, _ in self.published]
+        assert sorted(topics[1:3]) == ["bulk/create/collection/data", "bulk/create/resource/data"]
+        assert topics[3] == "bulk/summary"
+        assert self.published[0][1]["ids"] == ["id-a", "id-b"]
+        assert self.published[3][1]["counts"] == {"create/resource": 3, "create/collection": 1}
+        assert bulk.mode == "summary"
+
+    def test_suppress(self):
+        with events.bulk("suppress"):
+            for name in "abc":
+                events.collect("create", "resource", self.payload(name))
+        assert [t for t, _ in self.published] == ["bulk/summary"]
+        assert self.published[0][1]["counts"] == {"create/resource": 3}
+
+    def test_manifest(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with events.bulk("summary", manifest_dir=tmpdir):
+                events.collect("delete", "resource", self.payload("a"))
+            payload = self.published[0][1]
+            assert payload["count"] == 1
+            with open(payload["manifest"]) as f:
+                assert json.load(f) == [{"id": "id-a", "name": "a"}]
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_threads(self):
+        other = []
+        with events.bulk("summary") as bulk:
+            # Another thread publishes its events as usual...
+            t = threading.Thread(target=lambda: other.append(
+                events.collect("create", "resource", self.payload("a"))))
+            t.start()
+            t.join()
+            # ... unless it joins the operation
+            t = threading.Thread(target=events.in_bulk(lambda: other.append(
+                events.collect("create", "resource", self.payload("b")))))
+            t.start()
+            t.join()
+        assert other == [False, True]
+        assert bulk.counts == {"create/resource": 1}
+        # The operation is over, a thread which joined it publishes again
+        assert not bulk.add("create", "resource", self.payload("c"))
+
+    def test_no_bulk(self):
+        with events.bulk(None) as bulk:
+            assert bulk is None
+            assert not events.collect("create", "resource", self.payload("a"))
+        assert self.published == []
@@ -0,0 +1,71 @@
+import unittest
+
+from drastic import indexer
+from drastic.indexer import IndexQueue, start_indexer
+from drastic.models.search import SearchIndex
+from drastic.models.collection import Collection
+from drastic.models.user import User
+
+
+class Changed(object):
+    id = "1"
+
+
+class IndexerTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def test_coalesce(self):
+        queue = IndexQueue()
+        queue.put("1", None)
+        queue.put("2", None)
+        queue.put("1", None)
+        metrics = queue.metrics()
+        assert metrics["depth"] == 2
+        assert metrics["coalesced"] == 1
+        assert metrics["enqueued"] == 3
+
+    def test_in_flight(self):
+        queue = IndexQueue()
+        queue.put("1", "a")
+        queue.put("2", "b")
+        batch = queue.take()
+        assert batch == [("1", "a"), ("2", "b")]
+        # 1 changes again while it's being reindexed, it waits
+        queue.put("1", "c")
+        queue.put("3", "d")
+        assert queue.take() == [("3", "d")]
+        assert queue.metrics()["in_flight"] == 3
+        queue.done(batch)
+        assert queue.take() == [("1", "c")]
+
+    def test_forked(self):
+        # The queue of the parent process has no workers in a child
+        queue = IndexQueue()
+        queue.pid = -1
+        started = indexer._queue
+        indexer._queue = queue
+        try:
+            assert indexer.get_indexer() is None
+            indexer.notify(Changed(), "update")
+            assert queue.metrics()["depth"] == 0
+        finally:
+            indexer._queue = started
+
+    def test_model_hooks(self):
+        queue = start_indexer()
+        User.create(username="test_indexer_user", password="password", email="test@localhost.local", quick=True)
+        user = User.find("test_indexer_user")
+
+        root = Collection.get_root_collection()
+        coll = Collection.create(name="background", container=root.path())
+        assert queue.flush(10)
+        results = SearchIndex.find(["background"], user)
+        assert [r["id"] for r in results] == [coll.id]
+
+        coll.update(metadata={"note": "refreshed"})
+        assert queue.flush(10)
+        assert len(SearchIndex.find(["refreshed"], user)) == 1
+
+        coll.delete()
+        assert queue.flush(10)
+        assert SearchIndex.find(["background"], user) == []
@@ -0,0 +1,184 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from drastic.ingest import (
+    CollectionPlan,
+    DeadLetters,
+    Ingester,
+    initialize_threading,
+    terminate_threading
+)
+from drastic.scanner import list_dir, read_filelist, walk_levels
+from drastic.models.collection import Collection
+from drastic.models.group import Group
+from drastic.models.resource import Resource
+from drastic.models.search import SearchObjectTerm
+from drastic.models.user import User
+from drastic.util import derived_uuid, with_retries
+
+
+class IngestTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        for d in ("ingest_a", "ingest_a/b", "ingest_a/b/c", "ingest_d", ".hidden"):
+            os.mkdir(os.path.join(self.folder, d))
+        for f in ("ingest_a/one.txt", "ingest_a/b/c/two.txt", "ingest_d/three.txt"):
+            with open(os.path.join(self.folder, f), "w") as fh:
+                fh.write(f)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_plan(self):
+        plan = CollectionPlan(self.folder).build()
+        assert len(plan) == 4
+        assert len(plan.levels) == 3
+        assert sorted(p for _, _, _, p in plan.levels[0]) == ["/ingest_a", "/ingest_d"]
+        assert [(parent, name) for _, parent, name, _ in plan.levels[2]] == [("/ingest_a/b", "c")]
+
+    def test_ingest(self):
+        if not Collection.get_root_collection():
+            Collection.create_root()
+        User.create(username="test_ingest_user", password="password", email="test@localhost.local", quick=True)
+        user = User.find("test_ingest_user")
+        group = Group.create(name="test_ingest_group", owner=user.id)
+
+        Ingester(user, group, self.folder, threads=2).start()
+        coll = Collection.find("/ingest_a/b/c")
+        assert coll is not None
+        assert coll.write_access == [group.id]
+        two = Resource.find_by_path("/ingest_a/b/c/two.txt")
+        assert two is not None
+        assert Collection.find("/.hidden") is None
+
+        # A second ingest finds the existing collections and resources, the
+        # postings of the resources stay under their id
+        Ingester(user, group, self.folder, threads=2).start()
+        assert Collection.find("/ingest_a/b/c").id == coll.id
+        assert Resource.find_by_path("/ingest_a/b/c/two.txt").id == two.id
+        assert SearchObjectTerm.objects.filter(object_id=two.id).count()
+
+    def test_delete_paths(self):
+        if not Collection.get_root_collection():
+            Collection.create_root()
+        User.create(username="test_ingest_user", password="password", email="test@localhost.local", quick=True)
+        user = User.find("test_ingest_user")
+        group = Group.create(name="test_ingest_group", owner=user.id)
+
+        ingester = Ingester(user, group, self.folder, threads=2)
+        ingester.start()
+        one = Resource.find_by_path("/ingest_a/one.txt")
+        two = Resource.find_by_path("/ingest_a/b/c/two.txt")
+        assert SearchObjectTerm.objects.filter(object_id=one.id).count()
+
+        ingester.delete_paths([os.path.join(self.folder, "ingest_a", "one.txt"),
+                               os.path.join(self.folder, "ingest_a", "b")])
+        assert Resource.find_by_path("/ingest_a/one.txt") is None
+        assert Collection.find("/ingest_a/b/c") is None
+        # Their postings are gone with them
+        assert SearchObjectTerm.objects.filter(object_id=one.id).count() == 0
+        assert SearchObjectTerm.objects.filter(object_id=two.id).count() == 0
+
+
+class ScannerTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        for d in ("a", "a/b", ".hidden"):
+            os.mkdir(os.path.join(self.folder, d))
+        for f in ("top.txt", "a/one.txt", "a/b/two.txt", ".hidden/three.txt"):
+            with open(os.path.join(self.folder, f), "w") as fh:
+                fh.write(f)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_list_dir(self):
+        dirs, files = list_dir(self.folder)
+        assert dirs == ["a"]
+        assert [name for name, _ in files] == ["top.txt"]
+        assert files[0][1].st_size == len("top.txt")
+
+    def test_walk_levels(self):
+        levels = list(walk_levels(self.folder, threads=2))
+        assert levels == [[os.path.join(self.folder, "a")],
+                          [os.path.join(self.folder, "a/b")]]
+
+    def test_filelist(self):
+        listing = os.path.join(self.folder, "files")
+        with open(listing, "w") as f:
+            f.write("\0".join([os.path.join(self.folder, "a/b/two.txt"), "top.txt",
+                               ".hidden/three.txt", "/elsewhere/four.txt"]))
+        plan = CollectionPlan(self.folder).from_files(read_filelist(listing))
+        assert [[p for _, _, _, p in level] for level in plan.levels] == [["/a"], ["/a/b"]]
+        assert [name for name, _ in plan.list_files(self.folder)] == ["top.txt"]
+        assert plan.list_files(os.path.join(self.folder, "a")) == []
+        assert [name for name, _ in plan.list_files(os.path.join(self.folder, "a/b"))] == ["two.txt"]
+
+
+class RetryTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def test_with_retries(self):
+        calls = []
+        retries = []
+
+        def flaky():
+            calls.append(1)
+            if len(calls) < 3:
+                raise IOError("timeout")
+            return "done"
+
+        result = with_retries(flaky, 5, base_delay=0.001,
+                              on_retry=lambda attempt, e: retries.append(attempt))
+        assert result == "done"
+        assert retries == [1, 2]
+
+    def test_give_up(self):
+        def broken():
+            raise IOError("down")
+        self.assertRaises(IOError, with_retries, broken, 2, 0.001)
+
+    def test_derived_uuid(self):
+        assert derived_uuid("blob", 0) == derived_uuid("blob", 0)
+        assert derived_uuid("blob", 0) != derived_uuid("blob", 1)
+
+    def test_dead_letters(self):
+        folder = tempfile.mkdtemp()
+        try:
+            path = os.path.join(folder, "failed")
+            dead_letters = DeadLetters(path)
+            rdict = {"id": "id-a", "name": u"a.txt", "container": u"/data", "size": 3}
+            context = {"fullpath": u"/data/a.txt", "blob_id": "blob-a",
+                       "stat": os.stat(folder), "written_parts": set(["part-0"])}
+            dead_letters.add(rdict, context, True, IOError("down"))
+            entries = list(DeadLetters.read(path))
+            assert len(entries) == 1
+            replayed, replayed_context, do_load = entries[0]
+            assert replayed == rdict
+            assert do_load
+            assert "stat" not in replayed_context
+            assert replayed_context["written_parts"] == set(["part-0"])
+            assert replayed_context["blob_id"] == "blob-a"
+        finally:
+            shutil.rmtree(folder)
+
+
+class ThreadingTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def test_terminate_threading(self):
+        count = threading.active_count()
+        for _ in range(3):
+            queue, workers = initialize_threading(4)
+            assert threading.active_count() == count + 4
+            terminate_threading(queue, workers)
+            assert not any(t.is_alive() for t in workers)
+        # The threads of each run are gone
+        assert threading.active_count() == count
@@ -0,0 +1,118 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from drastic.manifest import IngestManifest
+
+
+class ManifestTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "manifest.db")
+        self.files = os.path.join(self.tmpdir, "data")
+        os.mkdir(self.files)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, content):
+        path = os.path.join(self.files, name)
+        with open(path, "w") as f:
+            f.write(content)
+        return path
+
+    def test_incremental(self):
+        a = self.write("a.txt", "first")
+        b = self.write("b.txt", "second")
+        manifest = IngestManifest(self.path, self.files)
+        manifest.begin_run()
+        assert manifest.check(a, os.stat(a)) == (False, None)
+        manifest.record(a, os.stat(a), "hash-a", "id-a")
+        manifest.record(b, os.stat(b), "hash-b", "id-b")
+        manifest.finish_run()
+        manifest.close()
+
+        # Second run: a is unchanged, b modified and c new
+        self.write("b.txt", "second, longer")
+        c = self.write("c.txt", "third")
+        manifest = IngestManifest(self.path, self.files)
+        manifest.begin_run()
+        assert manifest.check(a, os.stat(a)) == (True, "id-a")
+        assert manifest.check(b, os.stat(b)) == (False, "id-b")
+        assert manifest.check(c, os.stat(c)) == (False, None)
+        manifest.record(b, os.stat(b), "hash-b2", "id-b")
+        manifest.record(c, os.stat(c), "hash-c", "id-c")
+        assert manifest.deleted() == []
+        manifest.finish_run()
+        manifest.close()
+
+        # Third run: b has been deleted
+        os.remove(b)
+        manifest = IngestManifest(self.path, self.files)
+        manifest.begin_run()
+        assert manifest.check(a, os.stat(a))[0]
+        assert manifest.check(c, os.stat(c))[0]
+        assert manifest.deleted() == [b]
+        manifest.finish_run()
+        assert manifest.lookup(b) is None
+        manifest.close()
+
+    def test_failed(self):
+        a = self.write("a.txt", "first")
+        manifest = IngestManifest(self.path, self.files)
+        manifest.begin_run()
+        manifest.record(a, os.stat(a), "hash-a", "id-a")
+        manifest.finish_run()
+        manifest.close()
+
+        # a changed but its ingest fails, it isn't deleted
+        self.write("a.txt", "first, longer")
+        manifest = IngestManifest(self.path, self.files)
+        manifest.begin_run()
+        assert manifest.check(a, os.stat(a)) == (False, "id-a")
+        assert manifest.deleted() == []
+        manifest.finish_run()
+        assert manifest.lookup(a)[3:] == ("hash-a", "id-a")
+        # It's ingested again by the next run
+        assert not manifest.check(a, os.stat(a))[0]
+        manifest.close()
+
+    def test_partial(self):
+        a = self.write("a.txt", "first")
+        b = self.write("b.txt", "second")
+        manifest = IngestManifest(self.path, self.files)
+        manifest.begin_run()
+        manifest.record(a, os.stat(a), "hash-a", "id-a")
+        manifest.record(b, os.stat(b), "hash-b", "id-b")
+        manifest.finish_run()
+        manifest.close()
+
+        # A run over a list of files only sees a
+        manifest = IngestManifest(self.path, self.files)
+        manifest.begin_run()
+        assert manifest.check(a, os.stat(a))[0]
+        manifest.finish_run(complete=False)
+        assert manifest.lookup(b)[3:] == ("hash-b", "id-b")
+        manifest.close()
+
+        # b is still known to the next run
+        manifest = IngestManifest(self.path, self.files)
+        manifest.begin_run()
+        assert manifest.check(b, os.stat(b)) == (True, "id-b")
+        manifest.close()
+
+    def test_resume(self):
+        a = self.write("a.txt", "first")
+        manifest = IngestManifest(self.path, self.files)
+        run = manifest.begin_run()
+        manifest.record(a, os.stat(a), None, "id-a")
+        # The run never finishes
+        manifest.close()
+
+        manifest = IngestManifest(self.path, self.files)
+        assert manifest.begin_run() == run
+        assert manifest.check(a, os.stat(a)) == (True, "id-a")
+        manifest.close()
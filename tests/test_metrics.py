@@ -0,0 +1,64 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from drastic.metrics import Histogram, IngestMetrics
+
+
+class MetricsTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def test_histogram(self):
+        histogram = Histogram()
+        for seconds in (0.0005, 0.003, 0.003, 0.3, 100.0):
+            histogram.observe(seconds)
+        assert histogram.count == 5
+        assert histogram.min == 0.0005
+        assert histogram.max == 100.0
+        assert histogram.percentile(50) == 0.005
+        assert histogram.percentile(100) == 100.0
+        assert Histogram().percentile(50) is None
+
+    def test_stages(self):
+        metrics = IngestMetrics()
+        with metrics.stage("blob-upload"):
+            pass
+        metrics.observe("blob-upload", 0.5)
+        metrics.file_done(100)
+        metrics.file_done(50)
+        metrics.file_failed()
+        metrics.retry()
+        report = metrics.report()
+        assert report["files"] == 2
+        assert report["bytes"] == 150
+        assert report["failed"] == 1
+        assert report["retries"] == 1
+        assert report["stages"]["blob-upload"]["count"] == 2
+        assert report["stages"]["blob-upload"]["max"] == 0.5
+        assert "2 files, 150 bytes" in metrics.progress_line()
+
+    def test_merge(self):
+        worker = IngestMetrics()
+        worker.file_done(10)
+        worker.observe("resource-insert", 0.01)
+        metrics = IngestMetrics()
+        metrics.observe("resource-insert", 0.2)
+        metrics.merge(json.loads(json.dumps(worker.report())))
+        report = metrics.report()
+        assert report["files"] == 1
+        assert report["stages"]["resource-insert"]["count"] == 2
+        assert report["stages"]["resource-insert"]["min"] == 0.01
+
+    def test_write_report(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "report.json")
+            metrics = IngestMetrics()
+            metrics.file_done(1)
+            metrics.write_report(path)
+            with open(path) as f:
+                assert json.load(f)["files"] == 1
+        finally:
+            shutil.rmtree(tmpdir)
@@ -0,0 +1,140 @@
+import sys
+import unittest
+from StringIO import StringIO
+
+from drastic import reindex
+from drastic.reindex import Reindexer
+from drastic.models.collection import Collection
+from drastic.models.resource import Resource
+from drastic.models.search import SearchIndex, SearchObjectTerm
+from drastic.models.user import User
+
+
+class FakeQuery(list):
+
+    def limit(self, n):
+        return self
+
+
+class FakeObject(object):
+
+    def __init__(self, name, resources=(), collections=()):
+        self.id = "id-" + name
+        self.name = name
+        self.resources = FakeQuery(resources)
+        self.collections = FakeQuery(collections)
+
+    def path(self):
+        return "/" + self.name
+
+    def get_child_resources(self):
+        return self.resources
+
+    def get_child_collections(self):
+        return self.collections
+
+
+class FakeIndex(object):
+    """Records the calls of the reindexer"""
+
+    def __init__(self, failing=()):
+        self.calls = []
+        self.failing = failing
+
+    def reset(self, object_id):
+        self.calls.append(("reset", object_id))
+
+    def index(self, obj, fields):
+        if obj.name in self.failing:
+            raise ValueError("failed")
+        self.calls.append(("index", obj.id))
+
+
+class ReindexerTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def setUp(self):
+        self.index = FakeIndex(failing=("bad", ))
+        self.search_index = reindex.SearchIndex
+        reindex.SearchIndex = self.index
+        self.stdout = sys.stdout
+        sys.stdout = StringIO()
+
+    def tearDown(self):
+        reindex.SearchIndex = self.search_index
+        sys.stdout = self.stdout
+
+    def tree(self):
+        sub = FakeObject("sub", [FakeObject("c"), FakeObject("bad")])
+        return FakeObject("root", [FakeObject("a"), FakeObject("b")], [sub])
+
+    def test_workers(self):
+        reindexer = Reindexer(workers=3)
+        reindexer.start(self.tree())
+        indexed = sorted(object_id for call, object_id in self.index.calls if call == "index")
+        assert indexed == ["id-a", "id-b", "id-c", "id-root", "id-sub"]
+        # Every object is reset before it's indexed, the failed one too
+        reset = [object_id for call, object_id in self.index.calls if call == "reset"]
+        assert sorted(reset) == sorted(indexed + ["id-bad"])
+        for object_id in indexed:
+            assert (self.index.calls.index(("reset", object_id)) <
+                    self.index.calls.index(("index", object_id)))
+        assert reindexer.count == 6
+        assert reindexer.errors == 1
+        assert reindexer.queue.unfinished_tasks == 0
+
+    def test_progress(self):
+        interval = reindex.PROGRESS_INTERVAL
+        reindex.PROGRESS_INTERVAL = 0
+        try:
+            Reindexer(workers=1).start(self.tree())
+        finally:
+            reindex.PROGRESS_INTERVAL = interval
+        lines = sys.stdout.getvalue().splitlines()
+        # One report per object and the final one
+        assert len(lines) == 7
+        assert lines[-1].startswith(u"Reindexed 6 objects")
+        assert lines[-1].endswith(u"1 errors")
+
+    def test_resource(self):
+        reindexer = Reindexer(workers=2)
+        reindexer.start_resource(FakeObject("a"))
+        assert self.index.calls == [("reset", "id-a"), ("index", "id-a")]
+        assert reindexer.count == 1
+
+
+class ReindexContentTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def test_reindex(self):
+        root = Collection.get_root_collection() or Collection.create_root()
+        coll = Collection.create(name="reindex_tree", container=root.path())
+        sub = Collection.create(name="reindex_subfolder", container=coll.path())
+        resource = Resource.create(name="reindex_leaf.txt", container=sub.path(),
+                                   metadata={"colour": "turquoise"})
+
+        User.create(username="test_reindex_user", password="password", email="test@localhost.local", quick=True)
+        user = User.find("test_reindex_user")
+
+        # Postings left by an older version of the objects
+        SearchIndex.write_postings(resource.id, "Resource", {"obsolete": 1})
+        SearchIndex.write_postings(sub.id, "Collection", {"obsolete": 2})
+        assert len(SearchIndex.find(["obsolete"], user)) == 2
+
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            reindexer = Reindexer(workers=2)
+            reindexer.start(coll)
+        finally:
+            sys.stdout = stdout
+        assert reindexer.count == 3
+        assert reindexer.errors == 0
+
+        # The old postings are reset through the reverse index
+        assert SearchIndex.find(["obsolete"], user) == []
+        terms = set(t.term for t in SearchObjectTerm.objects.filter(object_id=resource.id))
+        assert "obsolete" not in terms
+        assert set(["reindex", "leaf", "txt", "turquoise"]) <= terms
+        assert [r["id"] for r in SearchIndex.find(["turquoise"], user)] == [resource.id]
+        assert [r["id"] for r in SearchIndex.find(["subfolder"], user)] == [sub.id]
@@ -1,6 +1,18 @@
 import unittest
 
-from drastic.models.search import SearchIndex
+from drastic.models import search
+from drastic.models.search import (
+    SearchIndex,
+    acl_allows,
+    acl_mask,
+    group_mask,
+    intersect_postings,
+    parse_query,
+    query_grams,
+    ranked,
+    term_grams,
+    union_postings
+)
 from drastic.models.collection import Collection
 from drastic.models.user import User
 from drastic.models.group import Group
@@ -49,3 +61,193 @@ class SearchTest(unittest.TestCase):
 
         results = SearchIndex.find(["protected"], reading_user)
         assert len(results) == 0, results
+
+    def test_find_limit(self):
+        coll = Collection.find("test_root")
+        Collection.create(name="limited one", parent=coll.id)
+        Collection.create(name="limited two", parent=coll.id)
+        for name in ["limited one", "limited two"]:
+            SearchIndex.index(Collection.find(name), ['name'])
+
+        User.create(username="test_limit_user", password="password", email="test@localhost.local", quick=True)
+        user = User.find("test_limit_user")
+
+        results = SearchIndex.find(["limited"], user)
+        assert len(results) == 2, results
+
+        results = SearchIndex.find(["limited"], user, limit=1)
+        assert len(results) == 1, results
+
+    def test_find_and(self):
+        coll = Collection.find("test_root")
+        Collection.create(name="both terms", parent=coll.id)
+        Collection.create(name="both", parent=coll.id)
+        for name in ["both terms", "both"]:
+            SearchIndex.index(Collection.find(name), ['name'])
+
+        User.create(username="test_and_user", password="password", email="test@localhost.local", quick=True)
+        user = User.find("test_and_user")
+
+        results = SearchIndex.find(["both", "terms"], user, operator="and")
+        assert len(results) == 1, results
+        assert results[0]["name"] == "both terms"
+
+        results = SearchIndex.find(["both", "terms"], user, operator="or")
+        assert len(results) == 2, results
+        assert results[0]["hit_count"] == 2
+
+    def test_find_partial(self):
+        coll = Collection.find("test_root")
+        Collection.create(name="spectrometer", parent=coll.id)
+        SearchIndex.index(Collection.find("spectrometer"), ['name'])
+
+        User.create(username="test_partial_user", password="password", email="test@localhost.local", quick=True)
+        user = User.find("test_partial_user")
+
+        for query, match in [("spec", "prefix"), ("s", "prefix"),
+                             ("trome", "substring"), ("sp", "substring")]:
+            results = SearchIndex.find([query], user, match=match)
+            assert len(results) == 1, (query, results)
+
+        assert SearchIndex.find(["trome"], user, match="prefix") == []
+        assert SearchIndex.find(["spec"], user) == []
+
+    def test_find_partial_common_grams(self):
+        coll = Collection.find("test_root")
+        for i in range(4):
+            Collection.create(name="zebrafish{}".format(i), parent=coll.id)
+            SearchIndex.index(Collection.find("zebrafish{}".format(i)), ['name'])
+
+        User.create(username="test_common_user", password="password", email="test@localhost.local", quick=True)
+        user = User.find("test_common_user")
+
+        limit = search.GRAM_SCAN_LIMIT
+        search.GRAM_SCAN_LIMIT = 2
+        try:
+            # Every gram has more postings than the limit, none is left out
+            assert len(SearchIndex.find(["zebraf"], user, match="prefix")) == 4
+            assert len(SearchIndex.find(["brafi"], user, match="substring")) == 4
+            # A single gram is cut at the limit
+            assert len(SearchIndex.find(["z"], user, match="prefix")) == 2
+        finally:
+            search.GRAM_SCAN_LIMIT = limit
+
+    def test_find_page(self):
+        coll = Collection.find("test_root")
+        for i in range(5):
+            Collection.create(name="paged {}".format(i), parent=coll.id)
+            SearchIndex.index(Collection.find("paged {}".format(i)), ['name'])
+
+        User.create(username="test_page_user", password="password", email="test@localhost.local", quick=True)
+        user = User.find("test_page_user")
+
+        first, cursor = SearchIndex.find_page(["paged"], user, limit=2)
+        assert len(first) == 2, first
+        assert cursor
+
+        second, cursor = SearchIndex.find_page(["paged"], user, limit=2, cursor=cursor)
+        third, cursor = SearchIndex.find_page(["paged"], user, limit=2, cursor=cursor)
+        assert len(second) == 2 and len(third) == 1
+        assert cursor is None
+        ids = [r["id"] for r in first + second + third]
+        assert len(set(ids)) == 5
+
+        assert [r["id"] for r in SearchIndex.find(["paged"], user, limit=2, offset=2)] == \
+            [r["id"] for r in second]
+
+    def test_fields_and_facets(self):
+        coll = Collection.find("test_root")
+        Collection.create(name="report 2015", parent=coll.id, metadata={"creator": "Smith"})
+        Collection.create(name="report 2016", parent=coll.id, metadata={"creator": "Jones"})
+        Collection.create(name="summary 2016", parent=coll.id, metadata={"creator": "Smith"})
+        for name in ["report 2015", "report 2016", "summary 2016"]:
+            SearchIndex.index(Collection.find(name), ['name', 'metadata'])
+
+        User.create(username="test_field_user", password="password", email="test@localhost.local", quick=True)
+        user = User.find("test_field_user")
+
+        results, _ = SearchIndex.search("report creator=smith", user)
+        assert [r["name"] for r in results] == ["report 2015"], results
+
+        results, _ = SearchIndex.search("creator=smith", user)
+        assert len(results) == 2, results
+
+        assert SearchIndex.facets("creator") == [("smith", 2), ("jones", 1)]
+        assert SearchIndex.facets("creator", ["report"]) == [("jones", 1), ("smith", 1)]
+
+    def test_acl_update(self):
+        coll = Collection.find("test_root")
+        User.create(username="acl_owner", password="password", email="test@localhost.local", quick=True)
+        User.create(username="acl_reader", password="password", email="test@localhost.local", quick=True)
+        owner = User.find("acl_owner")
+        reader = User.find("acl_reader")
+        group = Group.create(name="acl_group", owner=owner.id)
+
+        Collection.create(name="acl changes", parent=coll.id, read_access=[group.id])
+        c = Collection.find("acl changes")
+        SearchIndex.index(c, ['name'])
+        assert SearchIndex.find(["changes"], reader) == []
+
+        c.update(read_access=[])
+        assert len(SearchIndex.find(["changes"], reader)) == 1
+
+
+class PostingsTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def test_intersect(self):
+        a = [("1", "Resource", 1), ("2", "Resource", 2), ("4", "Collection", 1)]
+        b = [("2", "Resource", 1), ("3", "Resource", 1), ("4", "Collection", 3)]
+        assert intersect_postings([a, b]) == [("2", "Resource", 3),
+                                              ("4", "Collection", 4)]
+        assert intersect_postings([a, []]) == []
+        assert intersect_postings([]) == []
+
+    def test_union(self):
+        a = [("1", "Resource", 1), ("2", "Resource", 2)]
+        b = [("2", "Resource", 1), ("3", "Resource", 1)]
+        assert union_postings([a, b]) == [("1", "Resource", 1),
+                                          ("2", "Resource", 3),
+                                          ("3", "Resource", 1)]
+
+    def test_grams(self):
+        assert term_grams("report") == set(["^r", "^re", "rep", "epo", "por", "ort"])
+        assert query_grams("r", "prefix") == set(["^r"])
+        assert query_grams("rep", "prefix") == set(["^re", "rep"])
+        assert query_grams("por", "substring") == set(["por"])
+        # Too short for a substring lookup, matched as a prefix
+        assert query_grams("re", "substring") == set(["^re"])
+        for query in ["r", "re", "rep", "repo", "report"]:
+            assert query_grams(query, "prefix") <= term_grams("report")
+        for query in ["epo", "port", "eport"]:
+            assert query_grams(query, "substring") <= term_grams("report")
+
+    def test_posting_rows(self):
+        # 2 rows and 6 grams for the word, 3 rows for the field term
+        frequencies = {"report": 2, search.field_term("colour", "red"): 1}
+        assert SearchIndex.posting_rows(frequencies) == 11
+
+    def test_ranked(self):
+        postings = [("b", "Resource", 1), ("c", "Resource", 3),
+                    ("a", "Collection", 1), ("d", "Resource", 2)]
+        assert list(ranked(postings)) == [("c", "Resource", 3),
+                                          ("d", "Resource", 2),
+                                          ("a", "Collection", 1),
+                                          ("b", "Resource", 1)]
+
+    def test_parse_query(self):
+        assert parse_query("creator=smith AND type=PDF") == \
+            ([u"creator=smith", u"type=pdf"], "and")
+        assert parse_query('annual_report title="Annual Report"') == \
+            ([u"annual", u"report", u"title=annual report"], "or")
+
+    def test_acl_mask(self):
+        assert acl_mask([]) == 0
+        mask = acl_mask(["group-1", "group-2"])
+        assert 0 < mask < 2 ** 63
+        assert acl_allows(mask, [group_mask("group-1")])
+        assert acl_allows(mask, [group_mask("group-3"), group_mask("group-2")])
+        assert not acl_allows(mask, [])
+        assert acl_allows(0, [])
+        # Administrators
+        assert acl_allows(mask, None)
@@ -0,0 +1,139 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from drastic.searchengine import SearchEngine
+
+
+def payload(id_, name, metadata=None, read_access=None):
+    return {"id": id_, "container": "/data", "name": name,
+            "metadata": metadata or {}, "read_access": read_access or []}
+
+
+class FakeUser(object):
+
+    def __init__(self, groups, administrator=False):
+        self.groups = groups
+        self.administrator = administrator
+
+
+class Row(object):
+    """A resource as read from the database"""
+
+    def __init__(self, id_, name):
+        self.id = id_
+        self.name = name
+        self.metadata = {}
+        self.read_access = []
+
+    def path(self):
+        return "/data/" + self.name
+
+
+class SearchEngineTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def setUp(self):
+        self.engine = SearchEngine()
+        self.engine.apply_event("create/resource/data/annual_report.pdf",
+                                payload("1", "annual_report.pdf"))
+        self.engine.apply_event("create/resource/data/annual_budget.xls",
+                                payload("2", "annual_budget.xls", {"creator": "smith"}))
+        self.engine.apply_event("create/collection/data/reports",
+                                payload("3", "reports", read_access=["g1"]))
+
+    def test_search(self):
+        results = self.engine.search(["annual"])
+        assert sorted(r["id"] for r in results) == ["1", "2"]
+
+        results = self.engine.search(["annual", "report"], operator="and")
+        assert [r["id"] for r in results] == ["1"]
+        assert results[0]["path"] == "/data/annual_report.pdf"
+        assert results[0]["result_type"] == "Resource"
+
+        results = self.engine.search(["smith"])
+        assert [r["id"] for r in results] == ["2"]
+
+    def test_update_delete(self):
+        self.engine.apply_event("update/resource/data/annual_report.pdf",
+                                payload("1", "monthly_report.pdf"))
+        assert [r["id"] for r in self.engine.search(["annual"])] == ["2"]
+        assert [r["id"] for r in self.engine.search(["monthly"])] == ["1"]
+
+        self.engine.apply_event("delete/resource/data/annual_budget.xls",
+                                payload("2", "annual_budget.xls"))
+        assert self.engine.search(["annual"]) == []
+        assert len(self.engine) == 2
+
+    def test_events_during_build(self):
+        self.engine.touched = set()
+        self.engine.apply_event("update/resource/data/annual_report.pdf",
+                                payload("1", "monthly_report.pdf"))
+        self.engine.apply_event("delete/resource/data/annual_budget.xls",
+                                payload("2", "annual_budget.xls"))
+        # The rows read by the build are older than the events
+        self.engine.add_built(Row("1", "annual_report.pdf"))
+        self.engine.add_built(Row("2", "annual_budget.xls"))
+        self.engine.add_built(Row("4", "annual_summary.txt"))
+        self.engine.touched = None
+        assert [r["id"] for r in self.engine.search(["monthly"])] == ["1"]
+        assert [r["id"] for r in self.engine.search(["annual"])] == ["4"]
+
+    def test_permissions(self):
+        assert self.engine.search(["reports"], FakeUser([])) == []
+        assert len(self.engine.search(["reports"], FakeUser(["g1"]))) == 1
+        assert len(self.engine.search(["reports"], FakeUser([], True))) == 1
+
+    def test_snapshot(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "index.snapshot")
+            self.engine.apply_event("delete/resource/data/annual_budget.xls",
+                                    payload("2", "annual_budget.xls"))
+            self.engine.save(path)
+
+            engine = SearchEngine()
+            engine.load(path)
+            assert len(engine) == 2
+            assert [r["id"] for r in engine.search(["annual"])] == ["1"]
+
+            # Changes after the snapshot are applied on top of it
+            engine.apply_event("create/resource/data/annual_summary.txt",
+                               payload("4", "annual_summary.txt"))
+            assert sorted(r["id"] for r in engine.search(["annual"])) == ["1", "4"]
+            engine.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_changes_during_save(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "index.snapshot")
+            frozen = self.engine.freeze()
+            renumber = frozen.write_snapshot(path)
+            # Changes received while the snapshot is written
+            self.engine.apply_event("create/resource/data/annual_summary.txt",
+                                    payload("4", "annual_summary.txt"))
+            self.engine.apply_event("update/resource/data/annual_report.pdf",
+                                    payload("1", "monthly_report.pdf"))
+            self.engine.apply_event("delete/resource/data/annual_budget.xls",
+                                    payload("2", "annual_budget.xls"))
+            self.engine.rebase(path, len(frozen.doc_ids), renumber)
+
+            assert len(self.engine) == 3
+            assert [r["id"] for r in self.engine.search(["annual"])] == ["4"]
+            assert [r["id"] for r in self.engine.search(["monthly"])] == ["1"]
+            assert self.engine.search(["smith"]) == []
+            assert len(self.engine.search(["reports"], FakeUser(["g1"]))) == 1
+
+            # The next snapshot has the changes
+            self.engine.save(path)
+            engine = SearchEngine()
+            engine.load(path)
+            assert len(engine) == 3
+            assert [r["id"] for r in engine.search(["annual"])] == ["4"]
+            engine.close()
+            self.engine.close()
+        finally:
+            shutil.rmtree(directory)
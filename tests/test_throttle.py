@@ -0,0 +1,67 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from drastic import throttle
+from drastic.throttle import Throttle, TokenBucket
+
+
+class ThrottleTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(100)
+        # The bucket starts full
+        assert bucket.consume(100) == 0.0
+        t0 = time.time()
+        bucket.consume(10)
+        assert time.time() - t0 >= 0.08
+        assert TokenBucket().consume(10 ** 9) == 0.0
+        # A request bigger than the burst waits before it's done
+        bucket = TokenBucket(100)
+        assert bucket.consume(150) >= 0.45
+
+    def test_share(self):
+        t = Throttle(bytes_per_second=1000, rows_per_second=100, share=0.25)
+        assert t.bytes.rate == 250
+        assert t.rows.rate == 25
+        settings = t.settings(0.5)
+        assert settings["share"] == 0.5
+        assert Throttle(**settings).rows.rate == 50
+
+    def test_adaptive(self):
+        window = throttle.WINDOW
+        throttle.WINDOW = 0.0
+        try:
+            t = Throttle(rows_per_second=100, latency_target=0.1)
+            t.observe(0.5)
+            assert t.factor == 0.5
+            assert t.rows.rate == 50
+            t.observe(0.01, failed=True)
+            assert t.factor == 0.25
+            t.observe(0.01)
+            assert t.factor == 0.25 + throttle.RECOVERY_STEP
+        finally:
+            throttle.WINDOW = window
+
+    def test_control_file(self):
+        folder = tempfile.mkdtemp()
+        try:
+            path = os.path.join(folder, "limits.json")
+            with open(path, "w") as f:
+                json.dump({"bytes_per_second": 5000, "rows_per_second": None}, f)
+            t = Throttle(rows_per_second=10, control_file=path)
+            t.reload()
+            assert t.bytes.rate == 5000
+            assert t.rows.rate is None
+            # Not modified, not read again
+            t.set_limits(1, 1)
+            t.reload()
+            assert t.bytes.rate == 1
+            t.reload(force=True)
+            assert t.bytes.rate == 5000
+        finally:
+            shutil.rmtree(folder)
@@ -0,0 +1,45 @@
+import unittest
+
+from drastic.topics import TopicTrie, covers, reduce_filters
+
+
+class TopicTrieTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def setUp(self):
+        self.trie = TopicTrie()
+        self.trie.add("create/resource/data/#", "all_data")
+        self.trie.add("+/resource/data/+", "top_data")
+        self.trie.add("create/resource/data/a.csv", "a")
+        self.trie.add("#", "everything")
+
+    def test_match(self):
+        assert self.trie.match("create/resource/data/a.csv") == set(["all_data", "top_data", "a", "everything"])
+        assert self.trie.match("delete/resource/data/b.csv") == set(["top_data", "everything"])
+        assert self.trie.match("create/resource/data/x/b.csv") == set(["all_data", "everything"])
+        # "#" matches the parent level
+        assert self.trie.match("create/resource/data") == set(["all_data", "everything"])
+        assert self.trie.match("$SYS/broker") == set()
+
+    def test_remove(self):
+        self.trie.remove("#", "everything")
+        self.trie.remove("create/resource/data/a.csv", "a")
+        assert self.trie.match("create/resource/data/a.csv") == set(["all_data", "top_data"])
+        assert self.trie.match("update/collection/data") == set()
+        assert len(self.trie) == 2
+        self.trie.remove("create/resource/data/#", "all_data")
+        self.trie.remove("+/resource/data/+", "top_data")
+        assert self.trie.root.children == {}
+
+    def test_reduce(self):
+        assert covers("a/#", "a")
+        assert covers("+/b", "a/b")
+        assert not covers("+/b", "#")
+        assert not covers("a/b", "a/+")
+        assert reduce_filters(["a/b", "a/+", "c/#", "c/d/e", "a/+"]) == ["a/+", "c/#"]
+        assert reduce_filters(["x", "#"]) == ["#"]
+        # Wildcards don't cover the $ topics
+        assert not covers("#", "$SYS/x")
+        assert not covers("+/x", "$SYS/x")
+        assert covers("$SYS/#", "$SYS/x")
+        assert reduce_filters(["#", "$SYS/x"]) == ["#", "$SYS/x"]
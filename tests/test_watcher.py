@@ -0,0 +1,95 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from drastic.ingest import CollectionPlan
+from drastic.watcher import (
+    Debouncer,
+    Watcher,
+    IN_CLOSE_WRITE,
+    IN_CREATE,
+    IN_DELETE,
+    IN_ISDIR,
+    IN_MODIFY,
+    IN_MOVED_TO
+)
+
+
+class DebouncerTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def test_closed_files(self):
+        d = Debouncer(delay=2, open_timeout=60)
+        d.add("/data/a", IN_CREATE, now=0)
+        d.add("/data/a", IN_MODIFY, now=1)
+        d.add("/data/a", IN_CLOSE_WRITE, now=2)
+        d.add("/data/b", IN_MOVED_TO, now=2)
+        assert d.ready(now=3) == ([], [], [])
+        # Written again before it settled
+        d.add("/data/a", IN_CLOSE_WRITE, now=3.5)
+        assert d.ready(now=4) == (["/data/b"], [], [])
+        assert d.ready(now=6) == (["/data/a"], [], [])
+        assert d.pending() == 0
+
+    def test_open_files(self):
+        d = Debouncer(delay=2, open_timeout=60)
+        d.add("/data/a", IN_CREATE, now=0)
+        assert d.ready(now=10) == ([], [], [])
+        assert d.ready(now=61) == (["/data/a"], [], [])
+
+    def test_deleted(self):
+        d = Debouncer(delay=2)
+        d.add("/data/a", IN_CLOSE_WRITE, now=0)
+        d.add("/data/a", IN_DELETE, now=1)
+        d.add("/data/c", IN_CREATE | IN_ISDIR, now=1)
+        d.add("/data/.hidden", IN_CLOSE_WRITE, now=1)
+        assert d.ready(now=5) == ([], ["/data/c"], ["/data/a"])
+
+    def test_overflow(self):
+        d = Debouncer()
+        d.add(None, 0)
+        assert d.overflow
+
+
+class WatcherTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.folder, "a"))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def read_all(self, watcher):
+        events = []
+        while True:
+            received = watcher.read(0.2)
+            if not received:
+                return events
+            events.extend(received)
+
+    def test_watch(self):
+        watcher = Watcher(self.folder, threads=2)
+        try:
+            assert sorted(watcher.wds.values()) == [self.folder, os.path.join(self.folder, "a")]
+            path = os.path.join(self.folder, "a", "one.txt")
+            with open(path, "w") as f:
+                f.write("one")
+            os.mkdir(os.path.join(self.folder, "b"))
+            d = Debouncer(delay=0)
+            for p, mask, _ in self.read_all(watcher):
+                d.add(p, mask)
+            files, dirs, deleted = d.ready()
+            assert files == [path]
+            assert dirs == [os.path.join(self.folder, "b")]
+            assert deleted == []
+        finally:
+            watcher.close()
+
+    def test_plan_directories(self):
+        plan = CollectionPlan(self.folder).from_files([os.path.join(self.folder, "a", "x")],
+                                                      [os.path.join(self.folder, "b", "c")])
+        assert sorted(p for level in plan.levels for _, _, _, p in level) == ["/a", "/b", "/b/c"]
+        assert plan.files == {os.path.join(self.folder, "a"): ["x"]}
@@ -0,0 +1,163 @@
+import os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from drastic.script_runner import read_frame, write_frame
+from drastic.workers import DockerBackend, SubprocessBackend, WorkerPool
+
+
+class KillBackend(SubprocessBackend):
+    """Records the workers it's asked to kill"""
+
+    def __init__(self):
+        super(KillBackend, self).__init__()
+        self.killed = []
+
+    def kill(self, proc, name):
+        self.killed.append(name)
+        super(KillBackend, self).kill(proc, name)
+
+SCRIPT = """import os, sys
+with open(os.path.join(os.path.dirname(sys.argv[0]), "out"), "a") as f:
+    f.write("%s %s %s %s\\n" % (os.getpid(), sys.argv[1], sys.argv[2], sys.stdin.read()))
+print "not in the frames"
+if sys.argv[2] == "fail":
+    raise ValueError("failed")
+if sys.argv[2] == "exit":
+    sys.exit(3)
+"""
+
+
+class FrameTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def test_round_trip(self):
+        f = StringIO()
+        write_frame(f, {"topic": "a/b", "payload": "x"})
+        write_frame(f, {"ok": True})
+        f.seek(0)
+        assert read_frame(f) == {"topic": "a/b", "payload": "x"}
+        assert read_frame(f) == {"ok": True}
+        assert read_frame(f) is None
+
+    def test_truncated(self):
+        f = StringIO()
+        write_frame(f, {"ok": True})
+        assert read_frame(StringIO(f.getvalue()[:-1])) is None
+
+
+class DockerBackendTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def test_command(self):
+        cmd = DockerBackend(memory="64m").command("/scripts/dir/script.py", "worker")
+        assert cmd[:4] == ["docker", "run", "--rm", "-i"]
+        assert cmd[cmd.index("--name") + 1] == "worker"
+        assert "/scripts/dir:/scripts:ro" in cmd
+        assert cmd[cmd.index("--memory") + 1] == "64m"
+        assert cmd[-1] == "/scripts/script.py"
+
+
+class WorkerPoolTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.script = os.path.join(self.directory, "script.py")
+        with open(self.script, "w") as f:
+            f.write(SCRIPT)
+        self.devnull = open(os.devnull, "w")
+
+    def tearDown(self):
+        self.devnull.close()
+        shutil.rmtree(self.directory)
+
+    def pool(self, **kwargs):
+        return WorkerPool(SubprocessBackend(), self.script, size=1, stderr=self.devnull, **kwargs)
+
+    def runs(self):
+        with open(os.path.join(self.directory, "out")) as f:
+            return [line.split() for line in f]
+
+    def test_reuse(self):
+        pool = self.pool(max_events=0)
+        for i in range(3):
+            assert pool.submit("a/b", "payload{}".format(i))["ok"]
+        pool.close()
+        runs = self.runs()
+        assert [r[1:] for r in runs] == [["a/b", "payload0", "payload0"],
+                                         ["a/b", "payload1", "payload1"],
+                                         ["a/b", "payload2", "payload2"]]
+        # A single worker served every event
+        assert len(set(r[0] for r in runs)) == 1
+
+    def test_recycle(self):
+        pool = self.pool(max_events=2)
+        for _ in range(5):
+            pool.submit("a/b", "x")
+        pool.close()
+        pids = [r[0] for r in self.runs()]
+        assert pids[0] == pids[1] != pids[2] == pids[3] != pids[4]
+
+    def test_memory_limit(self):
+        pool = self.pool(max_memory=1)
+        response = pool.submit("a/b", "x")
+        assert response["rss"] > 1
+        pool.submit("a/b", "x")
+        pool.close()
+        pids = [r[0] for r in self.runs()]
+        assert pids[0] != pids[1]
+
+    def test_failures(self):
+        pool = self.pool()
+        response = pool.submit("a/b", "fail")
+        assert not response["ok"]
+        assert "ValueError" in response["error"]
+        response = pool.submit("a/b", "exit")
+        assert not response["ok"]
+        assert pool.submit("a/b", "x")["ok"]
+        pool.close()
+        # The worker survived the failures
+        assert len(set(r[0] for r in self.runs())) == 1
+
+    def test_imports(self):
+        # The modules next to the script are found, not the ones of drastic
+        with open(os.path.join(self.directory, "util.py"), "w") as f:
+            f.write("VALUE = 42\n")
+        with open(self.script, "w") as f:
+            f.write("import util\nassert util.VALUE == 42\n")
+        pool = self.pool()
+        assert pool.submit("a/b", "x")["ok"]
+        pool.close()
+
+    def test_binary_payload(self):
+        with open(self.script, "w") as f:
+            f.write("import os, sys\n"
+                    "with open(os.path.join(os.path.dirname(sys.argv[0]), 'out'), 'wb') as f:\n"
+                    "    f.write(sys.stdin.read())\n")
+        pool = self.pool()
+        assert pool.submit("a/b", "\xff\x00\xfe")["ok"]
+        pool.close()
+        with open(os.path.join(self.directory, "out"), "rb") as f:
+            assert f.read() == "\xff\x00\xfe"
+
+    def test_timeout(self):
+        with open(self.script, "w") as f:
+            f.write("import time\ntime.sleep(10)\n")
+        backend = KillBackend()
+        pool = WorkerPool(backend, self.script, size=1, timeout=0.5, stderr=self.devnull)
+        response = pool.submit("a/b", "x")
+        assert not response["ok"]
+        # The backend stops the worker
+        assert len(backend.killed) == 1
+        with open(self.script, "w") as f:
+            f.write("pass\n")
+        # The killed worker is replaced
+        assert pool.submit("a/b", "x")["ok"]
+        pool.close()
+
+
+if __name__ == '__main__':
+    unittest.main()